@@ -2,16 +2,36 @@ from flask import Flask, render_template, request, redirect, url_for, session, f
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from functools import wraps
+from werkzeug.exceptions import RequestEntityTooLarge
+from functools import wraps, partial
 import os
 from datetime import datetime, timezone, timedelta
-from collections import defaultdict
 from dotenv import load_dotenv
-from io import BytesIO
 import zipfile
-from flask import send_file
+import csv
+import io
+import itertools
+import hashlib
+import shutil
+import mimetypes
 import secrets
-from sqlalchemy import func
+import base64
+import threading
+import json
+import time
+import queue
+import select
+import smtplib
+from email.message import EmailMessage
+from xml.sax.saxutils import escape as xml_escape
+from collections import OrderedDict
+import click
+from sqlalchemy import func, event, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from flask import g, has_request_context, Response, stream_with_context, send_file
 
 load_dotenv()
 
@@ -24,6 +44,58 @@ if DATABASE_URL is None:
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Эскалация просроченных согласований: интервал в секундах и режим запуска
+# thread - фоновый поток в процессе приложения, off - отдельный воркер (flask escalate-approvals --loop)
+app.config['ESCALATION_INTERVAL'] = int(os.getenv('ESCALATION_INTERVAL', '300'))
+app.config['ESCALATION_SCHEDULER'] = os.getenv('ESCALATION_SCHEDULER', 'thread')
+
+# Максимум SQL-запросов на один HTTP-запрос, проверяется в режиме отладки
+app.config['SQL_QUERY_LIMIT'] = int(os.getenv('SQL_QUERY_LIMIT', '50'))
+
+# Кэш счетчиков панели управления: время жизни в секундах, размер локального кэша
+# и адрес общего кэша для нескольких процессов (redis://...), по умолчанию кэш в памяти процесса
+app.config['DASHBOARD_CACHE_TTL'] = int(os.getenv('DASHBOARD_CACHE_TTL', '60'))
+app.config['DASHBOARD_CACHE_SIZE'] = int(os.getenv('DASHBOARD_CACHE_SIZE', '1000'))
+app.config['DASHBOARD_CACHE_URL'] = os.getenv('DASHBOARD_CACHE_URL')
+
+# Очередь уведомлений: каналы доставки через запятую (log, email), режим и период диспетчера
+# thread - фоновый поток в процессе приложения, off - отдельный воркер (flask dispatch-notifications --loop)
+app.config['NOTIFICATION_CHANNELS'] = os.getenv('NOTIFICATION_CHANNELS', 'log')
+app.config['NOTIFICATION_DISPATCHER'] = os.getenv('NOTIFICATION_DISPATCHER', 'thread')
+app.config['NOTIFICATION_INTERVAL'] = int(os.getenv('NOTIFICATION_INTERVAL', '10'))
+app.config['SMTP_HOST'] = os.getenv('SMTP_HOST', 'localhost')
+app.config['SMTP_PORT'] = int(os.getenv('SMTP_PORT', '25'))
+app.config['SMTP_USERNAME'] = os.getenv('SMTP_USERNAME')
+app.config['SMTP_PASSWORD'] = os.getenv('SMTP_PASSWORD')
+app.config['SMTP_USE_TLS'] = os.getenv('SMTP_USE_TLS', 'false').lower() == 'true'
+app.config['SMTP_SENDER'] = os.getenv('SMTP_SENDER', 'noreply@krok-trips.local')
+
+# События заявок для /api/events: memory - только в пределах процесса,
+# postgresql - через LISTEN/NOTIFY, события видят клиенты всех процессов приложения
+app.config['EVENTS_BROKER'] = os.getenv(
+    'EVENTS_BROKER', 'postgresql' if DATABASE_URL.startswith('postgres') else 'memory')
+app.config['EVENTS_KEEPALIVE'] = int(os.getenv('EVENTS_KEEPALIVE', '15'))  # Секунд между keepalive-комментариями
+
+# Хранилище файлов документов: local - папка на диске приложения, s3 - бакет S3-совместимого
+# хранилища (AWS S3, MinIO), общий для нескольких серверов приложения (нужен пакет boto3)
+app.config['DOCUMENT_STORAGE'] = os.getenv('DOCUMENT_STORAGE', 'local')
+app.config['S3_BUCKET'] = os.getenv('S3_BUCKET')
+app.config['S3_ENDPOINT_URL'] = os.getenv('S3_ENDPOINT_URL')  # Адрес MinIO и других S3-совместимых хранилищ
+app.config['S3_REGION'] = os.getenv('S3_REGION')
+app.config['S3_ACCESS_KEY_ID'] = os.getenv('S3_ACCESS_KEY_ID')
+app.config['S3_SECRET_ACCESS_KEY'] = os.getenv('S3_SECRET_ACCESS_KEY')
+app.config['S3_PRESIGNED_URL_TTL'] = int(os.getenv('S3_PRESIGNED_URL_TTL', '300'))  # Срок действия ссылки, секунд
+
+# Отдача файлов из локального хранилища: app - само приложение (с поддержкой Range),
+# x-accel - nginx по заголовку X-Accel-Redirect, x-sendfile - Apache/lighttpd по заголовку X-Sendfile
+app.config['DOCUMENT_SENDFILE'] = os.getenv('DOCUMENT_SENDFILE', 'app')
+app.config['DOCUMENT_ACCEL_PREFIX'] = os.getenv('DOCUMENT_ACCEL_PREFIX', '/protected-documents/')  # internal location в nginx
+
+# Миниатюры документов: thread - фоновый поток в процессе приложения, off - отдельный воркер
+# (flask generate-previews --loop); нужны пакеты Pillow, для превью PDF - PyMuPDF
+app.config['PREVIEW_GENERATOR'] = os.getenv('PREVIEW_GENERATOR', 'thread')
+app.config['PREVIEW_INTERVAL'] = int(os.getenv('PREVIEW_INTERVAL', '60'))
+
 db = SQLAlchemy(app)
 
 # Убрали db_session - используем db.session напрямую
@@ -32,13 +104,31 @@ db = SQLAlchemy(app)
 UPLOAD_FOLDER = 'static/uploads'
 ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'doc', 'docx', 'xls', 'xlsx'}
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB (было 25MB)
+MAX_UPLOAD_REQUEST_SIZE = MAX_FILE_SIZE + 64 * 1024  # Файл и остальные поля multipart-формы
+ALLOWED_CAMERA_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+
+# Загрузка частями: недокачанные файлы лежат вне static, пока загрузка не завершена
+UPLOAD_PARTIAL_FOLDER = 'uploads_partial'
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Рекомендуемый клиенту размер части
+UPLOAD_SESSION_TTL = timedelta(hours=24)  # Незавершенные загрузки старше удаляются
 
-# Создаем папку для загрузок, если её нет
+# Хранилище документов по содержимому: один файл на SHA-256 (в локальном хранилище -
+# document_store/ab/cd/<sha256>), одинаковые документы разных заявок ссылаются на него
+# (stored_files.ref_count)
+DOCUMENT_STORE_FOLDER = 'document_store'
+
+# Создаем папки для загрузок, если их нет
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(UPLOAD_PARTIAL_FOLDER, exist_ok=True)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+
+def legacy_document_path(file_path):
+    """Путь к файлу документа, загруженного до появления хранилища, по URL /static/uploads/..."""
+    return os.path.join(app.root_path, file_path.lstrip('/'))
+
 # Модели базы данных
 class User(db.Model):
     __tablename__ = 'users'
@@ -59,6 +149,11 @@ class User(db.Model):
     managed_trips = db.relationship('BusinessTrip', backref='manager_rel',
                                    foreign_keys='BusinessTrip.manager_id')
 
+    __table_args__ = (
+        db.Index('ix_users_manager_id', manager_id),
+        db.Index('ix_users_role', role),
+    )
+
 
 class BusinessTrip(db.Model):
     __tablename__ = 'business_trip'
@@ -135,6 +230,30 @@ class BusinessTrip(db.Model):
     procurement_details = db.Column(db.Text)  # Детализация задания к закупке
     procurement_report = db.Column(db.Text)  # Отчет по закупке материалов
 
+    # Версия строки для оптимистичной блокировки: UPDATE проверяет и увеличивает ее
+    version_id = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    # Индексы под фильтры списков, отчетов и эскалации
+    __table_args__ = (
+        db.Index('ix_business_trip_activated_created', is_activated, created_date.desc(), id.desc()),
+        db.Index('ix_business_trip_employee_created', employee_id, created_date.desc(), id.desc()),
+        db.Index('ix_business_trip_status_created', status, created_date.desc(), id.desc()),
+        db.Index('ix_business_trip_manager_id', manager_id),
+        db.Index('ix_business_trip_dates', start_date, end_date),
+        db.Index('ix_business_trip_pending_approval', approval_request_date,
+                 postgresql_where=(status == 'Ожидают согласования'),
+                 sqlite_where=(status == 'Ожидают согласования')),
+        db.Index('ix_business_trip_procurement_created', created_date.desc(), id.desc(),
+                 postgresql_where=(procurement_needed == True),
+                 sqlite_where=(procurement_needed == True)),
+        # Триграммные индексы для поиска по подстроке (только PostgreSQL, расширение pg_trgm)
+        *(db.Index(f'ix_business_trip_{name}_trgm', column, postgresql_using='gin',
+                   postgresql_ops={name: 'gin_trgm_ops'}).ddl_if(dialect='postgresql')
+          for name, column in (('project_number', project_number), ('department', department),
+                               ('purpose', purpose), ('destination', destination))),
+    )
+    __mapper_args__ = {'version_id_col': version_id}
+
 
 class Document(db.Model):
     __tablename__ = 'documents'
@@ -146,9 +265,31 @@ class Document(db.Model):
     description = db.Column(db.Text)
     uploaded_by_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     upload_date = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    content_hash = db.Column(db.String(64), db.ForeignKey('stored_files.sha256'))  # NULL - файл лежит по file_path
     
     trip = db.relationship('BusinessTrip', backref='documents')
     uploaded_by = db.relationship('User')
+    stored_file = db.relationship('StoredFile')
+
+    __table_args__ = (
+        db.Index('ix_documents_trip_upload_date', trip_id, upload_date),
+        db.Index('ix_documents_file_path', file_path),
+    )
+
+
+# Файл в хранилище по содержимому и число документов, которые на него ссылаются
+class StoredFile(db.Model):
+    __tablename__ = 'stored_files'
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_date = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    preview_status = db.Column(db.String(20))  # Миниатюра: NULL - ожидает, processing, ready, none, failed
+    preview_date = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_stored_files_preview_status', preview_status),
+    )
 
 
 class TripCost(db.Model):
@@ -158,9 +299,15 @@ class TripCost(db.Model):
     category = db.Column(db.String(100))
     amount = db.Column(db.Float)
     comment = db.Column(db.Text)
+    version_id = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     trip = db.relationship('BusinessTrip', backref='cost_details')
 
+    __table_args__ = (
+        db.Index('ix_trip_costs_trip_id', trip_id, id),
+    )
+    __mapper_args__ = {'version_id_col': version_id}
+
 # Добавьте в модели (рядом с другими моделями)
 class GeoLocationHistory(db.Model):
     __tablename__ = 'geo_location_history'
@@ -179,6 +326,103 @@ class GeoLocationHistory(db.Model):
     trip = db.relationship('BusinessTrip', backref='geo_history')
     created_by = db.relationship('User')
 
+    __table_args__ = (
+        db.Index('ix_geo_location_history_trip_created', trip_id, created_date),
+    )
+
+
+# Предрасчитанные итоги для отчетов по активированным заявкам
+class TripReportRollup(db.Model):
+    __tablename__ = 'trip_report_rollup'
+    # Пустая строка вместо NULL: месяц без даты начала, заявка без подразделения/статуса/проекта
+    month = db.Column(db.String(7), primary_key=True)  # YYYY-MM по дате начала
+    department = db.Column(db.String(100), primary_key=True)
+    status = db.Column(db.String(50), primary_key=True)
+    project_number = db.Column(db.String(50), primary_key=True)
+
+    trip_count = db.Column(db.Integer, nullable=False, default=0)
+    estimated_costs = db.Column(db.Float, nullable=False, default=0)
+    actual_costs = db.Column(db.Float, nullable=False, default=0)
+    overrun_trips = db.Column(db.Integer, nullable=False, default=0)  # Заявки с превышением лимита
+    overrun_amount = db.Column(db.Float, nullable=False, default=0)
+    overrun_approved_trips = db.Column(db.Integer, nullable=False, default=0)  # Есть согласованный перерасход
+
+
+# Очередь уведомлений: запрос добавляет одну строку на событие в своей транзакции,
+# получателей определяет и рассылку выполняет фоновый диспетчер
+class NotificationOutbox(db.Model):
+    __tablename__ = 'notification_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    event_type = db.Column(db.String(50), nullable=False)
+    trip_id = db.Column(db.Integer, db.ForeignKey('business_trip.id'))
+    message = db.Column(db.Text, nullable=False)
+    recipient_roles = db.Column(db.String(100), default='')  # Роли получателей через запятую
+    recipient_ids = db.Column(db.String(200), default='')  # id получателей через запятую
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, fanned_out
+    created_date = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    processed_date = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_notification_outbox_status', status, id),
+    )
+
+
+# Доставка уведомления одному получателю по одному каналу
+class NotificationDelivery(db.Model):
+    __tablename__ = 'notification_delivery'
+    id = db.Column(db.Integer, primary_key=True)
+    outbox_id = db.Column(db.Integer, db.ForeignKey('notification_outbox.id'), nullable=False)
+    recipient_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    channel = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_date = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    sent_date = db.Column(db.DateTime)
+
+    outbox = db.relationship('NotificationOutbox')
+    recipient = db.relationship('User')
+
+    __table_args__ = (
+        db.Index('ix_notification_delivery_pending', status, next_attempt_date),
+    )
+
+
+# Счетчик номеров заявок за день: последний выданный номер BT-ГГГГММДД-NNNN
+class TripNumberCounter(db.Model):
+    __tablename__ = 'trip_number_counter'
+    day = db.Column(db.Date, primary_key=True)
+    last_value = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Загрузка документа частями: received_size - сколько байт подтверждено клиенту
+class UploadSession(db.Model):
+    __tablename__ = 'upload_sessions'
+    id = db.Column(db.String(32), primary_key=True)
+    trip_id = db.Column(db.Integer, db.ForeignKey('business_trip.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    source = db.Column(db.String(20), nullable=False, default='document')  # document, camera
+    file_type = db.Column(db.String(50))
+    description = db.Column(db.Text)
+    total_size = db.Column(db.Integer, nullable=False)
+    received_size = db.Column(db.Integer, nullable=False, default=0)
+    created_date = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    updated_date = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = (
+        db.Index('ix_upload_sessions_updated_date', updated_date),
+    )
+
+# Пользователь текущего запроса
+def load_current_user():
+    """Пользователь из сессии; загружается один раз за запрос и хранится в g"""
+    if 'current_user' not in g:
+        user_id = session.get('user_id')
+        g.current_user = db.session.get(User, user_id) if user_id else None
+    return g.current_user
+
+
 # Декораторы для проверки прав доступа
 def login_required(f):
     @wraps(f)
@@ -195,7 +439,7 @@ def role_required(roles):
         def decorated_function(*args, **kwargs):
             if 'user_id' not in session:
                 return redirect(url_for('login'))
-            user = db.session.get(User, session['user_id'])
+            user = load_current_user()
             if not user:
                 flash('Пользователь не найден', 'error')
                 return redirect(url_for('login'))
@@ -207,157 +451,997 @@ def role_required(roles):
     return decorator
 
 
-# Функция для проверки просроченных согласований и перенаправления на ГР
-def check_and_redirect_overdue_approvals():
-    """Проверяет заявки, ожидающие согласования более 1 рабочего дня, и перенаправляет на ГР"""
+def with_current_user(f):
+    """Передает в обработчик пользователя текущего запроса аргументом user"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        user = load_current_user()
+        if not user:
+            if request.path.startswith('/api/'):
+                return jsonify({'success': False, 'error': 'Пользователь не найден'})
+            flash('Пользователь не найден', 'error')
+            return redirect(url_for('login'))
+        return f(*args, user=user, **kwargs)
+    return decorated_function
+
+
+# Эскалация просроченных согласований на ГР
+ESCALATION_LOCK_KEY = 7310001  # Ключ advisory-блокировки PostgreSQL для воркера эскалации
+
+
+def escalate_overdue_approvals():
+    """Перенаправляет на ГР заявки, ожидающие согласования более 1 рабочего дня.
+
+    Выполняется под advisory-блокировкой, поэтому при нескольких процессах приложения
+    эскалацию проводит только один из них. Заявки обновляются через apply_trip_update
+    (по одному UPDATE на прежнего согласующего), чтобы подписчики /api/events получили
+    смену согласующего. Возвращает количество перенаправленных заявок.
+    """
     now = datetime.now(timezone.utc)
     one_working_day = timedelta(days=1)
 
-    overdue_trips = BusinessTrip.query.filter(
-        BusinessTrip.status == 'Ожидают согласования',
-        BusinessTrip.approval_request_date.isnot(None)
-    ).all()
-
-    for trip in overdue_trips:
-        if trip.approval_request_date:
-            time_diff = now - trip.approval_request_date
-            if time_diff > one_working_day:
-                # Находим главного руководителя
-                gr_manager = User.query.filter_by(role='GR').first()
-                if gr_manager:
-                    # Перенаправляем на ГР
-                    trip.manager_id = gr_manager.id
-                    # Обновляем дату запроса на согласование
-                    trip.approval_request_date = now
-                    db.session.commit()
+    try:
+        if db.engine.dialect.name == 'postgresql':
+            locked = db.session.execute(
+                db.text('SELECT pg_try_advisory_xact_lock(:key)'), {'key': ESCALATION_LOCK_KEY}
+            ).scalar()
+            if not locked:
+                db.session.rollback()
+                return 0
+
+        # Находим главного руководителя один раз за запуск
+        gr_manager_id = db.session.query(User.id).filter_by(role='GR').order_by(User.id).limit(1).scalar()
+        if gr_manager_id is None:
+            db.session.rollback()
+            return 0
+
+        overdue_ids = db.session.scalars(db.select(BusinessTrip.id).where(
+            BusinessTrip.status == 'Ожидают согласования',
+            BusinessTrip.approval_request_date.isnot(None),
+            BusinessTrip.approval_request_date < now - one_working_day
+        )).all()
+        trip_rows = load_trip_rows(overdue_ids) if overdue_ids else {}
+
+        # Прежний согласующий попадает в условие UPDATE, чтобы событие содержало смену manager_id
+        by_manager = {}
+        for row in trip_rows.values():
+            by_manager.setdefault(row['manager_id'], {})[row['id']] = row
+        escalated = 0
+        for manager_id, rows in by_manager.items():
+            escalated += len(apply_trip_update(rows, {'manager_id': gr_manager_id, 'approval_request_date': now},
+                                               {'status': 'Ожидают согласования', 'manager_id': manager_id}))
+        db.session.commit()
+        return escalated
+    except Exception as e:
+        db.session.rollback()
+        print(f"Ошибка при эскалации согласований: {e}")
+        return 0
+
+
+def run_escalation_loop(interval, stop_event):
+    """Периодически запускает эскалацию, пока не установлен stop_event"""
+    while not stop_event.is_set():
+        with app.app_context():
+            escalated = escalate_overdue_approvals()
+        if escalated:
+            print(f"Перенаправлено на ГР заявок: {escalated}")
+        stop_event.wait(interval)
+
+
+def start_escalation_scheduler():
+    """Запускает фоновый поток эскалации внутри процесса приложения"""
+    stop_event = threading.Event()
+    thread = threading.Thread(
+        target=run_escalation_loop,
+        args=(app.config['ESCALATION_INTERVAL'], stop_event),
+        name='escalation-scheduler',
+        daemon=True
+    )
+    thread.start()
+    return stop_event
+
+
+@app.cli.command('escalate-approvals')
+@click.option('--loop', is_flag=True, help='Работать постоянно с интервалом ESCALATION_INTERVAL')
+def escalate_approvals_command(loop):
+    """Перенаправляет просроченные согласования на ГР (отдельный воркер)"""
+    if loop:
+        run_escalation_loop(app.config['ESCALATION_INTERVAL'], threading.Event())
+    else:
+        click.echo(f"Перенаправлено на ГР заявок: {escalate_overdue_approvals()}")
 
-# Маршруты аутентификации
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    if request.method == 'POST':
-        username = request.form['username']
-        password = request.form['password']
 
-        user = User.query.filter_by(username=username).first()
+# Очередь уведомлений и каналы доставки
+NOTIFICATION_BATCH_SIZE = 500
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_RETRY_DELAY = 60  # Секунд до повторной попытки, удваивается с каждой неудачей
 
-        if user and check_password_hash(user.password_hash, password):
-            session['user_id'] = user.id
-            session['username'] = user.username
-            session['role'] = user.role
-            session['full_name'] = user.full_name
-            flash('Вы успешно вошли в систему', 'success')
-            return redirect(url_for('dashboard'))
-        else:
-            flash('Неверное имя пользователя или пароль', 'error')
+# Будит диспетчер после commit с новыми уведомлениями, не дожидаясь NOTIFICATION_INTERVAL
+notification_wakeup = threading.Event()
 
-    return render_template('login.html')
 
+class LogChannel:
+    """Уведомления в лог приложения"""
+    name = 'log'
 
-@app.route('/logout')
-def logout():
-    session.clear()
-    flash('Вы вышли из системы', 'info')
-    return redirect(url_for('login'))
+    def accepts(self, user):
+        return True
 
+    def send(self, user, messages):
+        for message in messages:
+            print(f"Уведомление для {user.full_name} ({user.role}): {message}")
 
-# Основные маршруты
-@app.route('/')
-def index():
-    if 'user_id' in session:
-        return redirect(url_for('dashboard'))
-    return redirect(url_for('login'))
 
+class EmailChannel:
+    """Уведомления по email через SMTP: все сообщения получателю одним письмом"""
+    name = 'email'
 
-@app.route('/dashboard')
-@login_required
-def dashboard():
-    # Проверяем просроченные согласования
-    check_and_redirect_overdue_approvals()
+    def __init__(self, host, port, sender, username=None, password=None, use_tls=False):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+
+    def accepts(self, user):
+        return bool(user.email)
+
+    def send(self, user, messages):
+        email = EmailMessage()
+        email['Subject'] = ('КРОК.Командировки: уведомление' if len(messages) == 1
+                            else f'КРОК.Командировки: уведомлений - {len(messages)}')
+        email['From'] = self.sender
+        email['To'] = user.email
+        email.set_content('\n\n'.join(messages))
+
+        with smtplib.SMTP(self.host, self.port, timeout=30) as smtp:
+            if self.use_tls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            smtp.send_message(email)
+
+
+NOTIFICATION_CHANNEL_FACTORIES = {
+    'log': lambda config: LogChannel(),
+    'email': lambda config: EmailChannel(config['SMTP_HOST'], config['SMTP_PORT'], config['SMTP_SENDER'],
+                                         config['SMTP_USERNAME'], config['SMTP_PASSWORD'],
+                                         config['SMTP_USE_TLS']),
+}
+
+
+def make_notification_channels(names):
+    """Каналы доставки по списку имен из NOTIFICATION_CHANNELS"""
+    channels = {}
+    for name in filter(None, (part.strip() for part in names.split(','))):
+        if name not in NOTIFICATION_CHANNEL_FACTORIES:
+            raise ValueError(f"Неизвестный канал уведомлений: {name}")
+        channels[name] = NOTIFICATION_CHANNEL_FACTORIES[name](app.config)
+    return channels
+
+
+notification_channels = make_notification_channels(app.config['NOTIFICATION_CHANNELS'])
+
+
+def enqueue_notification(event_type, message, roles=(), user_ids=(), trip=None):
+    """Ставит уведомление в очередь в текущей транзакции; отправка начнется после commit"""
+    notification = NotificationOutbox(
+        event_type=event_type,
+        trip_id=trip.id if trip else None,
+        message=message,
+        recipient_roles=','.join(roles),
+        recipient_ids=','.join(str(user_id) for user_id in user_ids if user_id)
+    )
+    db.session.add(notification)
+    db.session.info['notifications_enqueued'] = True
+    return notification
+
+
+@event.listens_for(Session, 'after_commit')
+def wake_notification_dispatcher(session):
+    if session.info.pop('notifications_enqueued', False):
+        notification_wakeup.set()
+
+
+@event.listens_for(Session, 'after_rollback')
+def reset_notifications_enqueued(session):
+    session.info.pop('notifications_enqueued', None)
+
+
+def split_ids(value):
+    return {int(part) for part in (value or '').split(',') if part}
+
+
+def split_roles(value):
+    return {part for part in (value or '').split(',') if part}
+
+
+def fan_out_notifications(now, batch_size=NOTIFICATION_BATCH_SIZE):
+    """Разворачивает события очереди в доставки: получатели всех событий пачки одним запросом"""
+    events = NotificationOutbox.query.filter_by(status='pending').order_by(
+        NotificationOutbox.id).limit(batch_size).with_for_update(skip_locked=True).all()
+    if not events:
+        return 0
+
+    roles, user_ids = set(), set()
+    for notification in events:
+        roles |= split_roles(notification.recipient_roles)
+        user_ids |= split_ids(notification.recipient_ids)
+    recipients = User.query.filter(db.or_(User.role.in_(roles), User.id.in_(user_ids))).all()
+
+    rows = []
+    for notification in events:
+        event_roles = split_roles(notification.recipient_roles)
+        event_ids = split_ids(notification.recipient_ids)
+        for recipient in recipients:
+            if recipient.role not in event_roles and recipient.id not in event_ids:
+                continue
+            for channel in notification_channels.values():
+                if channel.accepts(recipient):
+                    rows.append({'outbox_id': notification.id, 'recipient_id': recipient.id,
+                                 'channel': channel.name, 'status': 'pending', 'attempts': 0})
+        notification.status = 'fanned_out'
+        notification.processed_date = now
+
+    if rows:
+        db.session.execute(db.insert(NotificationDelivery), rows)
+    db.session.commit()
+    return len(events)
+
+
+def deliver_notifications(now, batch_size=NOTIFICATION_BATCH_SIZE):
+    """Отправляет ожидающие доставки: все сообщения получателю по каналу - одной отправкой"""
+    deliveries = NotificationDelivery.query.options(
+        joinedload(NotificationDelivery.outbox), joinedload(NotificationDelivery.recipient)
+    ).filter(
+        NotificationDelivery.status == 'pending',
+        db.or_(NotificationDelivery.next_attempt_date.is_(None), NotificationDelivery.next_attempt_date <= now)
+    ).order_by(NotificationDelivery.id).limit(batch_size).with_for_update(
+        skip_locked=True, of=NotificationDelivery).all()
+    if not deliveries:
+        return 0
+
+    batches = {}
+    for delivery in deliveries:
+        batches.setdefault((delivery.recipient_id, delivery.channel), []).append(delivery)
+
+    sent = 0
+    for (_, channel_name), batch in batches.items():
+        try:
+            channel = notification_channels.get(channel_name)
+            if channel is None:
+                raise RuntimeError(f"Канал {channel_name} не настроен")
+            channel.send(batch[0].recipient, [delivery.outbox.message for delivery in batch])
+        except Exception as e:
+            print(f"Ошибка доставки уведомлений ({channel_name}): {e}")
+            for delivery in batch:
+                delivery.attempts += 1
+                delivery.last_error = str(e)
+                if delivery.attempts >= NOTIFICATION_MAX_ATTEMPTS:
+                    delivery.status = 'failed'
+                else:
+                    delivery.next_attempt_date = now + timedelta(
+                        seconds=NOTIFICATION_RETRY_DELAY * 2 ** (delivery.attempts - 1))
+            continue
+
+        for delivery in batch:
+            delivery.status = 'sent'
+            delivery.sent_date = now
+        sent += len(batch)
 
-    user = db.session.get(User, session['user_id'])
-    if not user:
-        flash('Пользователь не найден', 'error')
-        return redirect(url_for('login'))
+    db.session.commit()
+    return sent
 
-    # Логика отображения заявок в зависимости от роли
-    if user.role == 'A':  # Администратор
-        trips = BusinessTrip.query.all()
-    elif user.role == 'B':  # Отдел безопасности
-        trips = BusinessTrip.query.all()
-    elif user.role == 'BU':  # Бухгалтерия
-        trips = BusinessTrip.query.all()
-    elif user.role == 'GR':  # Главный руководитель
-        trips = BusinessTrip.query.all()
-    elif user.role == 'R':  # Руководитель
-        # Свои заявки и заявки подчиненных
-        subordinate_ids = [sub.id for sub in user.subordinates]
-        trips = BusinessTrip.query.filter(
-            (BusinessTrip.employee_id == user.id) |
-            (BusinessTrip.employee_id.in_(subordinate_ids))
-        ).all()
-    elif user.role == 'S':  # Сотрудник
-        trips = BusinessTrip.query.filter_by(employee_id=user.id).all()
-    elif user.role == 'K':  # Отдел кадров
-        trips = BusinessTrip.query.all()
-    elif user.role == 'TK':  # Travel-координатор
-        trips = BusinessTrip.query.all()
-    elif user.role == 'Z':  # Отдел закупок
-        # Видит только заявки, где нужна закупка
-        trips = BusinessTrip.query.filter_by(procurement_needed=True).all()
+
+def dispatch_notifications():
+    """Один проход диспетчера; возвращает (обработано событий, отправлено доставок)"""
+    try:
+        events = fan_out_notifications(datetime.now(timezone.utc))
+        sent = deliver_notifications(datetime.now(timezone.utc))
+        return events, sent
+    except Exception as e:
+        db.session.rollback()
+        print(f"Ошибка при рассылке уведомлений: {e}")
+        return 0, 0
+
+
+def run_notification_loop(interval, stop_event):
+    """Рассылает уведомления, пока не установлен stop_event; новые события будят цикл сразу"""
+    while not stop_event.is_set():
+        notification_wakeup.clear()
+        with app.app_context():
+            events, sent = dispatch_notifications()
+        # Полная пачка - вероятно, в очереди есть еще, продолжаем без ожидания
+        if events < NOTIFICATION_BATCH_SIZE and sent < NOTIFICATION_BATCH_SIZE:
+            notification_wakeup.wait(interval)
+
+
+def start_notification_dispatcher():
+    """Запускает фоновый поток рассылки уведомлений внутри процесса приложения"""
+    stop_event = threading.Event()
+    thread = threading.Thread(
+        target=run_notification_loop,
+        args=(app.config['NOTIFICATION_INTERVAL'], stop_event),
+        name='notification-dispatcher',
+        daemon=True
+    )
+    thread.start()
+    return stop_event
+
+
+@app.cli.command('dispatch-notifications')
+@click.option('--loop', is_flag=True, help='Работать постоянно с интервалом NOTIFICATION_INTERVAL')
+def dispatch_notifications_command(loop):
+    """Рассылает уведомления из очереди (отдельный воркер)"""
+    if loop:
+        run_notification_loop(app.config['NOTIFICATION_INTERVAL'], threading.Event())
+    else:
+        events, sent = dispatch_notifications()
+        click.echo(f"Обработано событий: {events}, отправлено уведомлений: {sent}")
+
+
+# События заявок для клиентов /api/events (server-sent events)
+# Изменения собираются из flush сессии и публикуются только после commit
+TRIP_EVENT_FIELDS = ('status', 'is_activated', 'manager_id', 'over_limit', 'overrun_approved',
+                     'booking_overrun_approved', 'report_overrun_approved', 'booking_completed',
+                     'procurement_needed', 'procurement_done', 'geo_location', 'geo_location_verified',
+                     'report_prepared', 'report_reviewed', 'trip_closed', 'estimated_costs', 'actual_costs')
+TRIP_EVENTS_CHANNEL = 'trip_events'
+EVENT_SUBSCRIBER_QUEUE_SIZE = 100
+
+
+def event_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def collect_trip_events(session):
+    """События текущего flush в виде (id заявки, тип, изменившиеся данные)"""
+    events = []
+    for obj in session.new:
+        if isinstance(obj, BusinessTrip):
+            events.append((obj.id, 'trip_created', {'trip_number': obj.trip_number, 'status': obj.status}))
+        elif isinstance(obj, Document):
+            events.append((obj.trip_id, 'document_added',
+                           {'id': obj.id, 'filename': obj.filename, 'file_type': obj.file_type}))
+        elif isinstance(obj, TripCost):
+            events.append((obj.trip_id, 'costs_changed', {'id': obj.id}))
+        elif isinstance(obj, GeoLocationHistory):
+            events.append((obj.trip_id, 'geo_location', {'location': obj.location,
+                                                         'location_type': obj.location_type,
+                                                         'created_date': event_value(obj.created_date)}))
+
+    for obj in session.dirty:
+        if isinstance(obj, BusinessTrip):
+            state = inspect(obj)
+            changes = {field: event_value(getattr(obj, field)) for field in TRIP_EVENT_FIELDS
+                       if state.attrs[field].history.has_changes()}
+            if changes:
+                events.append((obj.id, 'trip_updated', changes))
+        elif isinstance(obj, TripCost) and session.is_modified(obj):
+            events.append((obj.trip_id, 'costs_changed', {'id': obj.id}))
+
+    for obj in session.deleted:
+        if isinstance(obj, (Document, TripCost)):
+            values = inspect(obj).dict
+            event_type = 'document_deleted' if isinstance(obj, Document) else 'costs_changed'
+            events.append((values.get('trip_id'), event_type, {'id': values.get('id')}))
+    return events
+
+
+def trip_event_audience(connection, trip_ids):
+    """Поля заявок, по которым решается, кому видно событие (см. can_view_trip)"""
+    rows = connection.execute(
+        db.select(BusinessTrip.id, BusinessTrip.employee_id, User.manager_id.label('employee_manager_id'),
+                  BusinessTrip.procurement_needed)
+        .outerjoin(User, User.id == BusinessTrip.employee_id)
+        .where(BusinessTrip.id.in_(trip_ids))
+    )
+    return {row.id: {'employee_id': row.employee_id, 'employee_manager_id': row.employee_manager_id,
+                     'procurement_needed': bool(row.procurement_needed)} for row in rows}
+
+
+def can_view_trip_event(user, payload):
+    """То же правило, что и can_view_trip, но по полям события без обращения к БД"""
+    if 'trip_id' not in payload:  # Служебные события (resync) получают все
+        return True
+    if user.role == 'R':
+        return user.id in (payload['employee_id'], payload['employee_manager_id'])
+    if user.role == 'S':
+        return payload['employee_id'] == user.id
+    if user.role == 'Z':
+        return payload['procurement_needed']
+    return True
+
+
+class MemoryEventBroker:
+    """Рассылка событий подписчикам внутри одного процесса"""
+
+    def __init__(self):
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        subscription = queue.Queue(EVENT_SUBSCRIBER_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def publish(self, payloads):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscription in subscribers:
+            for payload in payloads:
+                try:
+                    subscription.put_nowait(payload)
+                except queue.Full:
+                    # Клиент не успевает читать: сбрасываем очередь и просим его перезагрузить данные
+                    while not subscription.empty():
+                        subscription.get_nowait()
+                    subscription.put_nowait({'type': 'resync'})
+                    break
+
+    def stage(self, session, payloads):
+        """Откладывает события до commit транзакции"""
+        session.info.setdefault('trip_events', []).extend(payloads)
+
+    def commit(self, payloads):
+        self.publish(payloads)
+
+
+class PostgresEventBroker(MemoryEventBroker):
+    """События через PostgreSQL NOTIFY: доставляются при commit всем процессам приложения.
+
+    Каждый процесс держит одно соединение с LISTEN и раздает события своим подписчикам.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.listener = None
+
+    def subscribe(self):
+        with self.lock:
+            if self.listener is None or not self.listener.is_alive():
+                self.listener = threading.Thread(target=self.listen, name='trip-events-listener', daemon=True)
+                self.listener.start()
+        return super().subscribe()
+
+    def stage(self, session, payloads):
+        # NOTIFY транзакционный: при rollback события не уйдут
+        connection = session.connection()
+        for payload in payloads:
+            connection.execute(db.text('SELECT pg_notify(:channel, :payload)'),
+                               {'channel': TRIP_EVENTS_CHANNEL, 'payload': json.dumps(payload)})
+
+    def commit(self, payloads):
+        pass
+
+    def listen(self):
+        while True:
+            try:
+                with app.app_context():
+                    raw_connection = db.engine.raw_connection()
+                # Соединение в режиме autocommit не возвращаем в общий пул
+                raw_connection.detach()
+                connection = raw_connection.driver_connection
+                try:
+                    connection.autocommit = True
+                    connection.cursor().execute(f'LISTEN {TRIP_EVENTS_CHANNEL}')
+                    while True:
+                        if select.select([connection], [], [], 60) == ([], [], []):
+                            continue
+                        connection.poll()
+                        payloads = []
+                        while connection.notifies:
+                            payloads.append(json.loads(connection.notifies.pop(0).payload))
+                        if payloads:
+                            self.publish(payloads)
+                finally:
+                    connection.close()
+            except Exception as e:
+                print(f"Ошибка подписки на события заявок: {e}")
+                time.sleep(5)
+
+
+def make_event_broker(name):
+    if name == 'postgresql':
+        return PostgresEventBroker()
+    if name == 'memory':
+        return MemoryEventBroker()
+    raise ValueError(f"Неизвестный брокер событий: {name}")
+
+
+event_broker = make_event_broker(app.config['EVENTS_BROKER'])
+
+
+@event.listens_for(Session, 'after_flush')
+def stage_trip_events(session, flush_context):
+    events = collect_trip_events(session)
+    if not events:
+        return
+    audience = trip_event_audience(session.connection(), {trip_id for trip_id, _, _ in events})
+    empty_audience = {'employee_id': None, 'employee_manager_id': None, 'procurement_needed': False}
+    event_broker.stage(session, [
+        dict(type=event_type, trip_id=trip_id, data=data, **audience.get(trip_id, empty_audience))
+        for trip_id, event_type, data in events
+    ])
+
+
+@event.listens_for(Session, 'after_commit')
+def publish_trip_events(session):
+    payloads = session.info.pop('trip_events', None)
+    if payloads:
+        event_broker.commit(payloads)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_trip_events(session):
+    session.info.pop('trip_events', None)
+
+
+def format_sse(payload):
+    """Событие в формате text/event-stream; тип события - в поле event"""
+    data = {key: payload[key] for key in ('trip_id', 'data') if key in payload}
+    return f"event: {payload['type']}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# Номера заявок
+def format_trip_number(day, value):
+    """Номер заявки вида BT-20250314-0042"""
+    return f"BT-{day.strftime('%Y%m%d')}-{value:04d}"
+
+
+def allocate_trip_numbers(count=1, now=None):
+    """Выдает count последовательных номеров заявок за текущий день (UTC).
+
+    Номера берутся из счетчика дня одним UPSERT ... RETURNING, поэтому параллельные
+    запросы и импорт получают разные номера без повторных попыток. В PostgreSQL счетчик
+    увеличивается в отдельной короткой транзакции, чтобы блокировка строки счетчика
+    не держалась до конца создания заявки; номера откатившихся заявок не переиспользуются.
+    """
+    day = (now or datetime.now(timezone.utc)).date()
+    table = TripNumberCounter.__table__
+
+    def increment(connection):
+        dialect = connection.dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+            stmt = insert(table).values(day=day, last_value=count)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.day],
+                set_={'last_value': table.c.last_value + count}
+            ).returning(table.c.last_value)
+            return connection.execute(stmt).scalar()
+        updated = connection.execute(table.update().where(table.c.day == day).values(
+            last_value=table.c.last_value + count)).rowcount
+        if not updated:
+            connection.execute(table.insert().values(day=day, last_value=count))
+        return connection.execute(db.select(table.c.last_value).where(table.c.day == day)).scalar()
+
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.begin() as connection:
+            last_value = increment(connection)
     else:
-        trips = BusinessTrip.query.all()
+        # SQLite допускает одного писателя: счетчик увеличивается в транзакции сессии
+        last_value = increment(db.session.connection())
+    return [format_trip_number(day, value) for value in range(last_value - count + 1, last_value + 1)]
+
+
+# Импорт заявок из CSV/XLSX
+# Поле заявки -> заголовок столбца в файле; столбец можно назвать и самим именем поля
+TRIP_IMPORT_COLUMNS = {
+    'employee': 'Сотрудник',  # Логин или email
+    'start_date': 'Дата начала',
+    'end_date': 'Дата окончания',
+    'destination': 'Место назначения',
+    'purpose': 'Цель поездки',
+    'estimated_costs': 'Предполагаемые расходы',
+    'department': 'Подразделение',
+    'trip_format': 'Формат проведения',
+    'project_number': 'Номер договора к проекту',
+    'regularity': 'Регулярность',
+    'receiving_party': 'Принимающая сторона',
+    'cost_details': 'Детализация расходов',
+    'over_limit': 'Превышение лимита',
+    'make_active': 'Сделать активированной',
+}
+TRIP_IMPORT_REQUIRED = ('employee', 'start_date', 'end_date', 'destination', 'purpose', 'estimated_costs')
+# XLSX отдает эти поля датами и числами; значение другого типа разбирается как строка
+TRIP_IMPORT_CELL_TYPES = {'start_date': datetime, 'end_date': datetime, 'estimated_costs': (int, float)}
+TRIP_IMPORT_MAX_LENGTHS = {'destination': 200, 'purpose': 200, 'project_number': 50, 'regularity': 50,
+                           'receiving_party': 200, 'department': 100}
+TRIP_IMPORT_FORMATS = ('Онлайн', 'Оффлайн')
+TRIP_IMPORT_CHUNK_SIZE = 1000
+TRIP_IMPORT_MAX_ERRORS = 100  # Сколько строк с ошибками показывать в отчете
+IMPORT_TRUE_VALUES = {'1', 'да', 'yes', 'true', 'x', '+', 'on'}
+IMPORT_DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y', '%d/%m/%Y')
+
+
+def read_csv_rows(stream):
+    """Строки CSV по одной; разделитель (запятая, точка с запятой, табуляция) определяется по заголовку"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    header = text.readline()
+    try:
+        dialect = csv.Sniffer().sniff(header, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    return csv.reader(itertools.chain([header], text), dialect)
 
-    return render_template('dashboard.html', user=user, trips=trips, now=datetime.now(timezone.utc))
 
+def read_xlsx_rows(stream):
+    """Строки первого листа XLSX по одной (openpyxl в режиме только для чтения)"""
+    try:
+        import openpyxl
+    except ImportError:
+        raise ValueError('Для импорта XLSX установите пакет openpyxl')
+    workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+    return workbook.active.iter_rows(values_only=True)
+
+
+def read_import_rows(stream, filename):
+    """Строки файла импорта в зависимости от расширения"""
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if extension == 'csv':
+        return read_csv_rows(stream)
+    if extension == 'xlsx':
+        return read_xlsx_rows(stream)
+    raise ValueError('Поддерживаются файлы CSV и XLSX')
+
+
+def import_header_fields(header):
+    """Поле заявки для каждого столбца заголовка (None - столбец не импортируется)"""
+    names = {}
+    for field, title in TRIP_IMPORT_COLUMNS.items():
+        names[field] = field
+        names[title.lower()] = field
+    fields = [names.get(str(cell or '').strip().rstrip(':').lower()) for cell in header]
+    missing = [TRIP_IMPORT_COLUMNS[field] for field in TRIP_IMPORT_REQUIRED if field not in fields]
+    if missing:
+        raise ValueError(f"В файле нет обязательных столбцов: {', '.join(missing)}")
+    return fields
+
+
+def import_cell_value(field, value):
+    """Значение ячейки: дата или число, подходящие полю, - как есть, остальное - строкой.
+
+    Число в столбце даты или дата в столбце суммы становятся строкой и при проверке
+    дают ошибку строки, а не исключение, прерывающее импорт.
+    """
+    cell_type = TRIP_IMPORT_CELL_TYPES.get(field)
+    if cell_type and isinstance(value, cell_type) and not isinstance(value, bool):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def parse_import_date(value):
+    if isinstance(value, datetime):
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+    for date_format in IMPORT_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError
+
+
+def parse_import_amount(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    return float(value.replace(' ', '').replace('\xa0', '').replace(',', '.'))
+
+
+def load_import_lookups():
+    """Справочники для проверки строк: сотрудники по логину и email, известные подразделения"""
+    employees, departments = {}, set()
+    for row in db.session.execute(db.select(User.id, User.username, User.email, User.manager_id, User.department)):
+        employees[row.username.lower()] = row
+        if row.email:
+            employees.setdefault(row.email.lower(), row)
+        if row.department:
+            departments.add(row.department)
+    return employees, departments
+
+
+def validate_import_row(record, user, employees, departments, now):
+    """Значения для INSERT и список ошибок строки"""
+    errors = []
+    for field in TRIP_IMPORT_REQUIRED:
+        if record.get(field) in (None, ''):
+            errors.append(f"Не заполнено поле «{TRIP_IMPORT_COLUMNS[field]}»")
+    for field, max_length in TRIP_IMPORT_MAX_LENGTHS.items():
+        if len(record.get(field, '')) > max_length:
+            errors.append(f"Поле «{TRIP_IMPORT_COLUMNS[field]}» длиннее {max_length} символов")
+
+    employee = employees.get(record.get('employee', '').lower())
+    if record.get('employee') and employee is None:
+        errors.append(f"Сотрудник «{record['employee']}» не найден")
+    elif employee is not None and user is not None and user.role == 'R' and \
+            employee.id != user.id and employee.manager_id != user.id:
+        errors.append('Можно импортировать заявки только для своих подчиненных')
+
+    dates = {}
+    for field in ('start_date', 'end_date'):
+        if record.get(field):
+            try:
+                dates[field] = parse_import_date(record[field])
+            except ValueError:
+                errors.append(f"Неверная дата в поле «{TRIP_IMPORT_COLUMNS[field]}»: {record[field]}")
+    if len(dates) == 2 and dates['end_date'] < dates['start_date']:
+        errors.append('Дата окончания раньше даты начала')
 
-@app.route('/trips')
-@login_required
-def trips():
-    check_and_redirect_overdue_approvals()
-    
-    user = db.session.get(User, session['user_id'])
-    if not user:
-        flash('Пользователь не найден', 'error')
-        return redirect(url_for('login'))
+    estimated_costs = None
+    if record.get('estimated_costs') not in (None, ''):
+        try:
+            estimated_costs = parse_import_amount(record['estimated_costs'])
+            if estimated_costs < 0:
+                errors.append('Предполагаемые расходы не могут быть отрицательными')
+        except ValueError:
+            errors.append(f"Неверная сумма: {record['estimated_costs']}")
+
+    department = record.get('department') or (employee.department if employee else None)
+    if record.get('department') and record['department'] not in departments:
+        errors.append(f"Неизвестное подразделение «{record['department']}»")
+    if record.get('trip_format') and record['trip_format'] not in TRIP_IMPORT_FORMATS:
+        errors.append(f"Формат проведения должен быть одним из: {', '.join(TRIP_IMPORT_FORMATS)}")
+
+    if errors:
+        return None, errors
+
+    is_activated = record.get('make_active', '').lower() in IMPORT_TRUE_VALUES
+    return {
+        'trip_number': None,
+        'created_date': now,
+        'employee_id': employee.id,
+        'manager_id': employee.manager_id,
+        'department': department,
+        'start_date': dates['start_date'],
+        'end_date': dates['end_date'],
+        'duration': (dates['end_date'] - dates['start_date']).days + 1,
+        'destination': record['destination'],
+        'purpose': record['purpose'],
+        'estimated_costs': estimated_costs,
+        'cost_details_text': record.get('cost_details', ''),
+        'trip_format': record.get('trip_format', ''),
+        'project_number': record.get('project_number', ''),
+        'regularity': record.get('regularity', ''),
+        'receiving_party': record.get('receiving_party', ''),
+        'over_limit': record.get('over_limit', '').lower() in IMPORT_TRUE_VALUES,
+        'status': 'Активированная' if is_activated else 'Планируемая',
+        'is_activated': is_activated,
+        'actual_costs': None,
+        'overrun_approved': False,
+        'booking_overrun_approved': False,
+        'report_overrun_approved': False,
+    }, []
+
+
+def insert_trip_rows(rows, now=None):
+    """Вставляет заявки одним executemany и переносит их в итоги для отчетов.
+
+    Массовый INSERT проходит мимо flush, поэтому вклад активированных заявок в итоги
+    добавляется здесь. Номера выдаются блоком, если в строках их нет.
+    """
+    unnumbered = [row for row in rows if not row.get('trip_number')]
+    if unnumbered:
+        for row, trip_number in zip(unnumbered, allocate_trip_numbers(len(unnumbered), now)):
+            row['trip_number'] = trip_number
+    db.session.execute(db.insert(BusinessTrip), rows)
+
+    deltas = {}
+    for row in rows:
+        add_rollup_delta(deltas, trip_rollup_contribution({field: row.get(field) for field in ROLLUP_TRIP_FIELDS}), 1)
+    apply_rollup_deltas(db.session.connection(), deltas)
+
+
+def import_trips(stream, filename, user=None, dry_run=False):
+    """Проверяет и загружает заявки из CSV/XLSX в текущей транзакции.
+
+    Файл читается построчно, строки проверяются по справочникам, загруженным одним
+    запросом, и вставляются пачками по TRIP_IMPORT_CHUNK_SIZE. После первой ошибки
+    вставка прекращается, но проверка продолжается до конца файла, чтобы сообщить обо
+    всех ошибках; commit выполняет вызывающий код только при отсутствии ошибок.
+    user - кто импортирует (None - без ограничений, для CLI).
+    """
+    now = datetime.now(timezone.utc)
+    employees, departments = load_import_lookups()
+    rows = iter(read_import_rows(stream, filename))
+    fields = import_header_fields(next(rows, None) or [])
+
+    report = {'total': 0, 'imported': 0, 'error_rows': 0, 'errors': [], 'dry_run': dry_run}
+    chunk = []
+    for row_number, row in enumerate(rows, start=2):
+        record = {}
+        for field, value in zip(fields, row):
+            if field is not None and value is not None:
+                record[field] = import_cell_value(field, value)
+        if all(value == '' for value in record.values()):
+            continue
+
+        report['total'] += 1
+        values, errors = validate_import_row(record, user, employees, departments, now)
+        if errors:
+            report['error_rows'] += 1
+            if len(report['errors']) < TRIP_IMPORT_MAX_ERRORS:
+                report['errors'].append({'row': row_number, 'errors': errors})
+            continue
+        if dry_run or report['error_rows']:
+            continue
+
+        chunk.append(values)
+        if len(chunk) >= TRIP_IMPORT_CHUNK_SIZE:
+            insert_trip_rows(chunk, now)
+            report['imported'] += len(chunk)
+            chunk = []
+
+    if chunk and not report['error_rows']:
+        insert_trip_rows(chunk, now)
+        report['imported'] += len(chunk)
+    if report['error_rows']:
+        report['imported'] = 0
+    return report
+
+
+@app.cli.command('import-trips')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dry-run', is_flag=True, help='Только проверить файл, ничего не загружая')
+def import_trips_command(path, dry_run):
+    """Загружает заявки из CSV или XLSX файла"""
+    with open(path, 'rb') as stream:
+        try:
+            report = import_trips(stream, path, dry_run=dry_run)
+        except ValueError as e:
+            db.session.rollback()
+            raise click.ClickException(str(e))
 
-    # Базовый запрос в зависимости от роли
-    if user.role == 'A':  # Администратор
-        base_query = BusinessTrip.query
-    elif user.role == 'B':  # Отдел безопасности
-        base_query = BusinessTrip.query
-    elif user.role == 'BU':  # Бухгалтерия
-        base_query = BusinessTrip.query
-    elif user.role == 'GR':  # Главный руководитель
-        base_query = BusinessTrip.query
-    elif user.role == 'R':  # Руководитель
-        subordinate_ids = [sub.id for sub in user.subordinates]
-        base_query = BusinessTrip.query.filter(
-            (BusinessTrip.employee_id == user.id) |
-            (BusinessTrip.employee_id.in_(subordinate_ids))
+    for row_error in report['errors']:
+        click.echo(f"Строка {row_error['row']}: {'; '.join(row_error['errors'])}")
+    if report['error_rows'] or dry_run:
+        db.session.rollback()
+        click.echo(f"Строк: {report['total']}, с ошибками: {report['error_rows']}. Заявки не загружены.")
+        return
+    db.session.commit()
+    click.echo(f"Загружено заявок: {report['imported']}")
+
+
+# Жадная загрузка связей для списков заявок
+# Связи "один к одному" подгружаются JOIN-ом, коллекции - отдельным запросом IN (...)
+TRIP_JOINED_RELATIONS = ('employee', 'manager_rel')
+TRIP_SELECTIN_RELATIONS = ('documents', 'cost_details')
+
+
+def with_trip_relations(query, *relations):
+    """Добавляет к запросу заявок жадную загрузку указанных связей"""
+    options = []
+    for name in relations:
+        if name in TRIP_JOINED_RELATIONS:
+            options.append(joinedload(getattr(BusinessTrip, name)))
+        elif name in TRIP_SELECTIN_RELATIONS:
+            options.append(selectinload(getattr(BusinessTrip, name)))
+        else:
+            raise ValueError(f"Неизвестная связь заявки: {name}")
+    return query.options(*options)
+
+
+# Подсчет SQL-запросов в рамках HTTP-запроса
+with app.app_context():
+    @event.listens_for(db.engine, 'before_cursor_execute')
+    def count_sql_queries(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            g.sql_query_count = g.get('sql_query_count', 0) + 1
+
+
+@app.after_request
+def check_sql_query_count(response):
+    """В режиме отладки падает, если запрос выполнил слишком много SQL (признак N+1)"""
+    query_count = g.get('sql_query_count', 0)
+    if app.debug and query_count > app.config['SQL_QUERY_LIMIT']:
+        raise AssertionError(
+            f"{request.method} {request.path}: выполнено {query_count} SQL-запросов "
+            f"(лимит {app.config['SQL_QUERY_LIMIT']})"
         )
-    elif user.role == 'S':  # Сотрудник
-        base_query = BusinessTrip.query.filter_by(employee_id=user.id)
-    elif user.role == 'K':  # Отдел кадров
-        base_query = BusinessTrip.query
-    elif user.role == 'TK':  # Travel-координатор
-        base_query = BusinessTrip.query
-    elif user.role == 'Z':  # Отдел закупок
-        base_query = BusinessTrip.query.filter_by(procurement_needed=True)
-    else:
-        base_query = BusinessTrip.query
+    return response
 
-    # Применяем фильтры
-    project_number = request.args.get('project_number')
-    department = request.args.get('department')
-    status = request.args.get('status')
-    date_from = request.args.get('date_from')
-    date_to = request.args.get('date_to')
-    employee_id = request.args.get('employee_id')
+
+# Пагинация списков заявок
+TRIPS_PER_PAGE = 50
+MAX_TRIPS_PER_PAGE = 200
+DASHBOARD_RECENT_TRIPS = 10
+
+
+def get_per_page(default=TRIPS_PER_PAGE):
+    """Размер страницы из параметра per_page с ограничением сверху"""
+    per_page = request.args.get('per_page', default, type=int)
+    return max(1, min(per_page, MAX_TRIPS_PER_PAGE))
+
+
+def encode_trip_cursor(trip):
+    """Курсор на позицию заявки в порядке (created_date, id)"""
+    raw = f"{trip.created_date.isoformat()}|{trip.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_trip_cursor(cursor):
+    """Разбирает курсор, для некорректного значения возвращает None"""
+    try:
+        created, trip_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created), int(trip_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def keyset_page(query, cursor=None, per_page=TRIPS_PER_PAGE):
+    """Страница заявок по курсору, от новых к старым.
+
+    Возвращает (заявки, курсор следующей страницы, есть ли ещё заявки).
+    """
+    query = query.order_by(BusinessTrip.created_date.desc(), BusinessTrip.id.desc())
+    position = decode_trip_cursor(cursor) if cursor else None
+    if position:
+        query = query.filter(db.tuple_(BusinessTrip.created_date, BusinessTrip.id) < position)
+
+    trips = query.limit(per_page + 1).all()
+    has_more = len(trips) > per_page
+    trips = trips[:per_page]
+    next_cursor = encode_trip_cursor(trips[-1]) if has_more else None
+    return trips, next_cursor, has_more
+
+
+def trip_visibility_filter(user):
+    """SQL-условие на заявки, которые видит пользователь с учетом роли.
+
+    Подчиненные руководителя выбираются подзапросом по users.manager_id,
+    поэтому список их id не собирается в Python.
+    """
+    if user.role == 'R':  # Руководитель: свои заявки и заявки подчиненных
+        subordinates = db.select(User.id).where(User.manager_id == user.id)
+        return db.or_(BusinessTrip.employee_id == user.id, BusinessTrip.employee_id.in_(subordinates))
+    if user.role == 'S':  # Сотрудник: только свои заявки
+        return BusinessTrip.employee_id == user.id
+    if user.role == 'Z':  # Отдел закупок: только заявки, где нужна закупка
+        return BusinessTrip.procurement_needed == True
+    # A, B, BU, GR, K, TK видят все заявки
+    return db.true()
+
+
+def visible_trips_query(user):
+    """Базовый запрос заявок, которые видит пользователь"""
+    return BusinessTrip.query.filter(trip_visibility_filter(user))
+
+
+def is_own_or_subordinate_trip(user, trip):
+    """Заявка пользователя или его прямого подчиненного (trip.employee должен быть загружен)"""
+    return trip.employee_id == user.id or (trip.employee is not None and trip.employee.manager_id == user.id)
+
+
+def can_view_trip(user, trip):
+    """Проверка доступа к конкретной заявке по тем же правилам, что и trip_visibility_filter"""
+    if user.role == 'R':
+        return is_own_or_subordinate_trip(user, trip)
+    if user.role == 'S':
+        return trip.employee_id == user.id
+    if user.role == 'Z':
+        return bool(trip.procurement_needed)
+    return True
+
+
+def apply_trip_filters(base_query, args):
+    """Применяет фильтры страницы /trips, возвращает запрос и текущие значения фильтров"""
+    project_number = args.get('project_number')
+    department = args.get('department')
+    status = args.get('status')
+    date_from = args.get('date_from')
+    date_to = args.get('date_to')
+    employee_id = args.get('employee_id')
 
     if project_number:
-        base_query = base_query.filter(BusinessTrip.project_number.contains(project_number))
+        base_query = base_query.filter(text_search_filter(BusinessTrip.project_number, project_number))
     if department:
-        base_query = base_query.filter(BusinessTrip.department.contains(department))
+        base_query = base_query.filter(text_search_filter(BusinessTrip.department, department))
     if status:
         base_query = base_query.filter(BusinessTrip.status == status)
     if date_from:
@@ -381,273 +1465,1388 @@ def trips():
     # Только активированные заявки
     base_query = base_query.filter(BusinessTrip.is_activated == True)
 
-    trips = base_query.order_by(BusinessTrip.created_date.desc()).all()
+    current_filters = {'project_number': project_number, 'department': department,
+                       'status': status, 'date_from': date_from, 'date_to': date_to,
+                       'employee_id': employee_id}
+    return base_query, current_filters
+
+
+def trip_to_dict(trip):
+    """Краткое представление заявки для JSON-списков"""
+    return {
+        'id': trip.id,
+        'trip_number': trip.trip_number,
+        'employee': trip.employee.full_name if trip.employee else None,
+        'department': trip.department,
+        'destination': trip.destination,
+        'start_date': trip.start_date.strftime('%Y-%m-%d') if trip.start_date else None,
+        'end_date': trip.end_date.strftime('%Y-%m-%d') if trip.end_date else None,
+        'status': trip.status,
+        'estimated_costs': trip.estimated_costs,
+        'created_date': trip.created_date.isoformat() if trip.created_date else None
+    }
 
-    # Получаем списки для фильтров
-    departments = db.session.query(BusinessTrip.department).distinct().all()
-    departments = [d[0] for d in departments if d[0]]
-    statuses = db.session.query(BusinessTrip.status).distinct().all()
-    statuses = [s[0] for s in statuses if s[0]]
-    employees = User.query.all() if user.role in ['A', 'B', 'GR'] else []
 
-    return render_template('trips.html', user=user, trips=trips,
-                           departments=departments, statuses=statuses, employees=employees,
-                           current_filters={'project_number': project_number, 'department': department,
-                                            'status': status, 'date_from': date_from, 'date_to': date_to,
-                                            'employee_id': employee_id})
+# Счетчики панели управления: имя счетчика -> условие отбора заявок
+DASHBOARD_COUNTERS = {
+    'planned': lambda: BusinessTrip.status == 'Планируемая',
+    'activated': lambda: BusinessTrip.is_activated == True,
+    'waiting_approval': lambda: BusinessTrip.status == 'Ожидают согласования',
+    'approved': lambda: BusinessTrip.status == 'Согласована',
+    'waiting_overrun': lambda: db.and_(BusinessTrip.over_limit == True, BusinessTrip.overrun_approved == False),
+    'overrun_approved': lambda: BusinessTrip.overrun_approved == True,
+    'waiting_booking': lambda: db.and_(BusinessTrip.is_activated == True, BusinessTrip.booking_completed == False),
+    'booking_completed': lambda: BusinessTrip.booking_completed == True,
+    'waiting_procurement': lambda: db.and_(BusinessTrip.procurement_needed == True,
+                                           BusinessTrip.procurement_done == False),
+    'procurement_done': lambda: BusinessTrip.procurement_done == True,
+    'geo_set': lambda: BusinessTrip.geo_location.isnot(None),
+    'report_prepared': lambda: BusinessTrip.report_prepared == True,
+    'report_reviewed': lambda: BusinessTrip.report_reviewed == True,
+    'closed': lambda: BusinessTrip.trip_closed == True,
+}
+OVERDUE_APPROVAL_DAYS = 2  # Просрочка: запрос на согласование висит 2 и более полных суток
+OVERDUE_APPROVALS_LIMIT = 50
+
+
+def dashboard_stats(base_query):
+    """Все счетчики панели управления одним запросом COUNT(*) FILTER (WHERE ...)"""
+    row = base_query.with_entities(
+        *[func.count(BusinessTrip.id).filter(condition()) for condition in DASHBOARD_COUNTERS.values()]
+    ).order_by(None).one()
+    return dict(zip(DASHBOARD_COUNTERS, row))
+
+
+def utc_naive(value):
+    """Дата в UTC без часового пояса - в таком виде даты хранятся в БД"""
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def overdue_approvals(now, limit=OVERDUE_APPROVALS_LIMIT):
+    """Заявки с просроченным согласованием и число дней просрочки"""
+    now = utc_naive(now)
+    trips = with_trip_relations(BusinessTrip.query, 'employee', 'manager_rel').filter(
+        BusinessTrip.status == 'Ожидают согласования',
+        BusinessTrip.approval_request_date <= now - timedelta(days=OVERDUE_APPROVAL_DAYS)
+    ).order_by(BusinessTrip.approval_request_date).limit(limit).all()
+    return [(trip, (now - utc_naive(trip.approval_request_date)).days) for trip in trips]
 
 
-@app.route('/create_trip', methods=['GET', 'POST'])
-@login_required
-@role_required(['A', 'GR', 'R', 'S'])
-def create_trip():
-    if request.method == 'POST':
-        try:
-            user = db.session.get(User, session['user_id'])
-            if not user:
-                flash('Пользователь не найден', 'error')
-                return redirect(url_for('login'))
+# Кэш счетчиков панели управления
+# Ключ включает номер версии данных: любое изменение заявок или пользователей увеличивает
+# версию, и старые записи просто перестают читаться (и вытесняются по TTL/LRU)
+DASHBOARD_CACHE_VERSION_KEY = 'dashboard:version'
 
-            # Определяем employee_id
-            employee_id = request.form.get('employee_id')
-            if not employee_id:
-                employee_id = session['user_id']
-            else:
-                employee_id = int(employee_id)
 
-            # Проверка прав
-            if user.role == 'R' and employee_id != user.id:
-                subordinate_ids = [sub.id for sub in user.subordinates]
-                if employee_id not in subordinate_ids:
-                    flash('Вы можете создавать заявки только для своих подчиненных', 'error')
-                    return redirect(url_for('create_trip'))
+class LocalCacheBackend:
+    """Кэш в памяти процесса с TTL и вытеснением давно не использованных записей"""
 
-            employee = db.session.get(User, employee_id)
-            if not employee:
-                flash('Сотрудник не найден', 'error')
-                return redirect(url_for('create_trip'))
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.counters = {}
+        self.lock = threading.Lock()
 
-            start_date = datetime.strptime(request.form['start_date'], '%Y-%m-%d')
-            end_date = datetime.strptime(request.form['end_date'], '%Y-%m-%d')
-            duration = (end_date - start_date).days + 1
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
 
-            make_active = request.form.get('make_active') == 'on'
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
 
-            # Определяем статус и активацию
-            initial_status = 'Активированная' if make_active else 'Планируемая'
-            is_activated_value = make_active
+    def get_counter(self, key):
+        with self.lock:
+            return self.counters.get(key, 0)
 
-            trip = BusinessTrip(
-                trip_number=f"BT-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}",
-                employee_id=employee_id,
-                manager_id=employee.manager_id,
-                department=request.form.get('department') or employee.department,
-                start_date=start_date,
-                end_date=end_date,
-                duration=duration,
-                destination=request.form['destination'],
-                purpose=request.form['purpose'],
-                estimated_costs=float(request.form['estimated_costs']),
-                cost_details_text=request.form.get('cost_details', ''),  # Исправлено
-                trip_format=request.form.get('trip_format', ''),
-                project_number=request.form.get('project_number', ''),
-                regularity=request.form.get('regularity', ''),
-                receiving_party=request.form.get('receiving_party', ''),
-                over_limit=request.form.get('over_limit') == 'on',
-                status=initial_status,
-                is_activated=is_activated_value
-            )
-            db.session.add(trip)
-            db.session.commit()
-            flash('Заявка на командировку создана', 'success')
-            return redirect(url_for('trips'))
-        except Exception as e:
-            db.session.rollback()
-            flash(f'Ошибка при создании заявки: {str(e)}', 'error')
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
 
-    user = db.session.get(User, session['user_id'])
-    if not user:
-        flash('Пользователь не найден', 'error')
-        return redirect(url_for('login'))
 
-    managers = User.query.filter(User.role.in_(['R', 'GR'])).all()
-    employees = []
-    if user.role == 'A' or user.role == 'GR':
-        employees = User.query.filter(User.role == 'S').all()
-    elif user.role == 'R':
-        employees = user.subordinates
-    return render_template('create_trip.html', user=user, managers=managers, employees=employees)
+class RedisCacheBackend:
+    """Общий кэш для нескольких процессов приложения.
 
+    Вытеснение по LRU обеспечивает сам Redis (maxmemory-policy allkeys-lru).
+    """
 
-@app.route('/trip/<int:trip_id>')
-@login_required
-def trip_detail(trip_id):
-    check_and_redirect_overdue_approvals()
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
 
-    trip = db.session.get(BusinessTrip, trip_id)
-    if not trip:
-        flash('Заявка не найдена', 'error')
-        return redirect(url_for('dashboard'))
+    def get(self, key):
+        value = self.client.get(key)
+        return json.loads(value) if value is not None else None
 
-    user = db.session.get(User, session['user_id'])
-    if not user:
-        flash('Пользователь не найден', 'error')
-        return redirect(url_for('login'))
+    def set(self, key, value, ttl):
+        self.client.set(key, json.dumps(value), ex=ttl)
 
-    # Проверка прав доступа
-    if user.role == 'S' and trip.employee_id != user.id:
-        flash('Доступ запрещен', 'error')
-        return redirect(url_for('dashboard'))
-    elif user.role == 'R' and trip.employee_id != user.id and trip.employee_id not in [sub.id for sub in user.subordinates]:
-        flash('Доступ запрещен', 'error')
-        return redirect(url_for('dashboard'))
-    elif user.role == 'Z' and not trip.procurement_needed:
-        flash('Доступ запрещен', 'error')
-        return redirect(url_for('dashboard'))
+    def get_counter(self, key):
+        return int(self.client.get(key) or 0)
 
-    return render_template('trip_detail.html', user=user, trip=trip)
+    def incr(self, key):
+        return self.client.incr(key)
 
 
-@app.route('/reports')
-@login_required
-@role_required(['A', 'B', 'BU', 'GR', 'R', 'S', 'TK', 'Z'])
-def reports():
-    user = db.session.get(User, session['user_id'])
-    if not user:
-        flash('Пользователь не найден', 'error')
-        return redirect(url_for('login'))
+def make_cache_backend(url=None):
+    """Выбирает бэкенд кэша по адресу: redis://... - общий кэш, иначе кэш в памяти процесса"""
+    if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisCacheBackend(url)
+    return LocalCacheBackend(app.config['DASHBOARD_CACHE_SIZE'])
 
-    # Базовый запрос - только активированные заявки
-    base_query = BusinessTrip.query.filter(BusinessTrip.is_activated == True)
 
-    # Фильтрация по ролям
-    if user.role == 'R':
-        subordinate_ids = [sub.id for sub in user.subordinates]
-        base_query = base_query.filter(
-            (BusinessTrip.employee_id == user.id) |
-            (BusinessTrip.employee_id.in_(subordinate_ids))
-        )
-    elif user.role == 'S':
-        base_query = base_query.filter_by(employee_id=user.id)
-    elif user.role == 'Z':
-        base_query = base_query.filter_by(procurement_needed=True)
+dashboard_cache = make_cache_backend(app.config['DASHBOARD_CACHE_URL'])
 
-    # Применяем фильтры
-    project_number = request.args.get('project_number')
-    purpose = request.args.get('purpose')
-    status_cancel = request.args.get('status_cancel') == 'true'
-    status_not_approved = request.args.get('status_not_approved') == 'true'
-    status_closed = request.args.get('status_closed') == 'true'
-    sort_by = request.args.get('sort_by', 'costs')  # costs, overrun
-    
 
-    if project_number:
-        base_query = base_query.filter(BusinessTrip.project_number.contains(project_number))
-    if purpose:
-        base_query = base_query.filter(BusinessTrip.purpose.contains(purpose))
-    if status_cancel:
-        base_query = base_query.filter(BusinessTrip.status == 'Отменена')
-    if status_not_approved:
-        base_query = base_query.filter(BusinessTrip.status == 'Не согласована')
-    if status_closed:
-        base_query = base_query.filter(BusinessTrip.trip_closed == True)
+def dashboard_cache_key(user, version):
+    """Ключ кэша: роль и область видимости (пользователь для ролей, видящих только свои заявки)"""
+    scope = user.id if user.role in ('S', 'R') else 'all'
+    return f'dashboard:stats:{version}:{user.role}:{scope}'
 
-    # Сортировка
-    if sort_by == 'costs':
-        trips = base_query.order_by(BusinessTrip.estimated_costs.desc()).all()
-    elif sort_by == 'overrun':
-        trips = base_query.all()
-        trips.sort(key=lambda t: (t.actual_costs or t.estimated_costs or 0) - (t.estimated_costs or 0), reverse=True)
-    else:
-        trips = base_query.order_by(BusinessTrip.created_date.desc()).all()
-
-    # Статистика для графиков
-    total_trips = len(trips)
-    total_costs = sum(t.estimated_costs or 0 for t in trips)
-    total_actual_costs = sum(t.actual_costs or 0 for t in trips if t.actual_costs)
-    overrun_trips = [t for t in trips if t.over_limit]
-    overrun_amount = sum((t.actual_costs or t.estimated_costs or 0) - (t.estimated_costs or 0)
-                         for t in overrun_trips if
-                         (t.actual_costs or t.estimated_costs or 0) > (t.estimated_costs or 0))
-
-    # Данные для графиков
-    status_counts = defaultdict(int)
-    monthly_costs = defaultdict(float)
-    monthly_actual = defaultdict(float)
-    department_costs = defaultdict(float)
-    total_trips_with_overrun = 0
-    total_trips_without_overrun = 0
-
-    for trip in trips:
-        status_counts[trip.status] += 1
-        if trip.overrun_approved or trip.booking_overrun_approved or trip.report_overrun_approved:
-            total_trips_with_overrun += 1
-        else:
-            total_trips_without_overrun += 1
-        
-        if trip.start_date:
-            month_key = trip.start_date.strftime('%Y-%m')
-            monthly_costs[month_key] += trip.estimated_costs or 0
-            monthly_actual[month_key] += trip.actual_costs or 0
-        if trip.department:
-            department_costs[trip.department] += trip.estimated_costs or 0
-    
-    status_overrun_counts = {
-        'Согласованный перерасход': total_trips_with_overrun,
-        'Без согласованного перерасхода': total_trips_without_overrun
-    }
 
-    return render_template('reports.html', user=user, trips=trips,
-                           total_trips=total_trips, total_costs=total_costs,
-                           total_actual_costs=total_actual_costs, overrun_trips=len(overrun_trips),
-                           overrun_amount=overrun_amount,
-                           status_counts=dict(status_counts),
-                           status_overrun_counts=dict(status_overrun_counts),
-                           monthly_costs=dict(monthly_costs),
-                           monthly_actual=dict(monthly_actual),
-                           department_costs=dict(department_costs),
-                           current_filters={'project_number': project_number, 'purpose': purpose,
-                                            'status_cancel': status_cancel, 'status_not_approved': status_not_approved,
-                                            'status_closed': status_closed, 'sort_by': sort_by})
+def cached_dashboard_stats(user):
+    """Счетчики панели управления из кэша; при промахе - один запрос к БД"""
+    try:
+        key = dashboard_cache_key(user, dashboard_cache.get_counter(DASHBOARD_CACHE_VERSION_KEY))
+        stats = dashboard_cache.get(key)
+        if stats is not None:
+            return stats
+    except Exception as e:
+        print(f"Ошибка чтения кэша панели управления: {e}")
+        return dashboard_stats(visible_trips_query(user))
 
+    stats = dashboard_stats(visible_trips_query(user))
+    try:
+        dashboard_cache.set(key, stats, app.config['DASHBOARD_CACHE_TTL'])
+    except Exception as e:
+        print(f"Ошибка записи кэша панели управления: {e}")
+    return stats
 
-@app.route('/planning')
+
+def invalidate_dashboard_cache():
+    try:
+        dashboard_cache.incr(DASHBOARD_CACHE_VERSION_KEY)
+    except Exception as e:
+        print(f"Ошибка сброса кэша панели управления: {e}")
+
+
+# Сброс кэша привязан к сессии, а не к отдельным маршрутам: так его не забудет ни один
+# изменяющий endpoint. Версия увеличивается только после успешного commit.
+@event.listens_for(Session, 'after_flush')
+def mark_dashboard_cache_dirty(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, (BusinessTrip, User)):
+            session.info['dashboard_cache_dirty'] = True
+            return
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def mark_dashboard_cache_dirty_bulk(orm_execute_state):
+    """Массовые INSERT/UPDATE/DELETE (импорт, эскалация) проходят мимо flush"""
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is None or mapper.class_ in (BusinessTrip, User):
+            orm_execute_state.session.info['dashboard_cache_dirty'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_dashboard_cache_on_commit(session):
+    if session.info.pop('dashboard_cache_dirty', False):
+        invalidate_dashboard_cache()
+
+
+@event.listens_for(Session, 'after_rollback')
+def reset_dashboard_cache_dirty(session):
+    session.info.pop('dashboard_cache_dirty', None)
+
+
+# Агрегаты для страницы отчетов
+def trip_spent_expr():
+    """Фактические расходы, а при их отсутствии - предполагаемые"""
+    return func.coalesce(func.nullif(BusinessTrip.actual_costs, 0), BusinessTrip.estimated_costs, 0)
+
+
+def trip_overrun_expr():
+    """Перерасход заявки: потраченное минус предполагаемые расходы"""
+    return trip_spent_expr() - func.coalesce(BusinessTrip.estimated_costs, 0)
+
+
+def month_key_expr(column):
+    """Месяц даты в виде 'YYYY-MM' на стороне БД"""
+    if db.engine.dialect.name == 'postgresql':
+        return func.to_char(func.date_trunc('month', column), 'YYYY-MM')
+    return func.strftime('%Y-%m', column)
+
+
+def apply_report_filters(base_query, args):
+    """Применяет фильтры страницы /reports, возвращает запрос и текущие значения фильтров"""
+    project_number = args.get('project_number')
+    purpose = args.get('purpose')
+    status_cancel = args.get('status_cancel') == 'true'
+    status_not_approved = args.get('status_not_approved') == 'true'
+    status_closed = args.get('status_closed') == 'true'
+    sort_by = args.get('sort_by', 'costs')  # costs, overrun, date
+
+    if project_number:
+        base_query = base_query.filter(text_search_filter(BusinessTrip.project_number, project_number))
+    if purpose:
+        base_query = base_query.filter(text_search_filter(BusinessTrip.purpose, purpose))
+    if status_cancel:
+        base_query = base_query.filter(BusinessTrip.status == 'Отменена')
+    if status_not_approved:
+        base_query = base_query.filter(BusinessTrip.status == 'Не согласована')
+    if status_closed:
+        base_query = base_query.filter(BusinessTrip.trip_closed == True)
+
+    current_filters = {'project_number': project_number, 'purpose': purpose,
+                       'status_cancel': status_cancel, 'status_not_approved': status_not_approved,
+                       'status_closed': status_closed, 'sort_by': sort_by}
+    return base_query, current_filters
+
+
+def report_order_by(sort_by):
+    """Сортировка заявок страницы /reports"""
+    if sort_by == 'costs':
+        return BusinessTrip.estimated_costs.desc(), BusinessTrip.id
+    if sort_by == 'overrun':
+        return trip_overrun_expr().desc(), BusinessTrip.id
+    return BusinessTrip.created_date.desc(), BusinessTrip.id.desc()
+
+
+def report_filter_params(current_filters):
+    """Фильтры отчетов в виде параметров URL для ссылок пагинации"""
+    return {key: ('true' if value is True else value)
+            for key, value in current_filters.items() if value not in (None, '', False)}
+
+
+def report_aggregates(base_query):
+    """Итоги, распределение по статусам, месяцам и подразделениям одним набором GROUP BY"""
+    spent = trip_spent_expr()
+    estimated = func.coalesce(BusinessTrip.estimated_costs, 0)
+    overrun = trip_overrun_expr()
+    any_overrun_approved = db.or_(BusinessTrip.overrun_approved == True,
+                                  BusinessTrip.booking_overrun_approved == True,
+                                  BusinessTrip.report_overrun_approved == True)
+
+    totals = base_query.with_entities(
+        func.count(BusinessTrip.id),
+        func.sum(estimated),
+        func.sum(func.coalesce(BusinessTrip.actual_costs, 0)),
+        func.sum(db.case((BusinessTrip.over_limit == True, 1), else_=0)),
+        func.sum(db.case((db.and_(BusinessTrip.over_limit == True, spent > estimated), overrun), else_=0)),
+        func.sum(db.case((any_overrun_approved, 1), else_=0))
+    ).order_by(None).one()
+    total_trips, total_costs, total_actual_costs, overrun_trips, overrun_amount, with_overrun = totals
+
+    status_counts = dict(base_query.with_entities(
+        BusinessTrip.status, func.count(BusinessTrip.id)
+    ).group_by(BusinessTrip.status).order_by(None).all())
+
+    month_key = month_key_expr(BusinessTrip.start_date)
+    monthly_rows = base_query.with_entities(
+        month_key, func.sum(estimated), func.sum(func.coalesce(BusinessTrip.actual_costs, 0))
+    ).filter(BusinessTrip.start_date.isnot(None)).group_by(month_key).order_by(month_key).all()
+
+    department_costs = dict(base_query.with_entities(
+        BusinessTrip.department, func.sum(estimated)
+    ).filter(BusinessTrip.department.isnot(None), BusinessTrip.department != '').group_by(
+        BusinessTrip.department).order_by(BusinessTrip.department).all())
+
+    return {
+        'total_trips': total_trips,
+        'total_costs': total_costs or 0,
+        'total_actual_costs': total_actual_costs or 0,
+        'overrun_trips': overrun_trips or 0,
+        'overrun_amount': overrun_amount or 0,
+        'status_counts': status_counts,
+        'status_overrun_counts': {
+            'Согласованный перерасход': with_overrun or 0,
+            'Без согласованного перерасхода': total_trips - (with_overrun or 0)
+        },
+        'monthly_costs': {month: costs or 0 for month, costs, _ in monthly_rows},
+        'monthly_actual': {month: actual or 0 for month, _, actual in monthly_rows},
+        'department_costs': department_costs
+    }
+
+
+# Инкрементальное обновление итогов для отчетов
+ROLLUP_KEY_COLUMNS = ('month', 'department', 'status', 'project_number')
+ROLLUP_MEASURE_COLUMNS = ('trip_count', 'estimated_costs', 'actual_costs',
+                          'overrun_trips', 'overrun_amount', 'overrun_approved_trips')
+ROLLUP_TRIP_FIELDS = ('is_activated', 'start_date', 'department', 'status', 'project_number',
+                      'estimated_costs', 'actual_costs', 'over_limit', 'overrun_approved',
+                      'booking_overrun_approved', 'report_overrun_approved')
+
+
+def _load_old_value(target, value, oldvalue, initiator):
+    pass
+
+
+# Старое значение полей нужно для вычитания вклада заявки, поэтому загружаем его даже для
+# "протухших" после commit атрибутов
+for _field in ROLLUP_TRIP_FIELDS:
+    event.listen(getattr(BusinessTrip, _field), 'set', _load_old_value, active_history=True)
+
+
+def trip_rollup_contribution(values):
+    """Ключ и вклад заявки в итоги; None, если заявка в отчеты не попадает"""
+    if not values['is_activated']:
+        return None
+    start_date = values['start_date']
+    key = (start_date.strftime('%Y-%m') if start_date else '', values['department'] or '',
+           values['status'] or '', values['project_number'] or '')
+
+    estimated = values['estimated_costs'] or 0
+    spent = values['actual_costs'] or values['estimated_costs'] or 0
+    over_limit = bool(values['over_limit'])
+    overrun_approved = (values['overrun_approved'] or values['booking_overrun_approved'] or
+                        values['report_overrun_approved'])
+    return key, {
+        'trip_count': 1,
+        'estimated_costs': estimated,
+        'actual_costs': values['actual_costs'] or 0,
+        'overrun_trips': 1 if over_limit else 0,
+        'overrun_amount': spent - estimated if over_limit and spent > estimated else 0,
+        'overrun_approved_trips': 1 if overrun_approved else 0
+    }
+
+
+def add_rollup_delta(deltas, contribution, sign):
+    if contribution is None:
+        return
+    key, measures = contribution
+    bucket = deltas.setdefault(key, dict.fromkeys(ROLLUP_MEASURE_COLUMNS, 0))
+    for column, value in measures.items():
+        bucket[column] += sign * value
+
+
+def apply_rollup_deltas(connection, deltas):
+    """Прибавляет изменения к строкам итогов одним UPSERT и убирает опустевшие строки"""
+    deltas = {key: bucket for key, bucket in deltas.items() if any(bucket.values())}
+    if not deltas:
+        return
+    table = TripReportRollup.__table__
+    rows = [dict(zip(ROLLUP_KEY_COLUMNS, key), **bucket) for key, bucket in deltas.items()]
+
+    dialect = connection.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        stmt = insert(table).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(ROLLUP_KEY_COLUMNS),
+            set_={column: table.c[column] + stmt.excluded[column] for column in ROLLUP_MEASURE_COLUMNS}
+        )
+        connection.execute(stmt)
+    else:
+        for row in rows:
+            key_filter = db.and_(*(table.c[column] == row[column] for column in ROLLUP_KEY_COLUMNS))
+            updated = connection.execute(table.update().where(key_filter).values(
+                {column: table.c[column] + row[column] for column in ROLLUP_MEASURE_COLUMNS})).rowcount
+            if not updated:
+                connection.execute(table.insert().values(row))
+
+    connection.execute(table.delete().where(table.c.trip_count <= 0))
+
+
+@event.listens_for(Session, 'after_flush')
+def update_report_rollup(session, flush_context):
+    """Переносит изменения заявок из текущего flush в итоги для отчетов"""
+    deltas = {}
+    for obj in session.new:
+        if isinstance(obj, BusinessTrip):
+            add_rollup_delta(deltas, trip_rollup_contribution(
+                {field: getattr(obj, field) for field in ROLLUP_TRIP_FIELDS}), 1)
+
+    for obj in session.dirty:
+        if not isinstance(obj, BusinessTrip):
+            continue
+        state = inspect(obj)
+        old_values, new_values, changed = {}, {}, False
+        for field in ROLLUP_TRIP_FIELDS:
+            history = state.attrs[field].history
+            new_values[field] = getattr(obj, field)
+            if history.has_changes():
+                changed = True
+                old_values[field] = history.deleted[0] if history.deleted else None
+            else:
+                old_values[field] = new_values[field]
+        if changed:
+            add_rollup_delta(deltas, trip_rollup_contribution(old_values), -1)
+            add_rollup_delta(deltas, trip_rollup_contribution(new_values), 1)
+
+    for obj in session.deleted:
+        if isinstance(obj, BusinessTrip):
+            state = inspect(obj)
+            add_rollup_delta(deltas, trip_rollup_contribution(
+                {field: state.dict.get(field) for field in ROLLUP_TRIP_FIELDS}), -1)
+
+    apply_rollup_deltas(session.connection(), deltas)
+
+
+def rebuild_report_rollup():
+    """Пересчитывает итоги для отчетов по всем заявкам заново"""
+    month_key = func.coalesce(month_key_expr(BusinessTrip.start_date), '')
+    department = func.coalesce(BusinessTrip.department, '')
+    status = func.coalesce(BusinessTrip.status, '')
+    project_number = func.coalesce(BusinessTrip.project_number, '')
+    estimated = func.coalesce(BusinessTrip.estimated_costs, 0)
+    spent = trip_spent_expr()
+    any_overrun_approved = db.or_(BusinessTrip.overrun_approved == True,
+                                  BusinessTrip.booking_overrun_approved == True,
+                                  BusinessTrip.report_overrun_approved == True)
+
+    rollup_select = db.select(
+        month_key, department, status, project_number,
+        func.count(BusinessTrip.id),
+        func.sum(estimated),
+        func.sum(func.coalesce(BusinessTrip.actual_costs, 0)),
+        func.sum(db.case((BusinessTrip.over_limit == True, 1), else_=0)),
+        func.sum(db.case((db.and_(BusinessTrip.over_limit == True, spent > estimated),
+                          trip_overrun_expr()), else_=0)),
+        func.sum(db.case((any_overrun_approved, 1), else_=0))
+    ).where(BusinessTrip.is_activated == True).group_by(month_key, department, status, project_number)
+
+    table = TripReportRollup.__table__
+    db.session.execute(table.delete())
+    db.session.execute(table.insert().from_select(
+        list(ROLLUP_KEY_COLUMNS + ROLLUP_MEASURE_COLUMNS), rollup_select))
+    db.session.commit()
+    return TripReportRollup.query.count()
+
+
+@app.cli.command('rebuild-report-rollup')
+def rebuild_report_rollup_command():
+    """Пересчитывает таблицу итогов для отчетов с нуля"""
+    click.echo(f"Строк итогов: {rebuild_report_rollup()}")
+
+
+def can_use_report_rollup(user, current_filters):
+    """Итоги подходят, если роль видит все заявки и фильтры выражаются через ключ итогов"""
+    return (user.role not in ('R', 'S', 'Z') and not current_filters['purpose']
+            and not current_filters['status_closed'])
+
+
+def rollup_aggregates(current_filters):
+    """Те же показатели, что и report_aggregates, но по таблице итогов"""
+    query = TripReportRollup.query
+    if current_filters['project_number']:
+        query = query.filter(text_search_filter(TripReportRollup.project_number, current_filters['project_number']))
+    if current_filters['status_cancel']:
+        query = query.filter(TripReportRollup.status == 'Отменена')
+    if current_filters['status_not_approved']:
+        query = query.filter(TripReportRollup.status == 'Не согласована')
+
+    total_trips, total_costs, total_actual_costs, overrun_trips, overrun_amount, with_overrun = query.with_entities(
+        *(func.sum(getattr(TripReportRollup, column)) for column in ROLLUP_MEASURE_COLUMNS)
+    ).one()
+    total_trips = total_trips or 0
+
+    status_counts = dict(query.with_entities(
+        TripReportRollup.status, func.sum(TripReportRollup.trip_count)
+    ).filter(TripReportRollup.status != '').group_by(TripReportRollup.status).all())
+
+    monthly_rows = query.with_entities(
+        TripReportRollup.month, func.sum(TripReportRollup.estimated_costs), func.sum(TripReportRollup.actual_costs)
+    ).filter(TripReportRollup.month != '').group_by(TripReportRollup.month).order_by(TripReportRollup.month).all()
+
+    department_costs = dict(query.with_entities(
+        TripReportRollup.department, func.sum(TripReportRollup.estimated_costs)
+    ).filter(TripReportRollup.department != '').group_by(
+        TripReportRollup.department).order_by(TripReportRollup.department).all())
+
+    return {
+        'total_trips': total_trips,
+        'total_costs': total_costs or 0,
+        'total_actual_costs': total_actual_costs or 0,
+        'overrun_trips': overrun_trips or 0,
+        'overrun_amount': overrun_amount or 0,
+        'status_counts': status_counts,
+        'status_overrun_counts': {
+            'Согласованный перерасход': with_overrun or 0,
+            'Без согласованного перерасхода': total_trips - (with_overrun or 0)
+        },
+        'monthly_costs': {month: costs for month, costs, _ in monthly_rows},
+        'monthly_actual': {month: actual for month, _, actual in monthly_rows},
+        'department_costs': department_costs
+    }
+
+
+# Конечный автомат заявки: статусы, флаги и допустимые переходы между ними
+# Переход выполняется условным UPDATE ... WHERE status = :expected (и текущими значениями
+# изменяемых полей), поэтому одновременные клики не перетирают друг друга без блокировок строк
+TRIP_STATUSES = ('Планируемая', 'Активированная', 'Ожидают согласования', 'Согласована',
+                 'Не согласована', 'Отменена', 'Закрыта')
+TRIP_FINAL_STATUSES = ('Отменена', 'Закрыта')
+TRIP_STATE_FIELDS = ('status', 'is_activated', 'booking_completed', 'report_prepared', 'report_reviewed',
+                     'trip_closed', 'overrun_approved', 'booking_overrun_approved', 'report_overrun_approved',
+                     'procurement_needed', 'procurement_done')
+BOOKING_REQUIRED_FIELDS = ('transport_type', 'departure_city', 'arrival_city')
+
+
+def booking_guard(row, values):
+    missing_fields = [field for field in BOOKING_REQUIRED_FIELDS if not row[field]]
+    if missing_fields:
+        return 'Заполните обязательные поля бронирования: ' + ', '.join(missing_fields)
+
+
+def report_prepared_guard(row, values):
+    if not values['report_prepared']:
+        return None
+    if not row['actual_costs']:
+        return 'Заполните таблицу фактических расходов'
+    if not row['has_documents']:
+        return 'Необходимо прикрепить хотя бы один документ'
+
+
+def report_reviewed_guard(row, values):
+    if not values['report_reviewed']:
+        return None
+    if not row['geo_location']:
+        return 'Не установлена геолокация сотрудником'
+    if not row['has_documents']:
+        return 'Нет прикрепленных документов для проверки'
+    if not row['report_prepared']:
+        return 'Отчет должен быть подготовлен сотрудником'
+
+
+def trip_closed_guard(row, values):
+    if values['trip_closed'] and not row['report_reviewed']:
+        return 'Отчет должен быть проверен руководителем'
+
+
+# Переходы статуса: from - допустимые исходные статусы, to - новый статус.
+# Переходы флагов: flag - изменяемый флаг, value - его новое значение по параметрам.
+# roles - кому переход доступен; owner - доступен ли сотруднику для своей заявки;
+# owner_roles - если задано, owner действует только для этих ролей;
+# values - дополнительные поля; guard - проверка заявки перед переходом;
+# batch - показывать ли переход в пакетных действиях на /trips и /dashboard
+TRIP_TRANSITIONS = {
+    'activate': {
+        'label': 'Активировать', 'roles': ['A', 'GR', 'R'], 'owner': True, 'batch': True,
+        'from': ('Планируемая',), 'to': 'Активированная',
+        'values': lambda params, now: {'is_activated': True}},
+    'deactivate': {
+        'label': 'Отменить активацию', 'roles': ['A', 'GR', 'R'], 'owner': True, 'batch': True,
+        'from': ('Активированная', 'Ожидают согласования', 'Согласована', 'Не согласована'), 'to': 'Планируемая',
+        'values': lambda params, now: {'is_activated': False}},
+    'send_for_approval': {
+        'label': 'Отправить на согласование', 'roles': ['A', 'GR', 'R'], 'owner': True, 'batch': True,
+        'from': ('Активированная', 'Не согласована'), 'to': 'Ожидают согласования',
+        'values': lambda params, now: {'is_activated': True, 'approval_request_date': now}},
+    'approve': {
+        'label': 'Согласовать', 'roles': ['R', 'GR'], 'owner': False, 'batch': True,
+        'from': ('Ожидают согласования',), 'to': 'Согласована'},
+    'reject': {
+        'label': 'Не согласовать', 'roles': ['R', 'GR'], 'owner': False, 'batch': True,
+        'from': ('Ожидают согласования',), 'to': 'Не согласована',
+        'values': lambda params, now: {'cancellation_reason': params.get('reason', '')}},
+    'cancel': {
+        'label': 'Отменить', 'roles': ['A', 'GR', 'R'], 'owner': True, 'batch': True,
+        'from': tuple(status for status in TRIP_STATUSES if status not in TRIP_FINAL_STATUSES), 'to': 'Отменена',
+        'values': lambda params, now: {'cancellation_reason': params.get('reason', '')}},
+    'approve_overrun': {
+        'label': 'Согласовать перерасход', 'roles': ['R', 'GR'], 'owner': False, 'batch': True,
+        'flag': 'overrun_approved', 'value': lambda params: True},
+    'approve_booking_overrun': {
+        'label': 'Согласовать перерасход бронирования', 'roles': ['A', 'TK'], 'owner': False, 'batch': True,
+        'flag': 'booking_overrun_approved', 'value': lambda params: True},
+    'approve_report_overrun': {
+        'label': 'Согласовать перерасход по отчету', 'roles': ['R', 'GR'], 'owner': False, 'batch': True,
+        'flag': 'report_overrun_approved', 'value': lambda params: True},
+    'procurement': {
+        'label': 'Нужна закупка', 'roles': ['A', 'Z'], 'owner': False, 'batch': True,
+        'flag': 'procurement_needed', 'value': lambda params: bool(params.get('needed', False))},
+    'procurement_done': {
+        'label': 'Закупка выполнена', 'roles': ['A', 'Z'], 'owner': False,
+        'flag': 'procurement_done', 'value': lambda params: bool(params.get('done', False))},
+    'complete_booking': {
+        'label': 'Бронирование выполнено', 'roles': ['A', 'TK'], 'owner': True, 'owner_roles': ['S'],
+        'flag': 'booking_completed', 'value': lambda params: True,
+        'values': lambda params, now: {'booking_completed_date': now},
+        'guard': booking_guard, 'already': 'Бронирование уже отмечено как выполненное'},
+    'report_prepared': {
+        'label': 'Отчет подготовлен', 'roles': [], 'owner': True,
+        'flag': 'report_prepared', 'value': lambda params: bool(params.get('prepared', False)),
+        'guard': report_prepared_guard, 'forbidden': 'Только сотрудник может отметить отчет как подготовленный'},
+    'report_reviewed': {
+        'label': 'Отчет проверен', 'roles': ['R', 'GR'], 'owner': False,
+        'flag': 'report_reviewed', 'value': lambda params: bool(params.get('reviewed', False)),
+        'guard': report_reviewed_guard},
+    'trip_closed': {
+        'label': 'Командировка закрыта', 'roles': ['A', 'BU'], 'owner': False,
+        'flag': 'trip_closed', 'value': lambda params: bool(params.get('closed', False)),
+        'guard': trip_closed_guard},
+}
+# Переход статуса по целевому статусу (для /api/update_trip_status)
+TRIP_TRANSITION_BY_STATUS = {transition['to']: name for name, transition in TRIP_TRANSITIONS.items()
+                             if 'to' in transition}
+MAX_BATCH_ITEMS = 200
+
+
+def batch_actions_for(user):
+    """Переходы, которые пользователь может выполнять пакетно: [(имя, название)]"""
+    return [(name, transition['label']) for name, transition in TRIP_TRANSITIONS.items()
+            if transition.get('batch') and (user.role in transition['roles'] or
+                                            transition['owner'] and user.role == 'S')]
+
+
+def is_transition_owner(user, transition, row):
+    """Переход доступен пользователю как сотруднику заявки"""
+    return (transition['owner'] and row['employee_id'] == user.id and
+            ('owner_roles' not in transition or user.role in transition['owner_roles']))
+
+
+def transition_values(transition, params, now):
+    """Все поля, которые записывает переход"""
+    values = transition['values'](params, now) if 'values' in transition else {}
+    if 'to' in transition:
+        values['status'] = transition['to']
+    else:
+        values[transition['flag']] = transition['value'](params)
+    return values
+
+
+def check_transition(user, transition, row, values):
+    """Ошибка, если переход недоступен пользователю или заявке в ее текущем состоянии"""
+    # Руководитель работает только со своими заявками и заявками подчиненных (как в trip_visibility_filter)
+    if user.role == 'R' and user.id not in (row['employee_id'], row['employee_manager_id']):
+        return 'Заявка не найдена'
+    if user.role not in transition['roles'] and not is_transition_owner(user, transition, row):
+        return transition.get('forbidden', 'Недостаточно прав')
+    if 'from' in transition and row['status'] not in transition['from']:
+        return f"Действие «{transition['label']}» недоступно для заявки в статусе «{row['status']}»"
+    if 'flag' in transition and row[transition['flag']] == values[transition['flag']] and 'already' in transition:
+        return transition['already']
+    if 'guard' in transition:
+        return transition['guard'](row, values)
+    return None
+
+
+def load_trip_rows(trip_ids):
+    """Текущие значения заявок для проверки переходов, итогов отчетов и событий - одним запросом"""
+    fields = (set(ROLLUP_TRIP_FIELDS) | set(TRIP_EVENT_FIELDS) | set(TRIP_STATE_FIELDS) |
+              set(BOOKING_REQUIRED_FIELDS) | {'id', 'employee_id', 'version_id'})
+    has_documents = db.exists().where(Document.trip_id == BusinessTrip.id).label('has_documents')
+    query = db.select(*(getattr(BusinessTrip, field) for field in sorted(fields)), has_documents,
+                      User.manager_id.label('employee_manager_id')).outerjoin(
+        User, User.id == BusinessTrip.employee_id).where(BusinessTrip.id.in_(trip_ids))
+    return {row['id']: dict(row) for row in db.session.execute(query).mappings()}
+
+
+def apply_trip_update(trip_rows, values, expected):
+    """UPDATE набора заявок при условии, что поля состояния не изменились с момента чтения.
+
+    expected - прочитанные значения полей состояния, которые меняет переход.
+    Массовый UPDATE проходит мимо flush, поэтому итоги отчетов, события заявок и версия строки
+    обновляются здесь: прежнее состояние - это возвращенная строка с прежними значениями
+    изменяемых полей. Возвращает {id: новая версия} обновленных заявок.
+    """
+    returning_fields = sorted(set(ROLLUP_TRIP_FIELDS) | set(TRIP_EVENT_FIELDS) | {'id', 'version_id'})
+    updated = db.session.execute(
+        db.update(BusinessTrip)
+        .where(BusinessTrip.id.in_(list(trip_rows)),
+               *(getattr(BusinessTrip, field).is_not_distinct_from(value) for field, value in expected.items()))
+        .values(version_id=BusinessTrip.version_id + 1, **values)
+        .returning(*(getattr(BusinessTrip, field) for field in returning_fields)),
+        execution_options={'synchronize_session': False}
+    ).mappings().all()
+
+    deltas, payloads = {}, []
+    for new_row in updated:
+        old_row = dict(new_row, **expected)
+        add_rollup_delta(deltas, trip_rollup_contribution({field: old_row[field] for field in ROLLUP_TRIP_FIELDS}), -1)
+        add_rollup_delta(deltas, trip_rollup_contribution({field: new_row[field] for field in ROLLUP_TRIP_FIELDS}), 1)
+        changes = {field: event_value(new_row[field]) for field in TRIP_EVENT_FIELDS
+                   if field in values and new_row[field] != old_row[field]}
+        if changes:
+            snapshot = trip_rows[new_row['id']]
+            payloads.append({'type': 'trip_updated', 'trip_id': new_row['id'], 'data': changes,
+                             'employee_id': snapshot['employee_id'],
+                             'employee_manager_id': snapshot['employee_manager_id'],
+                             'procurement_needed': bool(new_row['procurement_needed'])})
+
+    apply_rollup_deltas(db.session.connection(), deltas)
+    if payloads:
+        event_broker.stage(db.session, payloads)
+    return {row['id']: row['version_id'] for row in updated}
+
+
+def run_trip_transitions(user, items, now):
+    """Выполняет переходы [{trip_id, action, params, version}] в текущей транзакции.
+
+    Права и состояние всех заявок проверяются по одному запросу, одинаковые переходы
+    из одинакового состояния выполняются одним UPDATE. Если указана version, переход
+    выполняется только для этой версии заявки. Возвращает результат по каждому
+    элементу в порядке запроса; commit выполняет вызывающий код.
+    """
+    trip_ids = {item.get('trip_id') for item in items if isinstance(item.get('trip_id'), int)}
+    trip_rows = load_trip_rows(trip_ids) if trip_ids else {}
+
+    results, groups, seen = [], {}, set()
+    for item in items:
+        trip_id, name = item.get('trip_id'), item.get('action')
+        result = {'trip_id': trip_id, 'action': name, 'success': False}
+        results.append(result)
+
+        transition = TRIP_TRANSITIONS.get(name)
+        if transition is None:
+            result['error'] = 'Неизвестное действие'
+            continue
+        if trip_id not in trip_rows:
+            result['error'] = 'Заявка не найдена'
+            continue
+        if trip_id in seen:
+            result['error'] = 'Заявка указана в пакете несколько раз'
+            continue
+        seen.add(trip_id)
+
+        row = trip_rows[trip_id]
+        version = item.get('version')
+        if version is not None and version != row['version_id']:
+            result['error'] = TRIP_CONFLICT_ERROR
+            result['conflict'] = True
+            continue
+
+        params = item.get('params') or {}
+        if not isinstance(params, dict):
+            result['error'] = 'Неверные параметры действия'
+            continue
+        values = transition_values(transition, params, now)
+        error = check_transition(user, transition, row, values)
+        if error:
+            result['error'] = error
+            continue
+
+        expected = {field: row[field] for field in values if field in TRIP_STATE_FIELDS}
+        if version is not None:
+            expected['version_id'] = version
+        group_key = (name, json.dumps(values, sort_keys=True, default=str), json.dumps(expected, sort_keys=True))
+        group = groups.setdefault(group_key, (values, expected, {}, []))
+        group[2][trip_id] = row
+        group[3].append(result)
+
+    for values, expected, rows, group_results in groups.values():
+        updated = apply_trip_update(rows, values, expected)
+        for result in group_results:
+            if result['trip_id'] in updated:
+                result['success'] = True
+                result['version'] = updated[result['trip_id']]
+            else:
+                result['error'] = TRIP_CONFLICT_ERROR
+                result['conflict'] = True
+    return results
+
+
+def run_trip_transition(user, trip_id, name, params=None, version=None):
+    """Переход одной заявки; возвращает результат из run_trip_transitions"""
+    return run_trip_transitions(user, [{'trip_id': trip_id, 'action': name, 'params': params or {},
+                                        'version': version}], datetime.now(timezone.utc))[0]
+
+
+def trip_transition_response(user, trip_id, name, params=None, extra=None):
+    """JSON-ответ endpoint-а, выполняющего один переход заявки (с учетом If-Match)"""
+    try:
+        result = run_trip_transition(user, trip_id, name, params, if_match_version('trip', trip_id))
+        if result.get('conflict'):
+            db.session.rollback()
+            return trip_conflict_response(trip_id)
+        if not result['success']:
+            db.session.rollback()
+            return jsonify({'success': False, 'error': result['error']})
+        db.session.commit()
+        return versioned_response(dict(extra or {}, success=True), 'trip', trip_id, result['version'])
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)})
+
+
+# Оптимистичная блокировка: версия строки в ETag, проверка через If-Match
+TRIP_CONFLICT_ERROR = 'Заявка была изменена другим пользователем, обновите страницу'
+COST_CONFLICT_ERROR = 'Расход был изменен другим пользователем, обновите страницу'
+
+
+def version_etag(kind, object_id, version):
+    """Значение ETag для версии объекта, например trip-15-v3"""
+    return f'{kind}-{object_id}-v{version}'
+
+
+def if_match_version(kind, object_id):
+    """Версия объекта из заголовка If-Match.
+
+    None - заголовка нет (или If-Match: *), запрос выполняется без проверки версии.
+    0 - заголовок есть, но относится к другому объекту: такой версии не бывает,
+    поэтому запрос завершится конфликтом.
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    prefix = version_etag(kind, object_id, '')
+    for tag in request.if_match.as_set(include_weak=True):
+        if tag.startswith(prefix) and tag[len(prefix):].isdigit():
+            return int(tag[len(prefix):])
+    return 0
+
+
+def versioned_response(data, kind, object_id, version):
+    """JSON-ответ с новой версией объекта в теле и в ETag"""
+    response = jsonify(dict(data, version=version))
+    response.set_etag(version_etag(kind, object_id, version))
+    return response
+
+
+def trip_version_mismatch(trip):
+    """True, если If-Match указывает версию заявки, отличную от текущей"""
+    version = if_match_version('trip', trip.id)
+    return version is not None and version != trip.version_id
+
+
+def trip_state_to_dict(trip):
+    """Текущее состояние заявки для ответа 409"""
+    state = trip_to_dict(trip)
+    state.update({field: getattr(trip, field) for field in TRIP_STATE_FIELDS})
+    state['version'] = trip.version_id
+    return state
+
+
+def trip_conflict_response(trip_id):
+    """409 с текущим состоянием заявки; вызывается после rollback"""
+    trip = db.session.get(BusinessTrip, trip_id)
+    if not trip:
+        return jsonify({'success': False, 'error': 'Заявка не найдена'})
+    response = jsonify({'success': False, 'error': TRIP_CONFLICT_ERROR, 'conflict': True,
+                        'trip': trip_state_to_dict(trip)})
+    response.set_etag(version_etag('trip', trip_id, trip.version_id))
+    return response, 409
+
+
+# Столбцы, индексы и их проверка
+def ensure_columns():
+    """Добавляет в существующие таблицы столбцы моделей, которых в них еще нет.
+
+    db.create_all() не меняет уже созданные таблицы. Добавляются только столбцы,
+    допускающие NULL или имеющие значение по умолчанию на стороне БД.
+    """
+    compiler = db.engine.dialect.ddl_compiler(db.engine.dialect, None)
+    created = []
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspect(connection).get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not (column.nullable or column.server_default is not None):
+                    continue
+                connection.execute(db.text(f'ALTER TABLE {compiler.preparer.format_table(table)} '
+                                           f'ADD COLUMN {compiler.get_column_specification(column)}'))
+                created.append(f'{table.name}.{column.name}')
+    return created
+
+
+def ensure_indexes():
+    """Создает индексы моделей, которых еще нет в существующей базе.
+
+    db.create_all() не добавляет индексы к уже созданным таблицам, поэтому
+    при обновлении схемы недостающие индексы создаются здесь.
+    """
+    created = []
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspect(db.engine).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                # Индексы другой СУБД (ddl_if) пропускаются самим create()
+                index.create(db.engine)
+        present = {index['name'] for index in inspect(db.engine).get_indexes(table.name)}
+        created.extend(sorted(present - existing))
+    return created
+
+
+def ensure_search_extension():
+    """Подключает pg_trgm, нужное триграммным индексам поиска"""
+    if db.engine.dialect.name != 'postgresql':
+        return
+    try:
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    except Exception as e:
+        print(f"Не удалось подключить расширение pg_trgm (нужны права владельца БД): {e}")
+
+
+def index_report_queries():
+    """Запросы списков в том виде, в каком их выполняют страницы приложения"""
+    sample_trip_id = db.session.query(func.min(BusinessTrip.id)).scalar() or 0
+    sample_employee_id = db.session.query(func.min(BusinessTrip.employee_id)).scalar() or 0
+    trips_query, _ = apply_trip_filters(BusinessTrip.query, {})
+    order = (BusinessTrip.created_date.desc(), BusinessTrip.id.desc())
+
+    return {
+        '/trips': trips_query.order_by(*order).limit(TRIPS_PER_PAGE),
+        '/trips (статус)': apply_trip_filters(BusinessTrip.query, {'status': 'Согласована'})[0].order_by(
+            *order).limit(TRIPS_PER_PAGE),
+        '/trips (сотрудник)': BusinessTrip.query.filter_by(employee_id=sample_employee_id).order_by(
+            *order).limit(TRIPS_PER_PAGE),
+        '/trips (даты)': BusinessTrip.query.filter(
+            BusinessTrip.start_date >= datetime(2025, 1, 1), BusinessTrip.end_date <= datetime(2025, 2, 1)),
+        '/dashboard (закупки)': BusinessTrip.query.filter_by(procurement_needed=True).order_by(
+            *order).limit(DASHBOARD_RECENT_TRIPS),
+        '/planning': BusinessTrip.query.filter(BusinessTrip.status == 'Планируемая').order_by(
+            *order).limit(TRIPS_PER_PAGE),
+        'эскалация': BusinessTrip.query.filter(
+            BusinessTrip.status == 'Ожидают согласования',
+            BusinessTrip.approval_request_date < datetime.now(timezone.utc) - timedelta(days=1)),
+        'документы заявки': Document.query.filter_by(trip_id=sample_trip_id).order_by(Document.upload_date.desc()),
+        'расходы заявки': TripCost.query.filter_by(trip_id=sample_trip_id).order_by(TripCost.id),
+        'история геолокаций': GeoLocationHistory.query.filter_by(trip_id=sample_trip_id).order_by(
+            GeoLocationHistory.created_date.desc()),
+        'подчиненные': User.query.filter_by(manager_id=sample_employee_id),
+    }
+
+
+def explain_query(query):
+    """План выполнения запроса и список таблиц, которые читаются последовательным сканированием"""
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+
+    if db.engine.dialect.name == 'postgresql':
+        rows = db.session.connection().exec_driver_sql(f"EXPLAIN {compiled}", params).all()
+        plan = [row[0] for row in rows]
+        seq_scans = [line.split(' on ')[1].split()[0] for line in plan if 'Seq Scan on ' in line]
+    else:
+        rows = db.session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", params).all()
+        plan = [row[-1] for row in rows]
+        seq_scans = [line.split()[1] for line in plan
+                     if line.startswith('SCAN ') and 'USING' not in line]
+    return plan, seq_scans
+
+
+@app.cli.command('index-report')
+@click.option('--verbose', is_flag=True, help='Показать полный план каждого запроса')
+def index_report_command(verbose):
+    """Выполняет EXPLAIN для запросов списков и отмечает последовательные сканирования"""
+    problems = 0
+    for name, query in index_report_queries().items():
+        plan, seq_scans = explain_query(query)
+        if seq_scans:
+            problems += 1
+            click.echo(f"[SEQ SCAN] {name}: {', '.join(seq_scans)}")
+        else:
+            click.echo(f"[OK] {name}")
+        if verbose or seq_scans:
+            for line in plan:
+                click.echo(f"    {line}")
+    click.echo(f"Запросов с последовательным сканированием: {problems}")
+    if problems:
+        click.echo("На небольших таблицах планировщик может предпочесть сканирование индексу; "
+                   "выполните ANALYZE и проверьте на реальном объеме данных.")
+
+
+@app.cli.command('create-indexes')
+def create_indexes_command():
+    """Создает недостающие индексы в существующей базе"""
+    created = ensure_indexes()
+    click.echo(f"Создано индексов: {len(created)}" + (f" ({', '.join(created)})" if created else ''))
+
+
+# Полнотекстовый поиск по заявкам
+SEARCH_COLUMNS = ('project_number', 'department', 'purpose', 'destination')
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+
+def escape_like(value):
+    """Экранирует спецсимволы LIKE в пользовательском вводе"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def text_search_filter(column, value):
+    """Поиск подстроки без учета регистра.
+
+    На PostgreSQL ILIKE '%...%' обслуживается триграммным GIN-индексом,
+    на SQLite (тесты) остается обычным LIKE.
+    """
+    return column.ilike(f"%{escape_like(value)}%", escape='\\')
+
+
+def search_trips(base_query, q, limit=SEARCH_DEFAULT_LIMIT):
+    """Заявки, где q встречается в номере проекта, подразделении, цели или направлении.
+
+    Возвращает список пар (заявка, релевантность) по убыванию релевантности.
+    """
+    columns = [getattr(BusinessTrip, name) for name in SEARCH_COLUMNS]
+    match = db.or_(*(text_search_filter(column, q) for column in columns))
+
+    if db.engine.dialect.name == 'postgresql':
+        # Похожие слова (опечатки) тоже находятся через оператор <% из pg_trgm
+        match = db.or_(match, *(db.literal(q).op('<%')(column) for column in columns))
+        rank = func.greatest(*(func.coalesce(func.word_similarity(q, column), 0) for column in columns))
+    else:
+        rank = db.case((BusinessTrip.project_number == q, 1.0), else_=0.5)
+
+    rows = base_query.filter(match).with_entities(BusinessTrip, rank.label('rank')).order_by(
+        db.desc('rank'), BusinessTrip.created_date.desc(), BusinessTrip.id.desc()).limit(limit).all()
+    return [(trip, float(rank or 0)) for trip, rank in rows]
+
+
+# Маршруты аутентификации
+@app.route('/login', methods=['GET', 'POST'])
+def login():
+    if request.method == 'POST':
+        username = request.form['username']
+        password = request.form['password']
+
+        user = User.query.filter_by(username=username).first()
+
+        if user and check_password_hash(user.password_hash, password):
+            session['user_id'] = user.id
+            session['username'] = user.username
+            session['role'] = user.role
+            session['full_name'] = user.full_name
+            flash('Вы успешно вошли в систему', 'success')
+            return redirect(url_for('dashboard'))
+        else:
+            flash('Неверное имя пользователя или пароль', 'error')
+
+    return render_template('login.html')
+
+
+@app.route('/logout')
+def logout():
+    session.clear()
+    flash('Вы вышли из системы', 'info')
+    return redirect(url_for('login'))
+
+
+# Основные маршруты
+@app.route('/')
+def index():
+    if 'user_id' in session:
+        return redirect(url_for('dashboard'))
+    return redirect(url_for('login'))
+
+
+@app.route('/dashboard')
 @login_required
-@role_required(['A', 'B', 'BU', 'GR', 'R', 'S'])
-def planning():
-    user = db.session.get(User, session['user_id'])
-    if not user:
-        flash('Пользователь не найден', 'error')
-        return redirect(url_for('login'))
+@with_current_user
+def dashboard(user):
+    base_query = visible_trips_query(user)
+    stats = cached_dashboard_stats(user)
+    recent_trips, next_cursor, has_more = keyset_page(
+        with_trip_relations(base_query, 'employee'), request.args.get('cursor'), DASHBOARD_RECENT_TRIPS)
+    overdue_trips = overdue_approvals(datetime.now(timezone.utc)) if user.role == 'A' else []
 
-    # Запланированные командировки с учетом ролей
-    base_query = BusinessTrip.query.filter_by(status='Планируемая')
+    return render_template('dashboard.html', user=user, stats=stats, recent_trips=recent_trips,
+                           next_cursor=next_cursor, has_more=has_more, overdue_trips=overdue_trips,
+                           batch_actions=batch_actions_for(user))
 
-    if user.role == 'A' or user.role == 'B' or user.role == 'BU' or user.role == 'GR':
-        planned_trips = base_query.all()
+
+@app.route('/trips')
+@login_required
+@with_current_user
+def trips(user):
+    base_query, current_filters = apply_trip_filters(visible_trips_query(user), request.args)
+
+    pagination = with_trip_relations(base_query, 'employee').order_by(BusinessTrip.created_date.desc(), BusinessTrip.id.desc()).paginate(
+        page=request.args.get('page', 1, type=int), per_page=get_per_page(), error_out=False)
+
+    # Получаем списки для фильтров
+    departments = db.session.query(BusinessTrip.department).distinct().all()
+    departments = [d[0] for d in departments if d[0]]
+    statuses = db.session.query(BusinessTrip.status).distinct().all()
+    statuses = [s[0] for s in statuses if s[0]]
+    employees = User.query.all() if user.role in ['A', 'B', 'GR'] else []
+
+    return render_template('trips.html', user=user, trips=pagination.items, pagination=pagination,
+                           departments=departments, statuses=statuses, employees=employees,
+                           current_filters=current_filters, batch_actions=batch_actions_for(user))
+
+
+@app.route('/api/trips')
+@login_required
+@with_current_user
+def api_trips(user):
+    """Список заявок с фильтрами /trips: постранично (page) или по курсору (cursor)"""
+    base_query, current_filters = apply_trip_filters(visible_trips_query(user), request.args)
+    base_query = with_trip_relations(base_query, 'employee')
+    per_page = get_per_page()
+
+    if 'page' in request.args:
+        pagination = base_query.order_by(BusinessTrip.created_date.desc(), BusinessTrip.id.desc()).paginate(
+            page=request.args.get('page', 1, type=int), per_page=per_page, error_out=False)
+        return jsonify({
+            'success': True,
+            'trips': [trip_to_dict(trip) for trip in pagination.items],
+            'page': pagination.page,
+            'pages': pagination.pages,
+            'total': pagination.total,
+            'has_more': pagination.has_next
+        })
+
+    trips, next_cursor, has_more = keyset_page(base_query, request.args.get('cursor'), per_page)
+    return jsonify({
+        'success': True,
+        'trips': [trip_to_dict(trip) for trip in trips],
+        'next_cursor': next_cursor,
+        'has_more': has_more
+    })
+
+
+@app.route('/api/trips/search')
+@login_required
+@with_current_user
+def api_search_trips(user):
+    """Поиск заявок по номеру проекта, подразделению, цели и направлению"""
+    q = (request.args.get('q') or '').strip()
+    if not q:
+        return jsonify({'success': False, 'error': 'Не указан поисковый запрос'})
+    limit = max(1, min(request.args.get('limit', SEARCH_DEFAULT_LIMIT, type=int), SEARCH_MAX_LIMIT))
+
+    results = search_trips(with_trip_relations(visible_trips_query(user), 'employee'), q, limit)
+    return jsonify({
+        'success': True,
+        'trips': [dict(trip_to_dict(trip), rank=rank) for trip, rank in results],
+        'total': len(results)
+    })
+
+
+@app.route('/api/trips/batch', methods=['POST'])
+@login_required
+@with_current_user
+def batch_trip_actions(user):
+    """Пакетные действия над заявками: {"items": [{"trip_id": 1, "action": "activate", "params": {}}]}
+
+    Необязательное поле version элемента - версия заявки, которую видел пользователь.
+    """
+    items = (request.get_json(silent=True) or {}).get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'error': 'Не указаны действия'})
+    if len(items) > MAX_BATCH_ITEMS:
+        return jsonify({'success': False, 'error': f'Не более {MAX_BATCH_ITEMS} действий за один запрос'})
+    if not all(isinstance(item, dict) for item in items):
+        return jsonify({'success': False, 'error': 'Неверный формат действий'})
+
+    try:
+        results = run_trip_transitions(user, items, datetime.now(timezone.utc))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)})
+
+    return jsonify({
+        'success': True,
+        'results': results,
+        'applied': sum(1 for result in results if result['success'])
+    })
+
+
+@app.route('/api/events')
+@login_required
+@with_current_user
+def trip_events_stream(user):
+    """Поток изменений видимых пользователю заявок (server-sent events).
+
+    Необязательный параметр trip_id оставляет события одной заявки.
+    """
+    trip_id = request.args.get('trip_id', type=int)
+    # Соединение с БД потоку не нужно: права проверяются по полям самого события
+    db.session.close()
+    subscription = event_broker.subscribe()
+
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    payload = subscription.get(timeout=app.config['EVENTS_KEEPALIVE'])
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if trip_id and payload.get('trip_id', trip_id) != trip_id:
+                    continue
+                if can_view_trip_event(user, payload):
+                    yield format_sse(payload)
+        finally:
+            event_broker.unsubscribe(subscription)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/create_trip', methods=['GET', 'POST'])
+@login_required
+@role_required(['A', 'GR', 'R', 'S'])
+@with_current_user
+def create_trip(user):
+    if request.method == 'POST':
+        try:
+            # Определяем employee_id
+            employee_id = request.form.get('employee_id')
+            if not employee_id:
+                employee_id = session['user_id']
+            else:
+                employee_id = int(employee_id)
+
+            employee = db.session.get(User, employee_id)
+            if not employee:
+                flash('Сотрудник не найден', 'error')
+                return redirect(url_for('create_trip'))
+
+            # Проверка прав
+            if user.role == 'R' and employee.id != user.id and employee.manager_id != user.id:
+                flash('Вы можете создавать заявки только для своих подчиненных', 'error')
+                return redirect(url_for('create_trip'))
+
+            start_date = datetime.strptime(request.form['start_date'], '%Y-%m-%d')
+            end_date = datetime.strptime(request.form['end_date'], '%Y-%m-%d')
+            duration = (end_date - start_date).days + 1
+
+            make_active = request.form.get('make_active') == 'on'
+
+            # Определяем статус и активацию
+            initial_status = 'Активированная' if make_active else 'Планируемая'
+            is_activated_value = make_active
+
+            trip = BusinessTrip(
+                trip_number=allocate_trip_numbers()[0],
+                employee_id=employee_id,
+                manager_id=employee.manager_id,
+                department=request.form.get('department') or employee.department,
+                start_date=start_date,
+                end_date=end_date,
+                duration=duration,
+                destination=request.form['destination'],
+                purpose=request.form['purpose'],
+                estimated_costs=float(request.form['estimated_costs']),
+                cost_details_text=request.form.get('cost_details', ''),  # Исправлено
+                trip_format=request.form.get('trip_format', ''),
+                project_number=request.form.get('project_number', ''),
+                regularity=request.form.get('regularity', ''),
+                receiving_party=request.form.get('receiving_party', ''),
+                over_limit=request.form.get('over_limit') == 'on',
+                status=initial_status,
+                is_activated=is_activated_value
+            )
+            db.session.add(trip)
+            db.session.commit()
+            flash('Заявка на командировку создана', 'success')
+            return redirect(url_for('trips'))
+        except Exception as e:
+            db.session.rollback()
+            flash(f'Ошибка при создании заявки: {str(e)}', 'error')
+
+    managers = User.query.filter(User.role.in_(['R', 'GR'])).all()
+    employees = []
+    if user.role == 'A' or user.role == 'GR':
+        employees = User.query.filter(User.role == 'S').all()
     elif user.role == 'R':
-        subordinate_ids = [sub.id for sub in user.subordinates]
-        planned_trips = base_query.filter(
-            (BusinessTrip.employee_id == user.id) |
-            (BusinessTrip.employee_id.in_(subordinate_ids))
-        ).all()
-    elif user.role == 'S':
-        planned_trips = base_query.filter_by(employee_id=user.id).all()
+        employees = user.subordinates
+    return render_template('create_trip.html', user=user, managers=managers, employees=employees)
+
+
+@app.route('/api/trips/import', methods=['POST'])
+@login_required
+@with_current_user
+def api_import_trips(user):
+    """Загрузка заявок из CSV/XLSX; dry_run=1 - только проверка файла"""
+    if user.role not in ['A', 'GR', 'R']:
+        return jsonify({'success': False, 'error': 'Недостаточно прав'})
+    file = request.files.get('file')
+    if not file or not file.filename:
+        return jsonify({'success': False, 'error': 'Файл не выбран'})
+    dry_run = request.form.get('dry_run', '').lower() in IMPORT_TRUE_VALUES
+
+    try:
+        report = import_trips(file.stream, file.filename, user, dry_run)
+        if report['error_rows'] or dry_run:
+            db.session.rollback()
+        else:
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)})
+
+    if report['error_rows']:
+        return jsonify(dict(report, success=False,
+                            error=f"Ошибки в {report['error_rows']} строках, заявки не загружены"))
+    return jsonify(dict(report, success=True))
+
+
+@app.route('/trip/<int:trip_id>')
+@login_required
+@with_current_user
+def trip_detail(trip_id, user):
+    trip = with_trip_relations(BusinessTrip.query, 'employee', 'manager_rel', 'documents', 'cost_details').filter(
+        BusinessTrip.id == trip_id).first()
+    if not trip:
+        flash('Заявка не найдена', 'error')
+        return redirect(url_for('dashboard'))
+
+    # Проверка прав доступа
+    if not can_view_trip(user, trip):
+        flash('Доступ запрещен', 'error')
+        return redirect(url_for('dashboard'))
+
+    return render_template('trip_detail.html', user=user, trip=trip)
+
+
+@app.route('/reports')
+@login_required
+@role_required(['A', 'B', 'BU', 'GR', 'R', 'S', 'TK', 'Z'])
+@with_current_user
+def reports(user):
+    # Только активированные заявки с учетом роли
+    base_query = visible_trips_query(user).filter(BusinessTrip.is_activated == True)
+    base_query, current_filters = apply_report_filters(base_query, request.args)
+    sort_by = current_filters['sort_by']
+
+    # Сортировка
+    detail_query = with_trip_relations(base_query, 'employee').order_by(*report_order_by(sort_by))
+
+    pagination = detail_query.paginate(
+        page=request.args.get('page', 1, type=int), per_page=get_per_page(), error_out=False)
+
+    # Статистика для графиков: из таблицы итогов, если фильтры позволяют, иначе по заявкам выборки
+    if can_use_report_rollup(user, current_filters):
+        stats = rollup_aggregates(current_filters)
     else:
-        planned_trips = base_query.all()
+        stats = report_aggregates(base_query)
+
+    return render_template('reports.html', user=user, trips=pagination.items, pagination=pagination,
+                           pagination_params=report_filter_params(current_filters),
+                           current_filters=current_filters, **stats)
+
+
+@app.route('/planning')
+@login_required
+@role_required(['A', 'B', 'BU', 'GR', 'R', 'S'])
+@with_current_user
+def planning(user):
+    # Запланированные командировки с учетом ролей
+    base_query = with_trip_relations(visible_trips_query(user), 'employee').filter(
+        BusinessTrip.status == 'Планируемая')
+
+    pagination = base_query.order_by(BusinessTrip.created_date.desc(), BusinessTrip.id.desc()).paginate(
+        page=request.args.get('page', 1, type=int), per_page=get_per_page(), error_out=False)
 
-    return render_template('planning.html', user=user, trips=planned_trips)
+    return render_template('planning.html', user=user, trips=pagination.items, pagination=pagination)
 
 
 @app.route('/employees')
 @login_required
 @role_required(['A', 'B'])
-def employees():
-    user = db.session.get(User, session['user_id'])
-    if not user:
-        flash('Пользователь не найден', 'error')
-        return redirect(url_for('login'))
-
+@with_current_user
+def employees(user):
     employees_list = User.query.all()
     managers = User.query.filter(User.role.in_(['R', 'GR'])).all()
     return render_template('employees.html', user=user, employees=employees_list, managers=managers)
@@ -733,129 +2932,697 @@ def delete_employee(employee_id):
         db.session.commit()
         flash('Сотрудник успешно удален', 'success')
     except Exception as e:
-        db.session.rollback()
-        flash(f'Ошибка при удалении сотрудника: {str(e)}', 'error')
+        db.session.rollback()
+        flash(f'Ошибка при удалении сотрудника: {str(e)}', 'error')
+
+    return redirect(url_for('employees'))
+
+
+# API endpoints для AJAX операций
+@app.route('/api/update_trip_status/<int:trip_id>', methods=['POST'])
+@login_required
+@with_current_user
+def update_trip_status(trip_id, user):
+    """Смена статуса через переход конечного автомата, соответствующий новому статусу"""
+    new_status = (request.get_json(silent=True) or {}).get('status')
+    if not new_status:
+        return jsonify({'success': False})
+    if new_status not in TRIP_TRANSITION_BY_STATUS:
+        return jsonify({'success': False, 'error': f'Недопустимый статус: {new_status}'})
+
+    return trip_transition_response(user, trip_id, TRIP_TRANSITION_BY_STATUS[new_status],
+                                    extra={'new_status': new_status})
+
+@app.route('/api/trip/<int:trip_id>/verify_geo_location', methods=['POST'])
+@login_required
+@with_current_user
+def verify_geo_location(trip_id, user):
+    """Проверка геолокации руководителем"""
+    try:
+        trip = db.session.get(BusinessTrip, trip_id)
+        if not trip:
+            return jsonify({'success': False, 'error': 'Заявка не найдена'})
+            
+        if user.role not in ['R', 'GR']:
+            return jsonify({'success': False, 'error': 'Недостаточно прав'})
+        if trip_version_mismatch(trip):
+            return trip_conflict_response(trip_id)
+        
+        verified = request.json.get('verified', False)
+        
+        trip.geo_location_verified = verified
+        if verified:
+            trip.geo_location_verified_by = user.id
+            trip.geo_location_verified_date = datetime.now(timezone.utc)
+        else:
+            trip.geo_location_verified_by = None
+            trip.geo_location_verified_date = None
+        
+        db.session.commit()
+        
+        return versioned_response({'success': True}, 'trip', trip_id, trip.version_id)
+    except StaleDataError:
+        db.session.rollback()
+        return trip_conflict_response(trip_id)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/trip/<int:trip_id>/activate', methods=['POST'])
+@login_required
+@with_current_user
+def activate_trip(trip_id, user):
+    return trip_transition_response(user, trip_id, 'activate')
+
+
+@app.route('/api/trip/<int:trip_id>/send_for_approval', methods=['POST'])
+@login_required
+@with_current_user
+def send_for_approval(trip_id, user):
+    return trip_transition_response(user, trip_id, 'send_for_approval')
+
+
+# Хранилище файлов документов
+# Файлы лежат по ключу - SHA-256 содержимого; драйвер выбирается DOCUMENT_STORAGE.
+# Удаление двухфазное: stage_delete до commit убирает файл из-под ключа, finish_delete
+# после commit удаляет его окончательно, а при откате возвращает на место
+class LocalDocumentStorage:
+    """Файлы в папке на диске приложения: <root>/ab/cd/<sha256>"""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def relative_path(self, key):
+        return f"{key[:2]}/{key[2:4]}/{key}"
+
+    def path(self, key):
+        return os.path.join(self.root, *self.relative_path(key).split('/'))
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def put_file(self, key, local_path):
+        """Переносит локальный файл в хранилище"""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.move(local_path, path)
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def download_url(self, key, filename):
+        """Адрес для скачивания в обход приложения; локальные файлы отдает само приложение"""
+        return None
+
+    def stage_delete(self, key):
+        try:
+            os.replace(self.path(key), self.path(key) + '.deleted')
+            return True
+        except FileNotFoundError:
+            return False
+
+    def finish_delete(self, key, committed):
+        if committed:
+            os.remove(self.path(key) + '.deleted')
+        else:
+            os.replace(self.path(key) + '.deleted', self.path(key))
+
+
+class S3DocumentStorage:
+    """Файлы в бакете S3-совместимого хранилища (AWS S3, MinIO), общем для всех экземпляров
+    приложения. Документы скачиваются по временным подписанным ссылкам прямо из хранилища."""
+
+    def __init__(self, bucket, endpoint_url=None, region=None, access_key_id=None,
+                 secret_access_key=None, url_ttl=300):
+        import boto3
+        from botocore.exceptions import ClientError
+        self.client_error = ClientError
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region,
+                                   aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key)
+        self.bucket = bucket
+        self.url_ttl = url_ttl
+
+    def object_key(self, key):
+        return f"documents/{key[:2]}/{key[2:4]}/{key}"
+
+    def is_missing(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+            return True
+        except self.client_error as e:
+            if self.is_missing(e):
+                return False
+            raise
+
+    def put_file(self, key, local_path):
+        self.client.upload_file(local_path, self.bucket, self.object_key(key))
+        os.remove(local_path)
+
+    def open(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))['Body']
+        except self.client_error as e:
+            if self.is_missing(e):
+                raise FileNotFoundError(self.object_key(key))
+            raise
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+    def download_url(self, key, filename):
+        params = {'Bucket': self.bucket, 'Key': self.object_key(key),
+                  'ResponseContentDisposition': f'inline; filename="{filename}"'}
+        mimetype = mimetypes.guess_type(filename)[0]
+        if mimetype:
+            params['ResponseContentType'] = mimetype
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=self.url_ttl)
+
+    def move(self, source_key, target_key):
+        # Копирование выполняет само хранилище, байты файла через приложение не идут
+        self.client.copy_object(Bucket=self.bucket, Key=target_key,
+                                CopySource={'Bucket': self.bucket, 'Key': source_key})
+        self.client.delete_object(Bucket=self.bucket, Key=source_key)
+
+    def stage_delete(self, key):
+        try:
+            self.move(self.object_key(key), self.object_key(key) + '.deleted')
+            return True
+        except self.client_error as e:
+            if self.is_missing(e):
+                return False
+            raise
+
+    def finish_delete(self, key, committed):
+        if committed:
+            self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key) + '.deleted')
+        else:
+            self.move(self.object_key(key) + '.deleted', self.object_key(key))
+
+
+def make_document_storage(name):
+    """Драйвер хранилища документов: local - диск приложения, s3 - S3-совместимое хранилище"""
+    if name == 's3':
+        return S3DocumentStorage(
+            app.config['S3_BUCKET'],
+            endpoint_url=app.config['S3_ENDPOINT_URL'],
+            region=app.config['S3_REGION'],
+            access_key_id=app.config['S3_ACCESS_KEY_ID'],
+            secret_access_key=app.config['S3_SECRET_ACCESS_KEY'],
+            url_ttl=app.config['S3_PRESIGNED_URL_TTL']
+        )
+    if name == 'local':
+        return LocalDocumentStorage(DOCUMENT_STORE_FOLDER)
+    raise ValueError(f"Неизвестное хранилище документов: {name}")
+
+
+document_storage = make_document_storage(app.config['DOCUMENT_STORAGE'])
+
+
+# Хранилище документов по содержимому
+# Ссылка на содержимое добавляется UPSERT-ом до загрузки файла в хранилище: строка
+# stored_files заблокирована до commit, поэтому параллельное удаление последней ссылки
+# не унесет только что загруженный файл
+HASH_READ_BLOCK = 1024 * 1024
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(HASH_READ_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def add_content_reference(connection, content_hash, size):
+    """Увеличивает счетчик ссылок на содержимое и возвращает новое значение"""
+    table = StoredFile.__table__
+    dialect = connection.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        stmt = insert(table).values(sha256=content_hash, size=size, ref_count=1)
+        return connection.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.sha256], set_={'ref_count': table.c.ref_count + 1}
+        ).returning(table.c.ref_count)).scalar()
+    updated = connection.execute(table.update().where(table.c.sha256 == content_hash).values(
+        ref_count=table.c.ref_count + 1)).rowcount
+    if not updated:
+        connection.execute(table.insert().values(sha256=content_hash, size=size, ref_count=1))
+    return connection.execute(db.select(table.c.ref_count).where(table.c.sha256 == content_hash)).scalar()
+
+
+def store_document_content(temp_path):
+    """Переносит загруженный файл в хранилище и добавляет ссылку на его содержимое.
+
+    Вызывается в транзакции, которая создает Document. Если такое содержимое уже есть,
+    временный файл просто удаляется: повторная загрузка стоит только вычисления хеша.
+    Новый файл удаляется из хранилища, если транзакция откатится (discard_stored_content).
+    Возвращает SHA-256 содержимого.
+    """
+    try:
+        content_hash = file_sha256(temp_path)
+        ref_count = add_content_reference(db.session.connection(), content_hash, os.path.getsize(temp_path))
+        if ref_count == 1 or not document_storage.exists(content_hash):
+            document_storage.put_file(content_hash, temp_path)
+            db.session.info['previews_pending'] = True
+            if ref_count == 1:
+                db.session.info.setdefault('stored_content', []).append(content_hash)
+        else:
+            os.remove(temp_path)
+        return content_hash
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+@event.listens_for(Session, 'after_commit')
+def keep_stored_content(session):
+    session.info.pop('stored_content', None)
+
+
+def claim_unreferenced_content(connection, content_hash):
+    """Занимает хеш строкой stored_files без ссылок; False, если строка уже есть.
+
+    Если другая транзакция успела вставить строку с этим хешем, но еще не завершилась,
+    вставка ждет ее: после commit строка есть и файл принадлежит ей, после отката хеш свободен.
+    """
+    table = StoredFile.__table__
+    values = {'sha256': content_hash, 'size': 0, 'ref_count': 0}
+    dialect = connection.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        return connection.execute(insert(table).values(**values).on_conflict_do_nothing(
+            index_elements=[table.c.sha256])).rowcount == 1
+    try:
+        with connection.begin_nested():
+            connection.execute(table.insert().values(**values))
+        return True
+    except IntegrityError:
+        return False
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_stored_content(session):
+    """Удаляет файлы, записанные в хранилище откатившейся транзакцией: строки stored_files
+    для них откатились, и без этого файлы остались бы в хранилище без учета ссылок.
+
+    Пока идет удаление, хеш занят строкой без ссылок в отдельной транзакции, поэтому
+    параллельная загрузка того же содержимого либо уже сохранила файл (и он не удаляется),
+    либо дождется удаления и запишет файл заново.
+    """
+    table = StoredFile.__table__
+    for content_hash in session.info.pop('stored_content', ()):
+        try:
+            with db.engine.begin() as connection:
+                if not claim_unreferenced_content(connection, content_hash):
+                    continue
+                if document_storage.stage_delete(content_hash):
+                    document_storage.finish_delete(content_hash, committed=True)
+                connection.execute(table.delete().where(table.c.sha256 == content_hash))
+        except Exception as e:
+            print(f"Ошибка при удалении файла из хранилища: {e}")
+
+
+def release_document_content(content_hash):
+    """Убирает ссылку удаляемого документа на содержимое (после flush удаления документа).
+
+    Если ссылок не осталось, строка stored_files удаляется, а файл откладывается
+    на удаление до commit (finish_content_release).
+    Возвращает хеш отложенного файла или None.
+    """
+    table = StoredFile.__table__
+    connection = db.session.connection()
+    remaining = connection.execute(table.update().where(table.c.sha256 == content_hash).values(
+        ref_count=table.c.ref_count - 1).returning(table.c.ref_count)).scalar()
+    if remaining is None or remaining > 0:
+        return None
+    connection.execute(table.delete().where(table.c.sha256 == content_hash, table.c.ref_count <= 0))
+    return content_hash if document_storage.stage_delete(content_hash) else None
+
+
+def finish_content_release(content_hash, committed):
+    """Удаляет отложенный файл после commit или возвращает его на место после отката"""
+    if content_hash is None:
+        return
+    try:
+        document_storage.finish_delete(content_hash, committed)
+        if committed:
+            document_storage.delete(preview_key(content_hash))
+    except Exception as e:
+        print(f"Ошибка при удалении файла из хранилища: {e}")
+
+
+def open_document_file(file_path, content_hash=None):
+    """Файл документа для чтения: из хранилища, а для документов, загруженных до его
+    появления, - с диска по URL вида /static/uploads/..."""
+    if content_hash:
+        return document_storage.open(content_hash)
+    return open(legacy_document_path(file_path), 'rb')
+
+
+@app.cli.command('migrate-documents')
+def migrate_documents_command():
+    """Переносит файлы документов, загруженных до появления хранилища, в хранилище по содержимому"""
+    moved, missing = 0, 0
+    for document in Document.query.filter(Document.content_hash.is_(None)).order_by(Document.id).all():
+        legacy_path = legacy_document_path(document.file_path)
+        if not os.path.exists(legacy_path):
+            missing += 1
+            continue
+        # Копия, а не перенос: старый файл удаляется только после commit
+        temp_path = os.path.join(UPLOAD_PARTIAL_FOLDER, f'migrate_{document.id}.part')
+        shutil.copyfile(legacy_path, temp_path)
+        document.content_hash = store_document_content(temp_path)
+        db.session.commit()
+        os.remove(legacy_path)
+        moved += 1
+    click.echo(f"Перенесено документов: {moved}, файлов не найдено: {missing}")
+
+
+# Отдача файлов документов
+# Содержимое документа не меняется, поэтому для файлов из хранилища ETag - хеш содержимого,
+# а браузер кэширует их на год без повторных запросов (immutable)
+DOCUMENT_CACHE_MAX_AGE = 365 * 24 * 3600
+
+
+def send_document(document):
+    """Ответ с файлом документа; права на заявку проверяет вызывающий код.
+
+    Из S3 файл скачивается по подписанной ссылке, из локального хранилища его отдает
+    приложение (с поддержкой Range) или, по DOCUMENT_SENDFILE, веб-сервер через sendfile.
+    """
+    if not document.content_hash:
+        # Документ, загруженный до появления хранилища: файл на диске по file_path
+        path = legacy_document_path(document.file_path)
+        if not os.path.exists(path):
+            return 'Документ не найден', 404
+        return send_file(path, download_name=document.filename, conditional=True)
+
+    return send_stored_file(document.content_hash, document.filename)
+
+
+def send_stored_file(key, filename):
+    """Ответ с файлом хранилища по ключу; содержимое по ключу не меняется"""
+    url = document_storage.download_url(key, filename)
+    if url:
+        return redirect(url)
+
+    etag = f'sha256-{key}'
+    mode = app.config['DOCUMENT_SENDFILE']
+    if mode == 'app':
+        response = send_file(document_storage.path(key), download_name=filename, conditional=True, etag=etag)
+    elif request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        # Заголовок перехватывает nginx (X-Accel-Redirect) или Apache/lighttpd (X-Sendfile):
+        # байты файла отдает веб-сервер, Range он обрабатывает сам
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['Content-Disposition'] = f'inline; filename="{filename}"'
+        if mode == 'x-accel':
+            response.headers['X-Accel-Redirect'] = (app.config['DOCUMENT_ACCEL_PREFIX'].rstrip('/') + '/' +
+                                                    document_storage.relative_path(key))
+        else:
+            response.headers['X-Sendfile'] = document_storage.path(key)
+    response.set_etag(etag)
+    response.cache_control.no_cache = None
+    response.cache_control.private = True
+    response.cache_control.max_age = DOCUMENT_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+def document_file_response(document):
+    """Файл документа, если пользователь видит его заявку; иначе 404, не раскрывая, что файл есть"""
+    user = load_current_user()
+    if user is None:
+        return redirect(url_for('login'))
+    if document is None or not can_view_trip(user, document.trip):
+        return 'Документ не найден', 404
+    return send_document(document)
+
+
+def load_document_with_trip(*criteria):
+    return Document.query.options(joinedload(Document.trip).joinedload(BusinessTrip.employee)).filter(
+        *criteria).first()
+
+
+@app.route('/api/document/<int:document_id>/file')
+@login_required
+def serve_document(document_id):
+    return document_file_response(load_document_with_trip(Document.id == document_id))
+
+
+# Прежние адреса документов /static/uploads/... тоже проходят проверку доступа:
+# документ ищется по file_path, остальная статика отдается как обычно
+def send_static_or_document(filename):
+    if filename.startswith('uploads/'):
+        return document_file_response(load_document_with_trip(Document.file_path == f'/static/{filename}'))
+    return app.send_static_file(filename)
+
+
+app.view_functions['static'] = send_static_or_document
+
+
+# Миниатюры документов
+# Для нового содержимого (изображения, первая страница PDF) фоновый генератор делает
+# уменьшенную копию в WebP и кладет ее в хранилище рядом с оригиналом (<sha256>.thumb.webp).
+# Состояние - в stored_files.preview_status: NULL - ожидает, processing, ready,
+# none - формат не поддерживается, failed - ошибка
+PREVIEW_SIZE = (320, 320)
+PREVIEW_QUALITY = 70
+PREVIEW_BATCH_SIZE = 20
+PREVIEW_CLAIM_TIMEOUT = timedelta(minutes=10)  # Через сколько зависшую обработку можно забрать снова
+
+# Будит генератор после commit с новым содержимым, не дожидаясь PREVIEW_INTERVAL
+preview_wakeup = threading.Event()
+
+
+def preview_key(content_hash):
+    return f'{content_hash}.thumb.webp'
+
+
+@event.listens_for(Session, 'after_commit')
+def wake_preview_generator(session):
+    if session.info.pop('previews_pending', False):
+        preview_wakeup.set()
+
+
+@event.listens_for(Session, 'after_rollback')
+def reset_previews_pending(session):
+    session.info.pop('previews_pending', None)
+
+
+def render_preview(data, target_path):
+    """Пишет миниатюру изображения или первой страницы PDF в WebP; False - формат не поддерживается"""
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    if data.startswith(b'%PDF-'):
+        try:
+            import pymupdf
+        except ImportError:
+            return False
+        with pymupdf.open(stream=data, filetype='pdf') as pdf:
+            page = pdf[0]
+            zoom = min(PREVIEW_SIZE[0] / page.rect.width, PREVIEW_SIZE[1] / page.rect.height)
+            pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False)
+            image = Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+    else:
+        try:
+            image = Image.open(io.BytesIO(data))
+        except UnidentifiedImageError:
+            return False
+        # JPEG декодируется сразу в уменьшенном масштабе, а не в полном размере снимка
+        image.draft('RGB', PREVIEW_SIZE)
+        image = ImageOps.exif_transpose(image)
+
+    image.thumbnail(PREVIEW_SIZE)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    image.save(target_path, 'WEBP', quality=PREVIEW_QUALITY)
+    return True
+
+
+def make_document_preview(content_hash):
+    """Создает миниатюру содержимого и возвращает итоговый preview_status"""
+    temp_path = os.path.join(UPLOAD_PARTIAL_FOLDER, preview_key(content_hash))
+    try:
+        with document_storage.open(content_hash) as source:
+            data = source.read()
+        if not render_preview(data, temp_path):
+            return 'none'
+        document_storage.put_file(preview_key(content_hash), temp_path)
+        return 'ready'
+    except Exception as e:
+        print(f"Ошибка при создании миниатюры {content_hash}: {e}")
+        return 'failed'
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
-    return redirect(url_for('employees'))
 
+def generate_previews(now=None, batch_size=PREVIEW_BATCH_SIZE):
+    """Один проход генератора; возвращает число обработанных файлов.
 
-# API endpoints для AJAX операций
-@app.route('/api/update_trip_status/<int:trip_id>', methods=['POST'])
-@login_required
-def update_trip_status(trip_id):
+    Файл забирается в работу условным UPDATE, поэтому несколько генераторов
+    (потоки разных процессов и отдельный воркер) не обрабатывают его дважды.
+    """
     try:
-        trip = db.session.get(BusinessTrip, trip_id)
-        if not trip:
-            return jsonify({'success': False, 'error': 'Заявка не найдена'})
-
-        new_status = request.json.get('status')
-        if new_status:
-            trip.status = new_status
-            db.session.commit()
-            return jsonify({'success': True, 'new_status': new_status})
+        import PIL  # noqa: F401
+    except ImportError:
+        return 0
+
+    now = now or datetime.now(timezone.utc)
+    pending = db.or_(
+        StoredFile.preview_status.is_(None),
+        db.and_(StoredFile.preview_status == 'processing',
+                StoredFile.preview_date < utc_naive(now - PREVIEW_CLAIM_TIMEOUT))
+    )
+    content_hashes = db.session.scalars(
+        db.select(StoredFile.sha256).where(pending).order_by(StoredFile.created_date).limit(batch_size)).all()
+    db.session.commit()
 
-        return jsonify({'success': False})
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'success': False, 'error': str(e)})
+    processed = 0
+    for content_hash in content_hashes:
+        claimed = db.session.execute(db.update(StoredFile).where(StoredFile.sha256 == content_hash, pending).values(
+            preview_status='processing', preview_date=now)).rowcount
+        db.session.commit()
+        if not claimed:
+            continue
 
-@app.route('/api/trip/<int:trip_id>/verify_geo_location', methods=['POST'])
-@login_required
-def verify_geo_location(trip_id):
-    """Проверка геолокации руководителем"""
-    try:
-        trip = db.session.get(BusinessTrip, trip_id)
-        if not trip:
-            return jsonify({'success': False, 'error': 'Заявка не найдена'})
-            
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-            
-        if user.role not in ['R', 'GR']:
-            return jsonify({'success': False, 'error': 'Недостаточно прав'})
-        
-        verified = request.json.get('verified', False)
-        
-        trip.geo_location_verified = verified
-        if verified:
-            trip.geo_location_verified_by = user.id
-            trip.geo_location_verified_date = datetime.now(timezone.utc)
-        else:
-            trip.geo_location_verified_by = None
-            trip.geo_location_verified_date = None
-        
+        status = make_document_preview(content_hash)
+        updated = db.session.execute(db.update(StoredFile).where(StoredFile.sha256 == content_hash).values(
+            preview_status=status, preview_date=datetime.now(timezone.utc))).rowcount
         db.session.commit()
-        
-        return jsonify({'success': True})
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'success': False, 'error': str(e)})
+        if not updated and status == 'ready':
+            # Последний документ с этим содержимым удалили, пока готовилась миниатюра
+            document_storage.delete(preview_key(content_hash))
+        processed += 1
+    return processed
 
-@app.route('/api/trip/<int:trip_id>/activate', methods=['POST'])
-@login_required
-def activate_trip(trip_id):
-    try:
-        trip = db.session.get(BusinessTrip, trip_id)
-        if not trip:
-            return jsonify({'success': False, 'error': 'Заявка не найдена'})
-            
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-            
-        if user.role not in ['A', 'GR', 'R'] and trip.employee_id != user.id:
-            return jsonify({'success': False, 'error': 'Недостаточно прав'})
-        trip.is_activated = True
-        trip.status = 'Активированная'
+
+def document_thumbnail_url(document):
+    """Адрес миниатюры документа или None, если ее нет (еще не готова или формат не поддерживается)"""
+    if document.stored_file is None or document.stored_file.preview_status != 'ready':
+        return None
+    return url_for('serve_document_thumbnail', document_id=document.id)
+
+
+def run_preview_loop(interval, stop_event):
+    """Создает миниатюры, пока не установлен stop_event; новые файлы будят цикл сразу"""
+    while not stop_event.is_set():
+        preview_wakeup.clear()
+        try:
+            with app.app_context():
+                processed = generate_previews()
+        except Exception as e:
+            print(f"Ошибка при создании миниатюр: {e}")
+            processed = 0
+        # Полная пачка - вероятно, в очереди есть еще, продолжаем без ожидания
+        if processed < PREVIEW_BATCH_SIZE:
+            preview_wakeup.wait(interval)
+
+
+def start_preview_generator():
+    """Запускает фоновый поток создания миниатюр внутри процесса приложения"""
+    stop_event = threading.Event()
+    thread = threading.Thread(
+        target=run_preview_loop,
+        args=(app.config['PREVIEW_INTERVAL'], stop_event),
+        name='preview-generator',
+        daemon=True
+    )
+    thread.start()
+    return stop_event
+
+
+@app.cli.command('generate-previews')
+@click.option('--loop', is_flag=True, help='Работать постоянно с интервалом PREVIEW_INTERVAL')
+@click.option('--retry', is_flag=True, help='Повторить файлы с ошибкой или неподдерживаемым форматом')
+def generate_previews_command(loop, retry):
+    """Создает миниатюры документов (отдельный воркер)"""
+    if retry:
+        db.session.execute(db.update(StoredFile).where(StoredFile.preview_status.in_(('none', 'failed'))).values(
+            preview_status=None))
         db.session.commit()
-        return jsonify({'success': True})
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'success': False, 'error': str(e)})
+    if loop:
+        run_preview_loop(app.config['PREVIEW_INTERVAL'], threading.Event())
+    else:
+        click.echo(f"Обработано файлов: {generate_previews()}")
 
 
-@app.route('/api/trip/<int:trip_id>/send_for_approval', methods=['POST'])
+@app.route('/api/document/<int:document_id>/thumbnail')
 @login_required
-def send_for_approval(trip_id):
-    try:
-        trip = db.session.get(BusinessTrip, trip_id)
-        if not trip:
-            return jsonify({'success': False, 'error': 'Заявка не найдена'})
-            
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-            
-        if user.role not in ['A', 'GR', 'R'] and trip.employee_id != user.id:
-            return jsonify({'success': False, 'error': 'Недостаточно прав'})
-        trip.status = 'Ожидают согласования'
-        trip.approval_request_date = datetime.now(timezone.utc)
-        db.session.commit()
-        return jsonify({'success': True})
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'success': False, 'error': str(e)})
+def serve_document_thumbnail(document_id):
+    document = load_document_with_trip(Document.id == document_id)
+    user = load_current_user()
+    if document is None or user is None or not can_view_trip(user, document.trip) or \
+            document.stored_file is None or document.stored_file.preview_status != 'ready':
+        return 'Миниатюра не найдена', 404
+    return send_stored_file(preview_key(document.content_hash),
+                            f"{os.path.splitext(document.filename)[0]}.webp")
+
+
+def limit_upload_request():
+    """Ответ 413, если тело запроса с файлом заведомо больше допустимого, иначе None.
+
+    Предел задается до разбора формы: запрос с большим Content-Length отклоняется сразу,
+    а без него чтение обрывается на пределе (RequestEntityTooLarge).
+    """
+    request.max_content_length = MAX_UPLOAD_REQUEST_SIZE
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_REQUEST_SIZE:
+        return jsonify({'success': False, 'error': 'Размер файла превышает 10MB'}), 413
+    return None
+
+
+def document_upload_name(trip_id, filename, content_hash, prefix=''):
+    """Имя документа в его адресе /static/uploads/...; по хешу адреса не совпадают
+    у разных файлов с одинаковым именем, загруженных в одну секунду"""
+    return f"{prefix}{trip_id}_{content_hash[:16]}_{filename}"
+
+
+def uploaded_document_response(document):
+    return jsonify({
+        'success': True,
+        'document': {
+            'id': document.id,
+            'filename': document.filename,
+            'file_path': document.file_path,
+            'url': url_for('serve_document', document_id=document.id),
+            'thumbnail_url': document_thumbnail_url(document),
+            'file_type': document.file_type,
+            'description': document.description,
+            'upload_date': document.upload_date.strftime('%d.%m.%Y %H:%M'),
+            'uploaded_by': document.uploaded_by.full_name
+        }
+    })
 
 
 @app.route('/api/trip/<int:trip_id>/upload_document', methods=['POST'])
 @login_required
-def upload_document(trip_id):
+@with_current_user
+def upload_document(trip_id, user):
+    too_large = limit_upload_request()
+    if too_large:
+        return too_large
     try:
-        trip = db.session.get(BusinessTrip, trip_id)
+        trip = db.session.get(BusinessTrip, trip_id, options=[joinedload(BusinessTrip.employee)])
         if not trip:
             return jsonify({'success': False, 'error': 'Заявка не найдена'})
             
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-        
         # Проверка прав доступа
-        if user.role == 'S' and trip.employee_id != user.id:
-            return jsonify({'success': False, 'error': 'Вы можете загружать документы только для своих командировок'})
-        elif user.role == 'R' and trip.employee_id != user.id and trip.employee_id not in [sub.id for sub in user.subordinates]:
-            return jsonify({'success': False, 'error': 'Доступ запрещен'})
-        elif user.role == 'Z' and not trip.procurement_needed:
+        if not can_view_trip(user, trip):
+            if user.role == 'S':
+                return jsonify({'success': False, 'error': 'Вы можете загружать документы только для своих командировок'})
             return jsonify({'success': False, 'error': 'Доступ запрещен'})
         
         if 'file' not in request.files:
@@ -874,19 +3641,19 @@ def upload_document(trip_id):
             if file_length > MAX_FILE_SIZE:
                 return jsonify({'success': False, 'error': 'Размер файла превышает 10MB'})
             
-            # Создаем уникальное имя файла
+            # Сохраняем файл во временную папку и переносим в хранилище по содержимому
             filename = secure_filename(file.filename)
-            unique_filename = f"{trip_id}_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}_{filename}"
-            file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
-            
-            # Сохраняем файл
-            file.save(file_path)
+            temp_path = upload_partial_path(secrets.token_hex(16))
+            file.save(temp_path)
+            content_hash = store_document_content(temp_path)
+            unique_filename = document_upload_name(trip_id, filename, content_hash)
             
             # Создаем запись в базе данных
             document = Document(
                 trip_id=trip_id,
                 filename=filename,
                 file_path=f"/static/uploads/{unique_filename}",
+                content_hash=content_hash,
                 file_type=request.form.get('file_type', 'other'),
                 description=request.form.get('description', ''),
                 uploaded_by_id=user.id
@@ -901,21 +3668,12 @@ def upload_document(trip_id):
             
             db.session.commit()
             
-            return jsonify({
-                'success': True,
-                'document': {
-                    'id': document.id,
-                    'filename': document.filename,
-                    'file_path': document.file_path,
-                    'file_type': document.file_type,
-                    'description': document.description,
-                    'upload_date': document.upload_date.strftime('%d.%m.%Y %H:%M'),
-                    'uploaded_by': document.uploaded_by.full_name
-                }
-            })
+            return uploaded_document_response(document)
         else:
             return jsonify({'success': False, 'error': 'Недопустимый формат файла'})
             
+    except RequestEntityTooLarge:
+        return jsonify({'success': False, 'error': 'Размер файла превышает 10MB'}), 413
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)})
@@ -923,26 +3681,22 @@ def upload_document(trip_id):
 
 @app.route('/api/document/<int:document_id>/delete', methods=['POST'])
 @login_required
-def delete_document(document_id):
+@with_current_user
+def delete_document(document_id, user):
     try:
-        document = db.session.get(Document, document_id)
+        document = db.session.get(Document, document_id,
+                                  options=[joinedload(Document.trip).joinedload(BusinessTrip.employee)])
         if not document:
             return jsonify({'success': False, 'error': 'Документ не найден'})
             
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-        
         # Проверка прав доступа
         trip = document.trip
         can_delete = False
         
         if user.role in ['A', 'B', 'BU', 'GR']:
             can_delete = True
-        elif user.role == 'R':
-            subordinate_ids = [sub.id for sub in user.subordinates]
-            if trip.employee_id == user.id or trip.employee_id in subordinate_ids:
-                can_delete = True
+        elif user.role == 'R' and is_own_or_subordinate_trip(user, trip):
+            can_delete = True
         elif user.role == 'S' and trip.employee_id == user.id:
             can_delete = True
         elif user.id == document.uploaded_by_id:
@@ -951,18 +3705,28 @@ def delete_document(document_id):
         if not can_delete:
             return jsonify({'success': False, 'error': 'Недостаточно прав для удаления документа'})
         
-        # Удаляем файл с диска
-        try:
-            file_path = document.file_path.replace('/static/', '')
-            full_path = os.path.join(app.root_path, file_path)
-            if os.path.exists(full_path):
-                os.remove(full_path)
-        except Exception as e:
-            print(f"Ошибка при удалении файла: {str(e)}")
-        
         # Удаляем запись из базы данных
         db.session.delete(document)
-        db.session.commit()
+        db.session.flush()
+
+        # Файл в хранилище удаляется, только если на него не ссылаются другие документы
+        released_path = None
+        if document.content_hash:
+            released_path = release_document_content(document.content_hash)
+        else:
+            try:
+                full_path = legacy_document_path(document.file_path)
+                if os.path.exists(full_path):
+                    os.remove(full_path)
+            except Exception as e:
+                print(f"Ошибка при удалении файла: {str(e)}")
+
+        try:
+            db.session.commit()
+        except Exception:
+            finish_content_release(released_path, committed=False)
+            raise
+        finish_content_release(released_path, committed=True)
         
         return jsonify({'success': True})
         
@@ -973,26 +3737,20 @@ def delete_document(document_id):
 
 @app.route('/api/trip/<int:trip_id>/documents')
 @login_required
-def get_trip_documents(trip_id):
+@with_current_user
+def get_trip_documents(trip_id, user):
     try:
-        trip = db.session.get(BusinessTrip, trip_id)
+        trip = db.session.get(BusinessTrip, trip_id, options=[joinedload(BusinessTrip.employee)])
         if not trip:
             return jsonify({'success': False, 'error': 'Заявка не найдена'})
             
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-        
         # Проверка прав доступа
-        if user.role == 'S' and trip.employee_id != user.id:
-            return jsonify({'success': False, 'error': 'Доступ запрещен'})
-        elif user.role == 'R' and trip.employee_id != user.id and trip.employee_id not in [sub.id for sub in user.subordinates]:
-            return jsonify({'success': False, 'error': 'Доступ запрещен'})
-        elif user.role == 'Z' and not trip.procurement_needed:
+        if not can_view_trip(user, trip):
             return jsonify({'success': False, 'error': 'Доступ запрещен'})
         
         # Получаем документы и группируем по типам
-        documents = Document.query.filter_by(trip_id=trip_id).order_by(Document.upload_date.desc()).all()
+        documents = Document.query.options(joinedload(Document.uploaded_by), joinedload(Document.stored_file)).filter_by(
+            trip_id=trip_id).order_by(Document.upload_date.desc()).all()
         
         documents_by_type = {
             'ticket': [],
@@ -1002,21 +3760,25 @@ def get_trip_documents(trip_id):
             'other': []
         }
         
+        # Права на удаление, не зависящие от конкретного документа, считаем один раз
+        can_delete_any = (
+            user.role in ['A', 'B', 'BU', 'GR'] or
+            user.role == 'R' and is_own_or_subordinate_trip(user, trip) or
+            user.role == 'S' and trip.employee_id == user.id
+        )
+
         for doc in documents:
             doc_dict = {
                 'id': doc.id,
                 'filename': doc.filename,
                 'file_path': doc.file_path,
+                'url': url_for('serve_document', document_id=doc.id),
+                'thumbnail_url': document_thumbnail_url(doc),
                 'file_type': doc.file_type or 'other',
                 'description': doc.description,
                 'upload_date': doc.upload_date.strftime('%d.%m.%Y %H:%M'),
                 'uploaded_by': doc.uploaded_by.full_name,
-                'can_delete': (
-                    user.role in ['A', 'B', 'BU', 'GR'] or
-                    user.role == 'R' and (trip.employee_id == user.id or trip.employee_id in [sub.id for sub in user.subordinates]) or
-                    user.id == doc.uploaded_by_id or
-                    user.role == 'S' and trip.employee_id == user.id
-                )
+                'can_delete': can_delete_any or user.id == doc.uploaded_by_id
             }
             
             if doc.file_type in documents_by_type:
@@ -1036,237 +3798,101 @@ def get_trip_documents(trip_id):
 
 @app.route('/api/trip/<int:trip_id>/deactivate', methods=['POST'])
 @login_required
-def deactivate_trip(trip_id):
-    try:
-        trip = db.session.get(BusinessTrip, trip_id)
-        if not trip:
-            return jsonify({'success': False, 'error': 'Заявка не найдена'})
-            
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-            
-        if user.role not in ['A', 'GR', 'R'] and trip.employee_id != user.id:
-            return jsonify({'success': False, 'error': 'Недостаточно прав'})
-        trip.is_activated = False
-        trip.status = 'Планируемая'
-        db.session.commit()
-        return jsonify({'success': True})
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'success': False, 'error': str(e)})
+@with_current_user
+def deactivate_trip(trip_id, user):
+    return trip_transition_response(user, trip_id, 'deactivate')
 
 
 @app.route('/api/trip/<int:trip_id>/reject', methods=['POST'])
 @login_required
-def reject_trip(trip_id):
-    try:
-        trip = db.session.get(BusinessTrip, trip_id)
-        if not trip:
-            return jsonify({'success': False, 'error': 'Заявка не найдена'})
-            
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-            
-        if user.role not in ['R', 'GR']:
-            return jsonify({'success': False, 'error': 'Недостаточно прав'})
-        trip.status = 'Не согласована'
-        trip.cancellation_reason = request.json.get('reason', '')
-        db.session.commit()
-        return jsonify({'success': True})
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'success': False, 'error': str(e)})
+@with_current_user
+def reject_trip(trip_id, user):
+    data = request.get_json(silent=True) or {}
+    return trip_transition_response(user, trip_id, 'reject', {'reason': data.get('reason', '')})
 
 
 @app.route('/api/trip/<int:trip_id>/cancel', methods=['POST'])
 @login_required
-def cancel_trip(trip_id):
-    try:
-        trip = db.session.get(BusinessTrip, trip_id)
-        if not trip:
-            return jsonify({'success': False, 'error': 'Заявка не найдена'})
-            
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-            
-        if user.role not in ['A', 'GR', 'R'] and trip.employee_id != user.id:
-            return jsonify({'success': False, 'error': 'Недостаточно прав'})
-        trip.status = 'Отменена'
-        trip.cancellation_reason = request.json.get('reason', '')
-        db.session.commit()
-        return jsonify({'success': True})
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'success': False, 'error': str(e)})
+@with_current_user
+def cancel_trip(trip_id, user):
+    data = request.get_json(silent=True) or {}
+    return trip_transition_response(user, trip_id, 'cancel', {'reason': data.get('reason', '')})
 
 
 @app.route('/api/trip/<int:trip_id>/approve_overrun', methods=['POST'])
 @login_required
-def approve_overrun(trip_id):
-    try:
-        trip = db.session.get(BusinessTrip, trip_id)
-        if not trip:
-            return jsonify({'success': False, 'error': 'Заявка не найдена'})
-            
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-            
-        if user.role not in ['R', 'GR']:
-            return jsonify({'success': False, 'error': 'Недостаточно прав'})
-        trip.overrun_approved = True
-        db.session.commit()
-        return jsonify({'success': True})
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'success': False, 'error': str(e)})
+@with_current_user
+def approve_overrun(trip_id, user):
+    return trip_transition_response(user, trip_id, 'approve_overrun')
 
 
 @app.route('/api/trip/<int:trip_id>/approve_booking_overrun', methods=['POST'])
 @login_required
-def approve_booking_overrun(trip_id):
-    try:
-        trip = db.session.get(BusinessTrip, trip_id)
-        if not trip:
-            return jsonify({'success': False, 'error': 'Заявка не найдена'})
-            
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-            
-        if user.role not in ['A', 'TK']:
-            return jsonify({'success': False, 'error': 'Недостаточно прав'})
-        trip.booking_overrun_approved = True
-        db.session.commit()
-        return jsonify({'success': True})
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'success': False, 'error': str(e)})
+@with_current_user
+def approve_booking_overrun(trip_id, user):
+    return trip_transition_response(user, trip_id, 'approve_booking_overrun')
 
 
 @app.route('/api/trip/<int:trip_id>/complete_booking', methods=['POST'])
 @login_required
-def complete_booking(trip_id):
+@with_current_user
+def complete_booking(trip_id, user):
     try:
-        trip = db.session.get(BusinessTrip, trip_id)
-        if not trip:
-            return jsonify({'success': False, 'error': 'Заявка не найдена'})
-            
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-            
-        # Разрешаем сотруднику отмечать бронирование выполненным
-        if user.role not in ['A', 'TK'] and (user.role != 'S' or trip.employee_id != user.id):
-            return jsonify({'success': False, 'error': 'Недостаточно прав'})
-        
-        if trip.booking_completed:
-            return jsonify({'success': False, 'error': 'Бронирование уже отмечено как выполненное'})
-        
-        # Проверяем заполнены ли основные поля бронирования
-        required_fields = ['transport_type', 'departure_city', 'arrival_city']
-        missing_fields = []
-        for field in required_fields:
-            if not getattr(trip, field):
-                missing_fields.append(field)
-        
-        if missing_fields:
-            return jsonify({
-                'success': False, 
-                'error': 'Заполните обязательные поля бронирования: ' + ', '.join(missing_fields)
-            })
-        
-        trip.booking_completed = True
-        trip.booking_completed_date = datetime.now(timezone.utc)
+        result = run_trip_transition(user, trip_id, 'complete_booking', version=if_match_version('trip', trip_id))
+        if result.get('conflict'):
+            db.session.rollback()
+            return trip_conflict_response(trip_id)
+        if not result['success']:
+            db.session.rollback()
+            return jsonify({'success': False, 'error': result['error']})
+
+        # Уведомление travel-координаторам уходит в той же транзакции
+        send_booking_completion_notification(db.session.get(BusinessTrip, trip_id), user)
         db.session.commit()
         
-        # Отправляем уведомление travel-координаторам
-        send_booking_completion_notification(trip, user)
-        
-        return jsonify({'success': True})
+        return versioned_response({'success': True}, 'trip', trip_id, result['version'])
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)})
 
 
 def send_booking_completion_notification(trip, completed_by):
-    """Отправка уведомления о выполнении бронирования"""
-    try:
-        # Находим travel-координаторов
-        tk_users = User.query.filter_by(role='TK').all()
-        message = f"Бронирование для командировки {trip.trip_number} отмечено как выполненное пользователем {completed_by.full_name}"
-        
-        for tk_user in tk_users:
-            # Здесь можно реализовать отправку email или других уведомлений
-            print(f"УВЕДОМЛЕНИЕ для travel-координатора {tk_user.full_name}: {message}")
-            
-    except Exception as e:
-        print(f"Ошибка отправки уведомлений: {e}")
+    """Уведомление travel-координаторов о выполнении бронирования (в очередь, в текущей транзакции)"""
+    message = f"Бронирование для командировки {trip.trip_number} отмечено как выполненное пользователем {completed_by.full_name}"
+    enqueue_notification('booking_completed', message, roles=['TK'], trip=trip)
 
 
 @app.route('/api/trip/<int:trip_id>/procurement', methods=['POST'])
 @login_required
-def toggle_procurement(trip_id):
-    try:
-        trip = db.session.get(BusinessTrip, trip_id)
-        if not trip:
-            return jsonify({'success': False, 'error': 'Заявка не найдена'})
-            
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-            
-        if user.role not in ['A', 'Z']:
-            return jsonify({'success': False, 'error': 'Недостаточно прав'})
-        trip.procurement_needed = request.json.get('needed', False)
-        db.session.commit()
-        return jsonify({'success': True})
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'success': False, 'error': str(e)})
+@with_current_user
+def toggle_procurement(trip_id, user):
+    data = request.get_json(silent=True) or {}
+    return trip_transition_response(user, trip_id, 'procurement', {'needed': data.get('needed', False)})
 
 
 @app.route('/api/trip/<int:trip_id>/procurement_done', methods=['POST'])
 @login_required
-def toggle_procurement_done(trip_id):
-    try:
-        trip = db.session.get(BusinessTrip, trip_id)
-        if not trip:
-            return jsonify({'success': False, 'error': 'Заявка не найдена'})
-            
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-            
-        if user.role not in ['A', 'Z']:
-            return jsonify({'success': False, 'error': 'Недостаточно прав'})
-        trip.procurement_done = request.json.get('done', False)
-        db.session.commit()
-        return jsonify({'success': True})
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'success': False, 'error': str(e)})
+@with_current_user
+def toggle_procurement_done(trip_id, user):
+    data = request.get_json(silent=True) or {}
+    return trip_transition_response(user, trip_id, 'procurement_done', {'done': data.get('done', False)})
 
 
 @app.route('/api/trip/<int:trip_id>/geo_location', methods=['POST'])
 @login_required
-def set_geo_location(trip_id):
+@with_current_user
+def set_geo_location(trip_id, user):
     """Установка геолокации командируемым сотрудником"""
     try:
         trip = db.session.get(BusinessTrip, trip_id)
         if not trip:
             return jsonify({'success': False, 'error': 'Заявка не найдена'})
             
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-            
         # Проверяем, что геопозицию устанавливает командируемый сотрудник
         if user.id != trip.employee_id:
             return jsonify({'success': False, 'error': 'Только командируемый сотрудник может установить геопозицию'})
+        if trip_version_mismatch(trip):
+            return trip_conflict_response(trip_id)
         
         location = request.json.get('location', '')
         location_type = request.json.get('location_type', 'auto')  # auto, manual
@@ -1302,12 +3928,14 @@ def set_geo_location(trip_id):
                 pass
         
         db.session.add(geo_history)
-        db.session.commit()
-        
         # Уведомление руководителям
         send_geo_notification_to_managers(trip, user, location)
+        db.session.commit()
         
-        return jsonify({'success': True})
+        return versioned_response({'success': True}, 'trip', trip_id, trip.version_id)
+    except StaleDataError:
+        db.session.rollback()
+        return trip_conflict_response(trip_id)
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)})
@@ -1315,22 +3943,20 @@ def set_geo_location(trip_id):
 # Получение истории геолокаций
 @app.route('/api/trip/<int:trip_id>/geo_history')
 @login_required
-def get_geo_history(trip_id):
+@with_current_user
+def get_geo_history(trip_id, user):
     """Получение истории геолокаций командируемого"""
     try:
         trip = db.session.get(BusinessTrip, trip_id)
         if not trip:
             return jsonify({'success': False, 'error': 'Заявка не найдена'})
             
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-        
         # Только руководители и администраторы видят историю
         if user.role not in ['A', 'R', 'GR', 'B']:
             return jsonify({'success': False, 'error': 'Недостаточно прав'})
         
-        history = GeoLocationHistory.query.filter_by(trip_id=trip_id).order_by(GeoLocationHistory.created_date.desc()).all()
+        history = GeoLocationHistory.query.options(joinedload(GeoLocationHistory.created_by)).filter_by(
+            trip_id=trip_id).order_by(GeoLocationHistory.created_date.desc()).all()
         
         history_list = []
         for record in history:
@@ -1355,142 +3981,43 @@ def get_geo_history(trip_id):
     
 # Функция уведомления руководителей
 def send_geo_notification_to_managers(trip, employee, location):
-    """Отправка уведомлений руководителям об установке геопозиции"""
-    try:
-        # Находим руководителей сотрудника
-        managers = []
-        
-        # Непосредственный руководитель
-        if trip.manager_rel:
-            managers.append(trip.manager_rel)
-        
-        # Главный руководитель
-        gr_manager = User.query.filter_by(role='GR').first()
-        if gr_manager and gr_manager not in managers:
-            managers.append(gr_manager)
-        
-        # Администраторы
-        admins = User.query.filter_by(role='A').all()
-        managers.extend([admin for admin in admins if admin not in managers])
-        
-        for manager in managers:
-            print(f"УВЕДОМЛЕНИЕ руководителю {manager.full_name}: "
-                  f"Сотрудник {employee.full_name} установил геопозицию: {location}")
-    except Exception as e:
-        print(f"Ошибка отправки уведомлений: {e}")
+    """Уведомление руководителей (непосредственный, ГР, администраторы) об установке геопозиции"""
+    message = f"Сотрудник {employee.full_name} установил геопозицию: {location}"
+    enqueue_notification('geo_location', message, roles=['GR', 'A'], user_ids=[trip.manager_id], trip=trip)
 
 
 @app.route('/api/trip/<int:trip_id>/approve_report_overrun', methods=['POST'])
 @login_required
-def approve_report_overrun(trip_id):
-    try:
-        trip = db.session.get(BusinessTrip, trip_id)
-        if not trip:
-            return jsonify({'success': False, 'error': 'Заявка не найдена'})
-            
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-            
-        if user.role not in ['R', 'GR']:
-            return jsonify({'success': False, 'error': 'Недостаточно прав'})
-        
-        trip.report_overrun_approved = True
-        db.session.commit()
-        
-        return jsonify({'success': True})
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'success': False, 'error': str(e)})
+@with_current_user
+def approve_report_overrun(trip_id, user):
+    return trip_transition_response(user, trip_id, 'approve_report_overrun')
 
 
 @app.route('/api/trip/<int:trip_id>/report_prepared', methods=['POST'])
 @login_required
-def toggle_report_prepared(trip_id):
-    try:
-        trip = db.session.get(BusinessTrip, trip_id)
-        if not trip:
-            return jsonify({'success': False, 'error': 'Заявка не найдена'})
-            
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-            
-        if trip.employee_id != user.id:
-            return jsonify({'success': False, 'error': 'Только сотрудник может отметить отчет как подготовленный'})
-        
-        prepared = request.json.get('prepared', False)
-        
-        if prepared:
-            # Проверяем заполнены ли расходы
-            if not trip.actual_costs or trip.actual_costs == 0:
-                return jsonify({'success': False, 'error': 'Заполните таблицу фактических расходов'})
-            
-            # Проверяем наличие документов
-            documents_count = Document.query.filter_by(trip_id=trip_id).count()
-            if documents_count == 0:
-                return jsonify({'success': False, 'error': 'Необходимо прикрепить хотя бы один документ'})
-        
-        trip.report_prepared = prepared
-        db.session.commit()
-        
-        return jsonify({'success': True})
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'success': False, 'error': str(e)})
+@with_current_user
+def toggle_report_prepared(trip_id, user):
+    data = request.get_json(silent=True) or {}
+    return trip_transition_response(user, trip_id, 'report_prepared', {'prepared': data.get('prepared', False)})
+
 
 @app.route('/api/trip/<int:trip_id>/report_reviewed', methods=['POST'])
 @login_required
-def toggle_report_reviewed(trip_id):
-    try:
-        trip = db.session.get(BusinessTrip, trip_id)
-        if not trip:
-            return jsonify({'success': False, 'error': 'Заявка не найдена'})
-            
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-            
-        if user.role not in ['R', 'GR']:
-            return jsonify({'success': False, 'error': 'Недостаточно прав'})
-        
-        reviewed = request.json.get('reviewed', False)
-        
-        if reviewed:
-            # Проверяем наличие геолокации
-            if not trip.geo_location:
-                return jsonify({'success': False, 'error': 'Не установлена геолокация сотрудником'})
-            
-            # Проверяем наличие документов
-            documents_count = Document.query.filter_by(trip_id=trip_id).count()
-            if documents_count == 0:
-                return jsonify({'success': False, 'error': 'Нет прикрепленных документов для проверки'})
-            
-            # Проверяем, что отчет подготовлен
-            if not trip.report_prepared:
-                return jsonify({'success': False, 'error': 'Отчет должен быть подготовлен сотрудником'})
-        
-        trip.report_reviewed = reviewed
-        db.session.commit()
-        
-        return jsonify({'success': True})
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'success': False, 'error': str(e)})
+@with_current_user
+def toggle_report_reviewed(trip_id, user):
+    data = request.get_json(silent=True) or {}
+    return trip_transition_response(user, trip_id, 'report_reviewed', {'reviewed': data.get('reviewed', False)})
 
 
 @app.route('/api/trip/<int:trip_id>/update_booking', methods=['POST'])
 @login_required
-def update_booking(trip_id):
+@with_current_user
+def update_booking(trip_id, user):
     try:
         trip = db.session.get(BusinessTrip, trip_id)
         if not trip:
             return jsonify({'success': False, 'error': 'Заявка не найдена'})
             
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-        
         # Проверка прав доступа
         can_edit = False
         
@@ -1501,6 +4028,8 @@ def update_booking(trip_id):
         
         if not can_edit:
             return jsonify({'success': False, 'error': 'Недостаточно прав для редактирования бронирования'})
+        if trip_version_mismatch(trip):
+            return trip_conflict_response(trip_id)
         
         data = request.json
         
@@ -1580,12 +4109,15 @@ def update_booking(trip_id):
         
         db.session.commit()
         
-        return jsonify({
+        return versioned_response({
             'success': True,
             'message': 'Данные бронирования обновлены',
             'booking_completed': trip.booking_completed
-        })
+        }, 'trip', trip_id, trip.version_id)
         
+    except StaleDataError:
+        db.session.rollback()
+        return trip_conflict_response(trip_id)
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)})
@@ -1593,47 +4125,22 @@ def update_booking(trip_id):
 
 @app.route('/api/trip/<int:trip_id>/trip_closed', methods=['POST'])
 @login_required
-def toggle_trip_closed(trip_id):
-    try:
-        trip = db.session.get(BusinessTrip, trip_id)
-        if not trip:
-            return jsonify({'success': False, 'error': 'Заявка не найдена'})
-            
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-            
-        if user.role not in ['A', 'BU']:
-            return jsonify({'success': False, 'error': 'Недостаточно прав'})
-        
-        closed = request.json.get('closed', False)
-        
-        if closed:
-            # Проверяем, что отчет проверен руководителем
-            if not trip.report_reviewed:
-                return jsonify({'success': False, 'error': 'Отчет должен быть проверен руководителем'})
-        
-        trip.trip_closed = closed
-        db.session.commit()
-        
-        return jsonify({'success': True})
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'success': False, 'error': str(e)})
+@with_current_user
+def toggle_trip_closed(trip_id, user):
+    data = request.get_json(silent=True) or {}
+    return trip_transition_response(user, trip_id, 'trip_closed', {'closed': data.get('closed', False)})
+
 
 # Управление расходами
 @app.route('/api/trip/<int:trip_id>/costs', methods=['GET', 'POST', 'DELETE'])
 @login_required
-def manage_trip_costs(trip_id):
+@with_current_user
+def manage_trip_costs(trip_id, user):
     try:
         trip = db.session.get(BusinessTrip, trip_id)
         if not trip:
             return jsonify({'success': False, 'error': 'Заявка не найдена'})
             
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-        
         # Проверяем, не закрыта ли командировка
         if trip.trip_closed and request.method != 'GET':
             return jsonify({'success': False, 'error': 'Командировка закрыта. Редактирование невозможно.'})
@@ -1646,23 +4153,17 @@ def manage_trip_costs(trip_id):
         if request.method == 'GET':
             # Получаем все расходы для командировки
             costs = TripCost.query.filter_by(trip_id=trip_id).order_by(TripCost.id).all()
-            costs_list = []
-            for cost in costs:
-                costs_list.append({
-                    'id': cost.id,
-                    'category': cost.category,
-                    'amount': cost.amount,
-                    'comment': cost.comment
-                })
-            
+            costs_list = [cost_to_dict(cost) for cost in costs]
+
             total_sum = sum(c.amount for c in costs) if costs else 0
-            
+
             return jsonify({
                 'success': True,
                 'costs': costs_list,
-                'total': total_sum
+                'total': total_sum,
+                'trip_version': trip.version_id
             })
-        
+
         elif request.method == 'POST':
             # Добавляем или обновляем расход
             data = request.json
@@ -1673,7 +4174,9 @@ def manage_trip_costs(trip_id):
                 cost = db.session.get(TripCost, cost_id)
                 if not cost or cost.trip_id != trip_id:
                     return jsonify({'success': False, 'error': 'Расход не найден'})
-                
+                if cost_version_mismatch(cost):
+                    return cost_conflict_response(trip_id)
+
                 cost.category = data['category']
                 cost.amount = float(data['amount'])
                 cost.comment = data.get('comment', '')
@@ -1691,9 +4194,10 @@ def manage_trip_costs(trip_id):
             
             # Обновляем общую сумму фактических расходов
             update_actual_costs(trip_id)
-            
-            return jsonify({'success': True, 'cost_id': cost.id})
-        
+
+            return versioned_response({'success': True, 'cost_id': cost.id, 'trip_version': trip.version_id},
+                                      'cost', cost.id, cost.version_id)
+
         elif request.method == 'DELETE':
             # Удаляем расход
             cost_id = request.args.get('cost_id')
@@ -1703,19 +4207,47 @@ def manage_trip_costs(trip_id):
             cost = db.session.get(TripCost, cost_id)
             if not cost or cost.trip_id != trip_id:
                 return jsonify({'success': False, 'error': 'Расход не найден'})
-            
+            if cost_version_mismatch(cost):
+                return cost_conflict_response(trip_id)
+
             db.session.delete(cost)
             db.session.commit()
-            
+
             # Обновляем общую сумму фактических расходов
             update_actual_costs(trip_id)
-            
-            return jsonify({'success': True})
-            
+
+            return jsonify({'success': True, 'trip_version': trip.version_id})
+
+    except StaleDataError:
+        db.session.rollback()
+        return cost_conflict_response(trip_id)
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)})
 
+def cost_to_dict(cost):
+    """Расход для JSON-ответов"""
+    return {
+        'id': cost.id,
+        'category': cost.category,
+        'amount': cost.amount,
+        'comment': cost.comment,
+        'version': cost.version_id
+    }
+
+
+def cost_version_mismatch(cost):
+    """True, если If-Match указывает версию расхода, отличную от текущей"""
+    version = if_match_version('cost', cost.id)
+    return version is not None and version != cost.version_id
+
+
+def cost_conflict_response(trip_id):
+    """409 с текущим списком расходов заявки; вызывается после rollback"""
+    costs = TripCost.query.filter_by(trip_id=trip_id).order_by(TripCost.id).all()
+    return jsonify({'success': False, 'error': COST_CONFLICT_ERROR, 'conflict': True,
+                    'costs': [cost_to_dict(cost) for cost in costs]}), 409
+
 # Функция для обновления общей суммы фактических расходов
 def update_actual_costs(trip_id):
     """Обновляет общую сумму фактических расходов на основе детализации"""
@@ -1731,156 +4263,427 @@ def update_actual_costs(trip_id):
 
 @app.route('/api/trip/<int:trip_id>/send_notification', methods=['POST'])
 @login_required
-def send_trip_notification(trip_id):
+@with_current_user
+def send_trip_notification(trip_id, user):
     """Отправка уведомлений о закрытии командировки"""
     try:
         trip = db.session.get(BusinessTrip, trip_id)
         if not trip:
             return jsonify({'success': False, 'error': 'Заявка не найдена'})
             
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-            
         data = request.json
         message = data.get('message', '')
-        roles = data.get('roles', [])
+        roles = [str(role) for role in data.get('roles') or []]
         
         if not message:
             return jsonify({'success': False, 'error': 'Не указано сообщение'})
         
-        # Находим пользователей для отправки уведомлений
-        users_to_notify = []
-        if roles:
-            users_to_notify = User.query.filter(User.role.in_(roles)).all()
-        
-        # Отправляем уведомления
-        notification_sent = []
-        for user_to_notify in users_to_notify:
-            # Здесь можно реализовать отправку email, push-уведомлений, Telegram и т.д.
-            # Пока просто логируем
-            print(f"Уведомление для {user_to_notify.full_name} ({user_to_notify.role}): {message}")
-            notification_sent.append({
-                'id': user_to_notify.id,
-                'name': user_to_notify.full_name,
-                'role': user_to_notify.role,
-                'email': user_to_notify.email
-            })
-        
+        notification = enqueue_notification('trip_notification', message, roles=roles, trip=trip)
+        db.session.commit()
+
         return jsonify({
             'success': True,
-            'message': f'Уведомления отправлены {len(notification_sent)} пользователям',
-            'notifications_sent': notification_sent
+            'message': 'Уведомления поставлены в очередь на отправку',
+            'notification_id': notification.id
         })
         
     except Exception as e:
+        db.session.rollback()
         return jsonify({'success': False, 'error': str(e)})
     
 # Функция для отправки уведомлений
 def send_notification_to_roles(roles, message):
-    """Отправляет уведомления пользователям с указанными ролями"""
+    """Отправляет уведомления пользователям с указанными ролями через очередь уведомлений"""
     try:
-        users = User.query.filter(User.role.in_(roles)).all()
-        for user in users:
-            # Здесь можно реализовать отправку email, push-уведомлений и т.д.
-            # Пока просто логируем
-            print(f"Уведомление для {user.full_name} ({user.role}): {message}")
-            
-            # В реальном приложении можно использовать:
-            # 1. Отправку email
-            # 2. Сохранение в таблицу уведомлений в БД
-            # 3. WebSocket для реальных уведомлений
-            # 4. Интеграцию с Telegram/Slack и т.д.
+        enqueue_notification('roles_notification', message, roles=roles)
+        db.session.commit()
     except Exception as e:
+        db.session.rollback()
         print(f"Ошибка при отправке уведомлений: {e}")
 
+
 # Функция для обновления общей суммы фактических расходов
 def update_actual_costs(trip_id):
-    try:
-        total = db.session.query(db.func.sum(TripCost.amount)).filter_by(trip_id=trip_id).scalar()
-        trip = db.session.get(BusinessTrip, trip_id)
-        if trip:
-            trip.actual_costs = total or 0
-            db.session.commit()
-    except Exception as e:
-        db.session.rollback()
-        print(f"Ошибка при обновлении суммы расходов: {e}")
+    # Параллельное изменение расходов увеличивает версию заявки: пересчитываем сумму заново
+    for attempt in range(3):
+        try:
+            total = db.session.query(db.func.sum(TripCost.amount)).filter_by(trip_id=trip_id).scalar()
+            trip = db.session.get(BusinessTrip, trip_id)
+            if trip:
+                trip.actual_costs = total or 0
+                db.session.commit()
+            return
+        except StaleDataError:
+            db.session.rollback()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Ошибка при обновлении суммы расходов: {e}")
+            return
+    print(f"Не удалось обновить сумму расходов заявки {trip_id}: заявка изменяется параллельно")
+
+# Потоковая упаковка документов в ZIP
+# Уже сжатые форматы кладутся в архив без сжатия, чтобы не тратить на них CPU
+ZIP_STORED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'gif', 'webp', 'docx', 'xlsx', 'zip'}
+ZIP_CHUNK_SIZE = 64 * 1024
+
+
+class ZipStreamSink:
+    """Файлоподобный приемник для zipfile: записанные байты забираются порциями через drain()"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def unique_arcname(arcname, used_names):
+    """Имя в архиве без повторов: 'чек.pdf', 'чек (2).pdf', ..."""
+    base, ext = os.path.splitext(arcname)
+    candidate, counter = arcname, 1
+    while candidate in used_names:
+        counter += 1
+        candidate = f"{base} ({counter}){ext}"
+    used_names.add(candidate)
+    return candidate
+
+
+def stream_zip(entries):
+    """Генератор ZIP-архива из троек (имя в архиве, функция открытия файла, дата изменения).
+
+    Файлы читаются из хранилища и отдаются кусками, поэтому память не зависит от размера
+    архива. Отсутствующие файлы пропускаются.
+    """
+    sink = ZipStreamSink()
+    used_names = set()
+    with zipfile.ZipFile(sink, 'w') as zf:
+        for arcname, open_file, modified in entries:
+            try:
+                src = open_file()
+            except FileNotFoundError:
+                continue
+            date_time = (modified or datetime.now(timezone.utc)).timetuple()[:6]
+            info = zipfile.ZipInfo(unique_arcname(arcname, used_names), date_time)
+            extension = arcname.rsplit('.', 1)[-1].lower() if '.' in arcname else ''
+            info.compress_type = zipfile.ZIP_STORED if extension in ZIP_STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+            with src, zf.open(info, 'w') as dst:
+                while True:
+                    chunk = src.read(ZIP_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            data = sink.drain()
+            if data:
+                yield data
+    yield sink.drain()
+
+
+def zip_response(entries, download_name):
+    """Ответ с архивом, который передается клиенту по мере упаковки"""
+    return Response(
+        stream_with_context(stream_zip(entries)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{download_name}"'}
+    )
+
+
+# Выгрузка заявок в CSV/XLSX
+# Строки читаются из БД порциями (yield_per) и сразу передаются клиенту
+TRIP_EXPORT_BATCH_SIZE = 1000
+XLSX_MAX_ROWS = 1048576  # Предел строк листа Excel, включая заголовок
+XML_ILLEGAL_CHARS = dict.fromkeys(c for c in range(32) if c not in (9, 10, 13))
+XLSX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '</Types>'
+)
+XLSX_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Target="xl/workbook.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+    '</Relationships>'
+)
+XLSX_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="{sheet_name}" sheetId="1" r:id="rId1"/></sheets></workbook>'
+)
+XLSX_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+    '<Relationship Id="rId2" Target="styles.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles"/>'
+    '</Relationships>'
+)
+# Стиль 1 - дата (встроенный формат 14)
+XLSX_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="14" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+XLSX_SHEET_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+)
+XLSX_SHEET_END = '</sheetData></worksheet>'
+EXCEL_EPOCH = datetime(1899, 12, 30)
+
+
+def trip_export_columns(employee):
+    """Столбцы выгрузки: (заголовок, выражение); строка - заявка или строка ее расходов"""
+    return [
+        ('Номер', BusinessTrip.trip_number),
+        ('Дата создания', BusinessTrip.created_date),
+        ('Статус', BusinessTrip.status),
+        ('Сотрудник', employee.full_name),
+        ('Подразделение', BusinessTrip.department),
+        ('Номер договора к проекту', BusinessTrip.project_number),
+        ('Место назначения', BusinessTrip.destination),
+        ('Цель поездки', BusinessTrip.purpose),
+        ('Дата начала', BusinessTrip.start_date),
+        ('Дата окончания', BusinessTrip.end_date),
+        ('Дней', BusinessTrip.duration),
+        ('Предполагаемые расходы', BusinessTrip.estimated_costs),
+        ('Фактические расходы', BusinessTrip.actual_costs),
+        ('Превышение лимита', BusinessTrip.over_limit),
+        ('Статья расхода', TripCost.category),
+        ('Сумма по статье', TripCost.amount),
+        ('Комментарий к расходу', TripCost.comment),
+    ]
+
+
+def trip_export_query(base_query, order_by):
+    """Строки выгрузки: заявки с ФИО сотрудника и строками расходов, читаются порциями"""
+    # Отдельный псевдоним: users уже используется в подзапросе видимости заявок руководителя
+    employee = db.aliased(User)
+    columns = trip_export_columns(employee)
+    query = base_query.outerjoin(employee, employee.id == BusinessTrip.employee_id).outerjoin(
+        TripCost, TripCost.trip_id == BusinessTrip.id).with_entities(*(column for _, column in columns))
+    query = query.order_by(*order_by, TripCost.id).yield_per(TRIP_EXPORT_BATCH_SIZE)
+    return [title for title, _ in columns], query
+
+
+def csv_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'Да' if value else 'Нет'
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, float):
+        return f'{value:.2f}'.replace('.', ',')
+    if isinstance(value, int):
+        return str(value)
+    value = str(value)
+    # Текст, который Excel принял бы за формулу, экранируется апострофом
+    return "'" + value if value[:1] in ('=', '+', '-', '@') else value
+
+
+def stream_csv(header, rows):
+    """CSV для Excel: UTF-8 с BOM, разделитель - точка с запятой, десятичная запятая"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';')
+    buffer.write('\ufeff')
+    writer.writerow(header)
+    yield buffer.getvalue().encode('utf-8')
+    buffer.seek(0)
+    buffer.truncate()
+
+    for row_count, row in enumerate(rows, start=1):
+        writer.writerow([csv_cell(value) for value in row])
+        if row_count % TRIP_EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def xlsx_cell(value):
+    if value is None:
+        return '<c/>'
+    if isinstance(value, bool):
+        value = 'Да' if value else 'Нет'
+    elif isinstance(value, datetime):
+        return f'<c s="1"><v>{(value.replace(tzinfo=None) - EXCEL_EPOCH).days}</v></c>'
+    elif isinstance(value, (int, float)):
+        return f'<c><v>{value}</v></c>'
+    text = xml_escape(str(value).translate(XML_ILLEGAL_CHARS))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def stream_xlsx(header, rows, sheet_name='Лист1'):
+    """Генератор XLSX-файла из одного листа.
+
+    Книга собирается вручную (строки inline, без общей таблицы строк), а лист пишется
+    в ZIP по мере чтения строк, поэтому первые байты уходят сразу, а память не зависит
+    от числа строк. Строки сверх предела Excel отбрасываются.
+    """
+    sink = ZipStreamSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('[Content_Types].xml', XLSX_CONTENT_TYPES)
+        zf.writestr('_rels/.rels', XLSX_ROOT_RELS)
+        zf.writestr('xl/workbook.xml', XLSX_WORKBOOK.format(sheet_name=xml_escape(sheet_name, {'"': '&quot;'})))
+        zf.writestr('xl/_rels/workbook.xml.rels', XLSX_WORKBOOK_RELS)
+        zf.writestr('xl/styles.xml', XLSX_STYLES)
+        yield sink.drain()
+
+        with zf.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write((XLSX_SHEET_START + '<row>' + ''.join(map(xlsx_cell, header)) + '</row>').encode('utf-8'))
+            for row_count, row in enumerate(itertools.islice(rows, XLSX_MAX_ROWS - 1), start=1):
+                sheet.write(('<row>' + ''.join(map(xlsx_cell, row)) + '</row>').encode('utf-8'))
+                if row_count % TRIP_EXPORT_BATCH_SIZE == 0:
+                    data = sink.drain()
+                    if data:
+                        yield data
+            sheet.write(XLSX_SHEET_END.encode('utf-8'))
+    yield sink.drain()
+
 
-# Функция для скачивания всех документов в формате архива
 # Скачивание всех документов в формате архива
 @app.route('/api/trip/<int:trip_id>/download_all_documents')
 @login_required
-def download_all_documents(trip_id):
+@with_current_user
+def download_all_documents(trip_id, user):
     try:
-        trip = db.session.get(BusinessTrip, trip_id)
+        trip = db.session.get(BusinessTrip, trip_id, options=[joinedload(BusinessTrip.employee)])
         if not trip:
             flash('Заявка не найдена', 'error')
             return redirect(url_for('dashboard'))
             
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            flash('Пользователь не найден', 'error')
-            return redirect(url_for('login'))
-        
         # Проверка прав доступа
-        if user.role == 'S' and trip.employee_id != user.id:
-            flash('Доступ запрещен', 'error')
-            return redirect(url_for('dashboard'))
-        elif user.role == 'R' and trip.employee_id != user.id and trip.employee_id not in [sub.id for sub in user.subordinates]:
+        if not can_view_trip(user, trip):
             flash('Доступ запрещен', 'error')
             return redirect(url_for('dashboard'))
         
         # Получаем все документы для командировки
-        documents = Document.query.filter_by(trip_id=trip_id).all()
+        documents = Document.query.filter_by(trip_id=trip_id).order_by(Document.upload_date).all()
         
         if not documents:
             flash('Нет документов для скачивания', 'info')
             return redirect(url_for('trip_detail', trip_id=trip_id))
         
-        # Создаем архив в памяти
-        memory_file = BytesIO()
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for doc in documents:
-                # Получаем полный путь к файлу
-                file_path = doc.file_path.replace('/static/', '')
-                full_path = os.path.join(app.root_path, file_path)
-                
-                if os.path.exists(full_path):
-                    # Добавляем файл в архив
-                    arcname = f"{doc.filename}"
-                    zf.write(full_path, arcname)
-        
-        memory_file.seek(0)
-        
-        # Отправляем архив пользователю
-        return send_file(
-            memory_file,
-            download_name=f'documents_{trip.trip_number}.zip',
-            as_attachment=True,
-            mimetype='application/zip'
-        )
+        # Отправляем архив пользователю по мере упаковки
+        entries = [(doc.filename, partial(open_document_file, doc.file_path, doc.content_hash),
+                    doc.upload_date) for doc in documents]
+        return zip_response(entries, f'documents_{trip.trip_number}.zip')
         
     except Exception as e:
         flash(f'Ошибка при создании архива: {str(e)}', 'error')
         return redirect(url_for('trip_detail', trip_id=trip_id))
 
+
+# Скачивание документов нескольких командировок (проект, месяц) одним архивом
+@app.route('/api/documents/export')
+@login_required
+@with_current_user
+def export_documents(user):
+    project_number = request.args.get('project_number')
+    month = request.args.get('month')  # YYYY-MM по дате начала командировки
+
+    query = db.session.query(Document.filename, Document.file_path, Document.content_hash, Document.upload_date,
+                             BusinessTrip.trip_number).join(
+        BusinessTrip, Document.trip_id == BusinessTrip.id).filter(trip_visibility_filter(user))
+
+    if not project_number and not month:
+        flash('Укажите проект или месяц для выгрузки документов', 'error')
+        return redirect(url_for('trips'))
+    if project_number:
+        query = query.filter(BusinessTrip.project_number == project_number)
+    if month:
+        try:
+            month_start = datetime.strptime(month, '%Y-%m')
+        except ValueError:
+            flash('Месяц должен быть в формате ГГГГ-ММ', 'error')
+            return redirect(url_for('trips'))
+        next_month = (month_start + timedelta(days=32)).replace(day=1)
+        query = query.filter(BusinessTrip.start_date >= month_start, BusinessTrip.start_date < next_month)
+
+    # Строки документов читаются из БД порциями, пока архив передается клиенту
+    rows = query.order_by(BusinessTrip.id, Document.upload_date).execution_options(yield_per=200)
+    entries = ((f"{trip_number}/{filename}", partial(open_document_file, file_path, content_hash),
+                upload_date) for filename, file_path, content_hash, upload_date, trip_number in rows)
+    name_suffix = '_'.join(secure_filename(part) for part in (project_number, month) if part) or 'export'
+    return zip_response(entries, f'documents_{name_suffix}.zip')
+
+
+# Выгрузка заявок со строками расходов в CSV/XLSX
+@app.route('/api/trips/export.<any(csv, xlsx):export_format>')
+@login_required
+@with_current_user
+def export_trips(export_format, user):
+    """Фильтры и сортировка страницы /trips, а при view=reports - страницы /reports"""
+    if request.args.get('view') == 'reports':
+        base_query = visible_trips_query(user).filter(BusinessTrip.is_activated == True)
+        base_query, current_filters = apply_report_filters(base_query, request.args)
+        order_by = report_order_by(current_filters['sort_by'])
+    else:
+        base_query, current_filters = apply_trip_filters(visible_trips_query(user), request.args)
+        order_by = (BusinessTrip.created_date.desc(), BusinessTrip.id.desc())
+
+    header, rows = trip_export_query(base_query, order_by)
+    if export_format == 'csv':
+        body, mimetype = stream_csv(header, rows), 'text/csv'
+    else:
+        body, mimetype = (stream_xlsx(header, rows, 'Заявки'),
+                          'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    download_name = f"trips_{datetime.now(timezone.utc).strftime('%Y%m%d')}.{export_format}"
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{download_name}"', 'X-Accel-Buffering': 'no'}
+    )
+
+
 # Добавляем возможность загрузки документов через сканирование (камера)
 @app.route('/api/trip/<int:trip_id>/upload_from_camera', methods=['POST'])
 @login_required
-def upload_from_camera(trip_id):
+@with_current_user
+def upload_from_camera(trip_id, user):
+    too_large = limit_upload_request()
+    if too_large:
+        return too_large
     try:
-        trip = db.session.get(BusinessTrip, trip_id)
+        trip = db.session.get(BusinessTrip, trip_id, options=[joinedload(BusinessTrip.employee)])
         if not trip:
             return jsonify({'success': False, 'error': 'Заявка не найдена'})
             
-        user = db.session.get(User, session['user_id'])
-        if not user:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'})
-        
         # Проверка прав доступа
-        if user.role == 'S' and trip.employee_id != user.id:
-            return jsonify({'success': False, 'error': 'Вы можете загружать документы только для своих командировок'})
-        elif user.role == 'R' and trip.employee_id != user.id and trip.employee_id not in [sub.id for sub in user.subordinates]:
+        if not can_view_trip(user, trip):
+            if user.role == 'S':
+                return jsonify({'success': False, 'error': 'Вы можете загружать документы только для своих командировок'})
             return jsonify({'success': False, 'error': 'Доступ запрещен'})
         
         if 'file' not in request.files:
@@ -1891,8 +4694,6 @@ def upload_from_camera(trip_id):
             return jsonify({'success': False, 'error': 'Файл не выбран'})
         
         # Принимаем изображения от камеры
-        ALLOWED_CAMERA_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
-        
         if file and '.' in file.filename and file.filename.rsplit('.', 1)[1].lower() in ALLOWED_CAMERA_EXTENSIONS:
             # Проверяем размер файла
             file.seek(0, os.SEEK_END)
@@ -1902,19 +4703,19 @@ def upload_from_camera(trip_id):
             if file_length > MAX_FILE_SIZE:
                 return jsonify({'success': False, 'error': 'Размер файла превышает 10MB'})
             
-            # Создаем уникальное имя файла
+            # Сохраняем файл во временную папку и переносим в хранилище по содержимому
             filename = secure_filename(file.filename)
-            unique_filename = f"scan_{trip_id}_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}_{filename}"
-            file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
-            
-            # Сохраняем файл
-            file.save(file_path)
+            temp_path = upload_partial_path(secrets.token_hex(16))
+            file.save(temp_path)
+            content_hash = store_document_content(temp_path)
+            unique_filename = document_upload_name(trip_id, filename, content_hash, 'scan_')
             
             # Создаем запись в базе данных
             document = Document(
                 trip_id=trip_id,
                 filename=filename,
                 file_path=f"/static/uploads/{unique_filename}",
+                content_hash=content_hash,
                 file_type='receipt',  # По умолчанию для сканированных документов
                 description=request.form.get('description', 'Сканированный документ'),
                 uploaded_by_id=user.id
@@ -1923,64 +4724,308 @@ def upload_from_camera(trip_id):
             db.session.add(document)
             db.session.commit()
             
-            return jsonify({
-                'success': True,
-                'document': {
-                    'id': document.id,
-                    'filename': document.filename,
-                    'file_path': document.file_path,
-                    'file_type': document.file_type,
-                    'description': document.description,
-                    'upload_date': document.upload_date.strftime('%d.%m.%Y %H:%M'),
-                    'uploaded_by': document.uploaded_by.full_name
-                }
-            })
+            return uploaded_document_response(document)
         else:
             return jsonify({'success': False, 'error': 'Недопустимый формат файла. Допустимы: PNG, JPG, JPEG, GIF, WEBP'})
             
+    except RequestEntityTooLarge:
+        return jsonify({'success': False, 'error': 'Размер файла превышает 10MB'}), 413
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)})
+
+# Загрузка документов частями с докачкой
+# init - создает сессию загрузки, PUT - дописывает часть с указанного смещения,
+# finalize - переносит собранный файл в хранилище документов и создает Document
+UPLOAD_READ_BLOCK = 64 * 1024
+UPLOAD_SESSION_NOT_FOUND = 'Загрузка не найдена или устарела, начните ее заново'
+
+
+def upload_partial_path(upload_id):
+    return os.path.join(UPLOAD_PARTIAL_FOLDER, f'{upload_id}.part')
+
+
+def upload_session_to_dict(upload):
+    return {'upload_id': upload.id, 'offset': upload.received_size, 'size': upload.total_size}
+
+
+def remove_partial_file(upload_id):
+    try:
+        os.remove(upload_partial_path(upload_id))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Ошибка при удалении временного файла загрузки {upload_id}: {e}")
+
+
+def purge_stale_uploads(now=None):
+    """Удаляет незавершенные загрузки, которые не продолжались дольше UPLOAD_SESSION_TTL"""
+    cutoff = utc_naive((now or datetime.now(timezone.utc)) - UPLOAD_SESSION_TTL)
+    stale_ids = db.session.scalars(db.select(UploadSession.id).where(UploadSession.updated_date < cutoff)).all()
+    if not stale_ids:
+        return 0
+    db.session.execute(db.delete(UploadSession).where(UploadSession.id.in_(stale_ids)))
+    db.session.commit()
+    for upload_id in stale_ids:
+        remove_partial_file(upload_id)
+    return len(stale_ids)
+
+
+@app.cli.command('purge-uploads')
+def purge_uploads_command():
+    """Удаляет незавершенные загрузки документов старше суток"""
+    click.echo(f"Удалено незавершенных загрузок: {purge_stale_uploads()}")
+
+
+def get_own_upload(upload_id, user):
+    """Сессия загрузки текущего пользователя или None"""
+    upload = db.session.get(UploadSession, upload_id)
+    if upload is None or upload.user_id != user.id:
+        return None
+    return upload
+
+
+def read_upload_chunk(target, limit):
+    """Пишет тело запроса в открытый файл, не больше limit байт.
+
+    Возвращает число записанных байт или None, если тело длиннее limit: лишнее
+    не дочитывается, а уже записанные байты не подтверждаются клиенту.
+    """
+    written = 0
+    while True:
+        block = request.stream.read(min(UPLOAD_READ_BLOCK, limit - written + 1))
+        if not block:
+            return written
+        if written + len(block) > limit:
+            return None
+        target.write(block)
+        written += len(block)
+
+
+@app.route('/api/trip/<int:trip_id>/uploads', methods=['POST'])
+@login_required
+@with_current_user
+def init_upload(trip_id, user):
+    try:
+        trip = db.session.get(BusinessTrip, trip_id, options=[joinedload(BusinessTrip.employee)])
+        if not trip:
+            return jsonify({'success': False, 'error': 'Заявка не найдена'})
+
+        # Проверка прав доступа
+        if not can_view_trip(user, trip):
+            if user.role == 'S':
+                return jsonify({'success': False, 'error': 'Вы можете загружать документы только для своих командировок'})
+            return jsonify({'success': False, 'error': 'Доступ запрещен'})
+
+        data = request.get_json(silent=True) or {}
+        source = data.get('source', 'document')
+        filename = secure_filename(data.get('filename') or '')
+        extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+        if source == 'camera':
+            if extension not in ALLOWED_CAMERA_EXTENSIONS:
+                return jsonify({'success': False, 'error': 'Недопустимый формат файла. Допустимы: PNG, JPG, JPEG, GIF, WEBP'})
+            file_type, description = 'receipt', data.get('description') or 'Сканированный документ'
+        elif source == 'document':
+            if not allowed_file(filename):
+                return jsonify({'success': False, 'error': 'Недопустимый формат файла'})
+            file_type, description = data.get('file_type') or 'other', data.get('description', '')
+        else:
+            return jsonify({'success': False, 'error': 'Неверный источник загрузки'})
+
+        try:
+            size = int(data.get('size'))
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'Не указан размер файла'})
+        if size <= 0:
+            return jsonify({'success': False, 'error': 'Файл пуст'})
+        if size > MAX_FILE_SIZE:
+            return jsonify({'success': False, 'error': 'Размер файла превышает 10MB'}), 413
+
+        purge_stale_uploads()
+        upload = UploadSession(
+            id=secrets.token_hex(16),
+            trip_id=trip_id,
+            user_id=user.id,
+            filename=filename,
+            source=source,
+            file_type=file_type,
+            description=description,
+            total_size=size
+        )
+        open(upload_partial_path(upload.id), 'wb').close()
+        db.session.add(upload)
+        db.session.commit()
+
+        return jsonify({'success': True, 'chunk_size': UPLOAD_CHUNK_SIZE, **upload_session_to_dict(upload)})
+
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/uploads/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+@login_required
+@with_current_user
+def upload_chunk(upload_id, user):
+    """GET - подтвержденное смещение для докачки, PUT - очередная часть файла
+    (смещение в заголовке Upload-Offset), DELETE - отмена загрузки"""
+    try:
+        upload = get_own_upload(upload_id, user)
+        if upload is None:
+            return jsonify({'success': False, 'error': UPLOAD_SESSION_NOT_FOUND}), 404
+
+        if request.method == 'GET':
+            return jsonify({'success': True, **upload_session_to_dict(upload)})
+
+        if request.method == 'DELETE':
+            db.session.delete(upload)
+            db.session.commit()
+            remove_partial_file(upload_id)
+            return jsonify({'success': True})
+
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Не указано смещение части (Upload-Offset)'}), 400
+        if offset != upload.received_size:
+            # Клиент продолжает с другого места: сообщаем, с какого байта слать дальше
+            return jsonify({'success': False, 'error': 'Неверное смещение части',
+                            'conflict': True, **upload_session_to_dict(upload)}), 409
+
+        remaining = upload.total_size - offset
+        if request.content_length is not None and request.content_length > remaining:
+            return jsonify({'success': False, 'error': 'Размер файла превышает заявленный при начале загрузки',
+                            **upload_session_to_dict(upload)}), 413
+
+        with open(upload_partial_path(upload_id), 'r+b') as target:
+            target.seek(offset)
+            written = read_upload_chunk(target, remaining)
+        if written is None:
+            return jsonify({'success': False, 'error': 'Размер файла превышает заявленный при начале загрузки',
+                            **upload_session_to_dict(upload)}), 413
+
+        # Смещение подтверждается условным UPDATE: из двух параллельных повторов одной части
+        # засчитывается одна, вторая получит 409 с актуальным смещением
+        db.session.rollback()
+        updated = db.session.execute(
+            db.update(UploadSession)
+            .where(UploadSession.id == upload_id, UploadSession.received_size == offset)
+            .values(received_size=offset + written, updated_date=datetime.now(timezone.utc))
+        ).rowcount
+        db.session.commit()
+        upload = db.session.get(UploadSession, upload_id)
+        if not updated:
+            return jsonify({'success': False, 'error': 'Неверное смещение части',
+                            'conflict': True, **upload_session_to_dict(upload)}), 409
+        return jsonify({'success': True, **upload_session_to_dict(upload)})
+
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+@login_required
+@with_current_user
+def finalize_upload(upload_id, user):
+    try:
+        upload = get_own_upload(upload_id, user)
+        if upload is None:
+            return jsonify({'success': False, 'error': UPLOAD_SESSION_NOT_FOUND}), 404
+        if upload.received_size != upload.total_size:
+            return jsonify({'success': False, 'error': 'Файл загружен не полностью',
+                            'conflict': True, **upload_session_to_dict(upload)}), 409
+
+        trip = db.session.get(BusinessTrip, upload.trip_id, options=[joinedload(BusinessTrip.employee)])
+        if not trip or not can_view_trip(user, trip):
+            return jsonify({'success': False, 'error': 'Доступ запрещен'})
+
+        db.session.delete(upload)
+        content_hash = store_document_content(upload_partial_path(upload_id))
+        prefix = 'scan_' if upload.source == 'camera' else ''
+        unique_filename = document_upload_name(trip.id, upload.filename, content_hash, prefix)
+        document = Document(
+            trip_id=trip.id,
+            filename=upload.filename,
+            file_path=f"/static/uploads/{unique_filename}",
+            content_hash=content_hash,
+            file_type=upload.file_type,
+            description=upload.description,
+            uploaded_by_id=user.id
+        )
+        db.session.add(document)
+        # Если тип файла - отчет, обновляем статус отчета
+        if upload.source == 'document' and upload.file_type == 'report' and user.role == 'S':
+            trip.report_prepared = True
+        db.session.commit()
+
+        return uploaded_document_response(document)
+
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)})
 
+
+# Флаг -> (параметр перехода, текст уведомления)
+TOGGLE_FLAG_MESSAGES = {
+    'report_prepared': ('prepared', "Отчёт по командировке {trip_number} подготовлен."),
+    'report_reviewed': ('reviewed', "Отчёт по командировке {trip_number} проверен."),
+    'trip_closed': ('closed', "Командировка {trip_number} закрыта."),
+}
+
+
 @app.route('/api/trip/<int:trip_id>/toggle_flag', methods=['POST'])
 @login_required
-def toggle_flag(trip_id):
-    
-    flag = request.json.get('flag')
-    trip = db.session.get(BusinessTrip, trip_id)
-    if not trip:
-        return jsonify({'error': 'Командировка не найдена'}), 404
-
-    if flag == 'report_prepared':
-        trip.report_prepared = True
-        if not trip.actual_costs or not trip.documents:
-            return jsonify({'error': 'Заполните поля расходов и прикрепите документы'}), 400
-        message = f"Отчёт по командировке {trip.trip_number} подготовлен."
-    elif flag == 'report_reviewed':
-        trip.report_reviewed = True
-        message = f"Отчёт по командировке {trip.trip_number} проверен."
-    elif flag == 'trip_closed':
-        trip.trip_closed = True
-        message = f"Командировка {trip.trip_number} закрыта."
-    else:
+@with_current_user
+def toggle_flag(trip_id, user):
+    flag = (request.get_json(silent=True) or {}).get('flag')
+    if flag not in TOGGLE_FLAG_MESSAGES:
         return jsonify({'error': 'Неверный флаг'}), 400
+    param, message = TOGGLE_FLAG_MESSAGES[flag]
 
-    db.session.commit()
+    try:
+        result = run_trip_transition(user, trip_id, flag, {param: True}, if_match_version('trip', trip_id))
+        if result.get('conflict'):
+            db.session.rollback()
+            return trip_conflict_response(trip_id)
+        if not result['success']:
+            db.session.rollback()
+            if result['error'] == 'Заявка не найдена':
+                return jsonify({'error': 'Командировка не найдена'}), 404
+            return jsonify({'error': result['error']}), 400
 
-    # Уведомление
-    users_to_notify = User.query.filter(User.role.in_(['A', 'B', 'GR', 'R', 'S', 'BU'])).all()
-    for user in users_to_notify:
-        # Здесь можно реализовать отправку email или push-уведомлений
-        print(f"Уведомление для {user.full_name}: {message}")
-    return jsonify({'success': True})
+        # Уведомление
+        trip = db.session.get(BusinessTrip, trip_id)
+        enqueue_notification(flag, message.format(trip_number=trip.trip_number),
+                             roles=['A', 'B', 'GR', 'R', 'S', 'BU'], trip=trip)
+        db.session.commit()
+        return versioned_response({'success': True}, 'trip', trip_id, result['version'])
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
 
 
 def init_db():
     from datetime import datetime, timedelta
     # Создаем все таблицы
+    ensure_search_extension()
     db.create_all()
     print("Таблицы базы данных созданы")
 
+    # Столбцы, добавленные в модели после создания таблиц
+    created_columns = ensure_columns()
+    if created_columns:
+        print(f"Добавлены столбцы: {', '.join(created_columns)}")
+
+    # Индексы для таблиц, созданных до их появления в моделях
+    created_indexes = ensure_indexes()
+    if created_indexes:
+        print(f"Созданы индексы: {', '.join(created_indexes)}")
+
+    # Итоги для отчетов появились позже заявок: заполняем их для существующей базы
+    if not TripReportRollup.query.first() and BusinessTrip.query.filter_by(is_activated=True).first():
+        print(f"Пересчитаны итоги для отчетов: {rebuild_report_rollup()} строк")
+
     # Создание тестовых пользователей если их нет
     if not User.query.first():
         print("Создание тестовых пользователей...")
@@ -2300,6 +5345,7 @@ def init_db():
         print(f"Найдено {existing_trips} существующих тестовых заявок. Пропуск создания новых.")
         return
 
+    trips = []
     for i in range(50): # Увеличим количество тестовых заявок до 50
         start_date = base_date + timedelta(days=i*3)
         end_date = start_date + timedelta(days=2)
@@ -2324,7 +5370,7 @@ def init_db():
         elif i % 7 == 4:
             status = 'Закрыта'
 
-        trip = BusinessTrip(
+        trips.append(dict(
             trip_number=trip_number,
             employee_id=employee.id,
             manager_id=manager.id,
@@ -2343,9 +5389,10 @@ def init_db():
             booking_overrun_approved=booking_overrun_approved,
             report_overrun_approved=report_overrun_approved,
             trip_closed=(status == 'Закрыта')
-        )
-        db.session.add(trip)
+        ))
 
+    # Одним INSERT, как при импорте из файла
+    insert_trip_rows(trips)
     db.session.commit()
     print(f"Создано {50} тестовых командировок")
 
@@ -2354,5 +5401,14 @@ def init_db():
 with app.app_context():
     init_db()
 
+if app.config['ESCALATION_SCHEDULER'] == 'thread':
+    start_escalation_scheduler()
+
+if app.config['NOTIFICATION_DISPATCHER'] == 'thread':
+    start_notification_dispatcher()
+
+if app.config['PREVIEW_GENERATOR'] == 'thread':
+    start_preview_generator()
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
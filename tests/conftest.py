@@ -0,0 +1,40 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+# app.py настраивается из окружения и создает папки загрузок относительно текущего
+# каталога при импорте, поэтому тесты работают во временном каталоге с базой SQLite
+TEST_DIR = tempfile.mkdtemp(prefix='krok-tests-')
+TEST_DB = os.path.join(TEST_DIR, 'test.db')
+TEMPLATE_DB = os.path.join(TEST_DIR, 'template.db')
+os.environ['DATABASE_URL'] = f"sqlite:///{TEST_DB}"
+os.environ['ESCALATION_SCHEDULER'] = 'off'
+os.environ['NOTIFICATION_DISPATCHER'] = 'off'
+os.environ['PREVIEW_GENERATOR'] = 'off'
+os.chdir(TEST_DIR)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+# База с тестовыми данными создана init_db при импорте; каждый тест получает ее копию
+shutil.copy(TEST_DB, TEMPLATE_DB)
+
+
+@pytest.fixture
+def app():
+    """Модуль приложения с исходной тестовой базой (пользователи и 50 заявок)"""
+    with app_module.app.app_context():
+        app_module.db.session.remove()
+        app_module.db.engine.dispose()
+        shutil.copy(TEMPLATE_DB, TEST_DB)
+        yield app_module
+        app_module.db.session.remove()
+
+
+@pytest.fixture
+def users(app):
+    """Тестовые пользователи по логину"""
+    return {user.username: user for user in app.User.query}
@@ -0,0 +1,46 @@
+import os
+
+
+def temp_upload(app, content):
+    path = os.path.join(app.UPLOAD_PARTIAL_FOLDER, 'upload.tmp')
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+def test_new_content_is_removed_when_transaction_rolls_back(app):
+    content_hash = app.store_document_content(temp_upload(app, b'rolled back'))
+    assert app.document_storage.exists(content_hash)
+
+    app.db.session.rollback()
+
+    assert not app.document_storage.exists(content_hash)
+    assert app.db.session.get(app.StoredFile, content_hash) is None
+
+
+def test_committed_content_is_kept(app):
+    content_hash = app.store_document_content(temp_upload(app, b'committed'))
+    app.db.session.commit()
+
+    # Откат следующей транзакции со ссылкой на то же содержимое не трогает файл
+    assert app.store_document_content(temp_upload(app, b'committed')) == content_hash
+    app.db.session.rollback()
+
+    assert app.document_storage.exists(content_hash)
+    assert app.db.session.get(app.StoredFile, content_hash).ref_count == 1
+
+
+def test_rollback_keeps_content_stored_by_concurrent_transaction(app):
+    content_hash = app.store_document_content(temp_upload(app, b'shared'))
+    app.db.session.rollback()
+    assert not app.document_storage.exists(content_hash)
+
+    # Параллельная транзакция сохранила то же содержимое после отката первой, но до ее очистки
+    app.store_document_content(temp_upload(app, b'shared'))
+    app.db.session.commit()
+    app.db.session.get(app.StoredFile, content_hash)  # Открывает транзакцию, которую откатим
+    app.db.session.info['stored_content'] = [content_hash]
+    app.db.session.rollback()
+
+    assert app.document_storage.exists(content_hash)
+    assert app.db.session.get(app.StoredFile, content_hash).ref_count == 1
@@ -0,0 +1,84 @@
+import io
+from datetime import datetime
+
+import pytest
+
+HEADER = ['Сотрудник', 'Дата начала', 'Дата окончания', 'Место назначения', 'Цель поездки',
+          'Предполагаемые расходы']
+
+
+def trip_count(app):
+    return app.BusinessTrip.query.count()
+
+
+def xlsx_file(app, rows):
+    return io.BytesIO(b''.join(app.stream_xlsx(HEADER, iter(rows))))
+
+
+def test_csv_import(app):
+    before = trip_count(app)
+    data = ('Сотрудник;Дата начала;Дата окончания;Место назначения;Цель поездки;Предполагаемые расходы\n'
+            'employee;01.03.2026;03.03.2026;Тестоград;Монтаж;12 500,50\n'
+            'employee;2026-04-10;2026-04-11;Самара;Аудит;8000\n').encode('utf-8-sig')
+
+    report = app.import_trips(io.BytesIO(data), 'plan.csv')
+    app.db.session.commit()
+
+    assert report['imported'] == 2 and report['error_rows'] == 0
+    assert trip_count(app) == before + 2
+    trip = app.BusinessTrip.query.filter_by(destination='Тестоград').one()
+    assert (trip.estimated_costs, trip.duration, trip.status) == (12500.5, 3, 'Планируемая')
+
+
+def test_csv_import_reports_row_errors(app):
+    before = trip_count(app)
+    data = ('Сотрудник;Дата начала;Дата окончания;Место назначения;Цель поездки;Предполагаемые расходы\n'
+            'employee;01.03.2026;03.03.2026;Тестоград;Монтаж;100\n'
+            'nobody;31.02.2026;03.03.2026;Тестоград;Монтаж;много\n').encode('utf-8')
+
+    report = app.import_trips(io.BytesIO(data), 'plan.csv')
+    app.db.session.rollback()
+
+    assert report['imported'] == 0 and report['error_rows'] == 1
+    assert report['errors'][0]['row'] == 3
+    assert len(report['errors'][0]['errors']) == 3
+    assert trip_count(app) == before
+
+
+@pytest.mark.parametrize('start_date, amount, error', [
+    (46000, 100, 'Неверная дата в поле «Дата начала»: 46000'),
+    (datetime(2026, 3, 1), datetime(2026, 1, 5), 'Неверная сумма: 2026-01-05 00:00:00'),
+], ids=['number-in-date', 'date-in-amount'])
+def test_mistyped_cell_is_row_error(app, start_date, amount, error):
+    # Так openpyxl отдает числовую ячейку в столбце даты и ячейку с форматом даты в столбце суммы
+    employees, departments = app.load_import_lookups()
+    record = {field: app.import_cell_value(field, value) for field, value in zip(
+        ('employee', 'start_date', 'end_date', 'destination', 'purpose', 'estimated_costs'),
+        ('employee', start_date, datetime(2026, 3, 3), 'Тестоград', 'Монтаж', amount))}
+
+    values, errors = app.validate_import_row(record, None, employees, departments, datetime.now())
+
+    assert values is None and errors == [error]
+
+
+def test_xlsx_import_with_mistyped_cells(app):
+    pytest.importorskip('openpyxl')
+    before = trip_count(app)
+    rows = [
+        ['employee', datetime(2026, 3, 1), datetime(2026, 3, 3), 'Тестоград', 'Монтаж', 12500.5],
+        ['employee', 46000, datetime(2026, 3, 3), 'Самара', 'Аудит', 100],
+        ['employee', datetime(2026, 3, 1), datetime(2026, 3, 3), 'Импортск', 'Аудит', datetime(2026, 1, 5)],
+    ]
+
+    report = app.import_trips(xlsx_file(app, rows), 'plan.xlsx', dry_run=True)
+    app.db.session.rollback()
+
+    assert (report['total'], report['error_rows']) == (3, 2)
+    assert [row_error['row'] for row_error in report['errors']] == [3, 4]
+    assert trip_count(app) == before
+
+    report = app.import_trips(xlsx_file(app, rows[:1]), 'plan.xlsx')
+    app.db.session.commit()
+    assert report['imported'] == 1
+    trip = app.BusinessTrip.query.filter_by(destination='Тестоград').one()
+    assert (trip.start_date, trip.estimated_costs) == (datetime(2026, 3, 1), 12500.5)
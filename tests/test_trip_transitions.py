@@ -0,0 +1,146 @@
+from datetime import datetime, timezone
+
+import pytest
+
+
+def trips_with_status(app, status):
+    return [trip.id for trip in app.BusinessTrip.query.filter_by(status=status).order_by(app.BusinessTrip.id)]
+
+
+def run(app, user, items):
+    return app.run_trip_transitions(user, items, datetime.now(timezone.utc))
+
+
+def rollup_rows(app):
+    table = app.TripReportRollup.__table__
+    rows = app.db.session.execute(app.db.select(table)).mappings()
+    return {tuple(row[column] for column in app.ROLLUP_KEY_COLUMNS):
+            tuple(pytest.approx(row[column]) for column in app.ROLLUP_MEASURE_COLUMNS) for row in rows}
+
+
+def test_owner_can_activate_own_trip(app, users):
+    trip_id = trips_with_status(app, 'Планируемая')[0]
+
+    result = run(app, users['employee'], [{'trip_id': trip_id, 'action': 'activate'}])[0]
+    app.db.session.commit()
+
+    assert result['success'] and result['version'] == 2
+    trip = app.db.session.get(app.BusinessTrip, trip_id)
+    assert (trip.status, trip.is_activated) == ('Активированная', True)
+
+
+@pytest.mark.parametrize('username, action, own_trip', [
+    ('sales_emp1', 'activate', False),       # Чужая заявка сотрудника
+    ('accountant', 'approve', False),        # Роль без права согласования
+    ('employee', 'approve', True),           # Сотрудник не согласует свои заявки
+    ('tk1', 'procurement', False),
+    ('manager', 'complete_booking', True),   # Бронирование отмечает только сотрудник-владелец, не руководитель
+])
+def test_forbidden_transition(app, users, username, action, own_trip):
+    status = 'Ожидают согласования' if action == 'approve' else 'Планируемая'
+    trip_id = trips_with_status(app, status)[0]
+    if own_trip:
+        app.db.session.get(app.BusinessTrip, trip_id).employee_id = users[username].id
+        app.db.session.commit()
+
+    result = run(app, users[username], [{'trip_id': trip_id, 'action': action}])[0]
+
+    assert not result['success']
+    assert result['error'] == 'Недостаточно прав'
+
+
+def test_manager_limited_to_own_and_subordinate_trips(app, users):
+    manager, employee = users['manager'], users['employee']
+    pending = trips_with_status(app, 'Ожидают согласования')
+
+    assert run(app, manager, [{'trip_id': pending[0], 'action': 'approve'}])[0]['error'] == 'Заявка не найдена'
+
+    employee.manager_id = manager.id
+    app.db.session.commit()
+    assert run(app, manager, [{'trip_id': pending[0], 'action': 'approve'}])[0]['success']
+
+
+def test_from_status_guard(app, users):
+    trip_id = trips_with_status(app, 'Согласована')[0]
+
+    result = run(app, users['admin'], [{'trip_id': trip_id, 'action': 'activate'}])[0]
+
+    assert not result['success']
+    assert result['error'] == 'Действие «Активировать» недоступно для заявки в статусе «Согласована»'
+    assert app.db.session.get(app.BusinessTrip, trip_id).status == 'Согласована'
+
+
+def test_invalid_params_fail_only_their_item(app, users):
+    first, second = trips_with_status(app, 'Планируемая')[:2]
+
+    results = run(app, users['admin'], [{'trip_id': first, 'action': 'cancel', 'params': [1]},
+                                        {'trip_id': second, 'action': 'cancel', 'params': {'reason': 'Перенос'}}])
+
+    assert results[0]['error'] == 'Неверные параметры действия'
+    assert results[1]['success']
+
+
+def test_concurrent_change_is_reported_as_conflict(app, users, monkeypatch):
+    trip_id = trips_with_status(app, 'Планируемая')[0]
+    load_trip_rows = app.load_trip_rows
+
+    def load_then_change_concurrently(trip_ids):
+        rows = load_trip_rows(trip_ids)
+        # Другой пользователь меняет статус между чтением и условным UPDATE
+        with app.db.engine.begin() as connection:
+            connection.execute(app.db.update(app.BusinessTrip).where(app.BusinessTrip.id == trip_id).values(
+                status='Отменена', version_id=app.BusinessTrip.version_id + 1))
+        return rows
+
+    monkeypatch.setattr(app, 'load_trip_rows', load_then_change_concurrently)
+    result = run(app, users['admin'], [{'trip_id': trip_id, 'action': 'activate'}])[0]
+
+    assert not result['success']
+    assert result['conflict'] and result['error'] == app.TRIP_CONFLICT_ERROR
+    app.db.session.rollback()
+    assert app.db.session.get(app.BusinessTrip, trip_id).status == 'Отменена'
+
+
+def test_stale_version_is_rejected(app, users):
+    trip_id = trips_with_status(app, 'Планируемая')[0]
+
+    result = run(app, users['admin'], [{'trip_id': trip_id, 'action': 'activate', 'version': 5}])[0]
+
+    assert result['conflict'] and result['error'] == app.TRIP_CONFLICT_ERROR
+
+
+def test_batch_keeps_report_rollup_consistent_with_rebuild(app, users):
+    items = [{'trip_id': trip_id, 'action': 'activate'} for trip_id in trips_with_status(app, 'Планируемая')]
+    items += [{'trip_id': trip_id, 'action': 'approve'} for trip_id in trips_with_status(app, 'Ожидают согласования')]
+    items += [{'trip_id': trip_id, 'action': 'deactivate'} for trip_id in trips_with_status(app, 'Согласована')[:3]]
+    items += [{'trip_id': trip_id, 'action': 'approve_overrun'} for trip_id in trips_with_status(app, 'Не согласована')]
+
+    results = run(app, users['gr_manager'], items)
+    app.db.session.commit()
+
+    assert all(result['success'] for result in results)
+    incremental = rollup_rows(app)
+    app.rebuild_report_rollup()
+    assert incremental == rollup_rows(app)
+
+
+@pytest.mark.parametrize('url', [
+    '/api/update_trip_status/{trip_id}',
+    '/api/trip/{trip_id}/reject',
+    '/api/trip/{trip_id}/cancel',
+    '/api/trip/{trip_id}/procurement',
+    '/api/trip/{trip_id}/procurement_done',
+    '/api/trip/{trip_id}/report_prepared',
+    '/api/trip/{trip_id}/report_reviewed',
+    '/api/trip/{trip_id}/trip_closed',
+    '/api/trip/{trip_id}/toggle_flag',
+])
+def test_request_without_json_body_gets_json_answer(app, url):
+    client = app.app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    trip_id = trips_with_status(app, 'Планируемая')[0]
+
+    response = client.post(url.format(trip_id=trip_id))
+
+    assert response.is_json
+    assert response.status_code in (200, 400)